@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from hashlib import sha256
+
+from popper import utils as pu
+from popper.cli import log
+
+
+class StepCache(object):
+    """Stores the outputs of steps so that a step whose definition, image and
+    inputs have not changed since a previous execution is not executed again.
+
+    Only steps that declare ``inputs`` or ``outputs`` attributes are cached.
+    Entries are stored in ``<cache_dir>/steps/<key>``, where the key is a
+    digest of the step definition (after options have been propagated and
+    substitutions applied), the engine and image it runs on and the contents
+    of its declared inputs.
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._cache_dir = os.path.join(config.cache_dir, "steps")
+
+    @staticmethod
+    def is_cacheable(step):
+        """True if the step declares inputs or outputs."""
+        return "inputs" in step or "outputs" in step
+
+    def key(self, step, engine_name, image_digest=None):
+        """Computes the cache key for a step.
+
+        Args:
+          step(Box): step information.
+          engine_name(str): name of the engine that executes the step.
+          image_digest(str): identifier of the image used by the step, if the
+            engine is able to obtain one.
+
+        Returns:
+          str: hex digest identifying the step.
+        """
+        inputs = StepCache._paths(step, "inputs")
+        # accessing a missing attribute of a step adds an empty dictionary
+        # for it (see box.Box's default_box), so we leave those out
+        step_data = {k: v for k, v in step.to_dict().items() if v != {}}
+        data = {
+            "step": step_data,
+            "engine": engine_name,
+            "image": image_digest,
+            "inputs": pu.paths_digest(self._config.workspace_dir, inputs),
+        }
+        return sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def restore(self, key, step):
+        """Copies the outputs stored for the given key into the workspace.
+
+        Returns:
+          bool: True if an entry for the key exists, False otherwise.
+        """
+        outputs = StepCache._paths(step, "outputs")
+
+        entry_dir = os.path.join(self._cache_dir, key)
+        if not os.path.isfile(os.path.join(entry_dir, "step.json")):
+            return False
+
+        for p in outputs:
+            src = os.path.join(entry_dir, "outputs", p)
+            dst = os.path.join(self._config.workspace_dir, p)
+            log.debug(f"restoring {p} from {entry_dir}")
+            StepCache._copy(src, dst)
+
+        return True
+
+    def store(self, key, step):
+        """Saves the outputs of a step that just executed successfully."""
+        outputs = StepCache._paths(step, "outputs")
+        for p in outputs:
+            if not os.path.exists(os.path.join(self._config.workspace_dir, p)):
+                log.warning(f"Step '{step.id}' did not produce output '{p}'.")
+                return
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self._cache_dir, prefix=".tmp_")
+
+        for p in outputs:
+            src = os.path.join(self._config.workspace_dir, p)
+            dst = os.path.join(tmp_dir, "outputs", p)
+            StepCache._copy(src, dst)
+
+        with open(os.path.join(tmp_dir, "step.json"), "w") as f:
+            json.dump({"id": step.id, "created": time.time()}, f)
+
+        entry_dir = os.path.join(self._cache_dir, key)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another execution stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def _paths(step, attr):
+        """Returns the paths given in the 'inputs' or 'outputs' attribute of a
+        step, normalized. Fails if a path is not inside the workspace, since
+        outputs are removed before being restored (or stored).
+        """
+        paths = []
+        for p in list(step[attr]) if attr in step else []:
+            path = os.path.normpath(p)
+            if (
+                os.path.isabs(path)
+                or path in [os.curdir, os.pardir]
+                or path.startswith(os.pardir + os.sep)
+            ):
+                log.fail(
+                    f"Step '{step.id}': '{p}' in '{attr}' is not a path inside "
+                    "the workspace."
+                )
+            paths.append(path)
+        return paths
+
+    @staticmethod
+    def _copy(src, dst):
+        """Copies a file or folder, replacing dst if it exists."""
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        elif os.path.lexists(dst):
+            os.remove(dst)
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, symlinks=True)
+        else:
+            shutil.copy2(src, dst, follow_symlinks=False)
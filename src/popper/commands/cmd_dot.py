@@ -31,12 +31,11 @@ def cli(ctx, file, skip, colors):
     act_attr = node_attrs.format("", ",color=cyan" if colors else "")
     dot_str = ""
     dot_str += f'  "Workflow" [{wf_attr}];\n'
-    for i, step in enumerate(wf.steps):
-        n = wf.steps[i]["id"]
+    deps = WorkflowParser.get_dependencies(wf)
+    for step in wf.steps:
+        n = step["id"]
         dot_str += f'  "{n}" [{act_attr}];\n'
-        if i == 0:
-            parent = "Workflow"
-        else:
-            parent = wf.steps[i - 1]["id"]
-        dot_str += f'  "{parent}" -> "{n}";\n'
+        parents = [s["id"] for s in wf.steps if s["id"] in deps[n]]
+        for parent in parents or ["Workflow"]:
+            dot_str += f'  "{parent}" -> "{n}";\n'
     log.info("digraph G { graph [bgcolor=transparent];\n" + dot_str + "}\n")
@@ -0,0 +1,91 @@
+import click
+
+from popper import utils as pu
+from popper.cli import log, pass_context
+from popper.config import ConfigLoader
+from popper.gc import GarbageCollector
+
+
+@click.command("gc", short_help="Remove resources left behind by workflows.")
+@click.option(
+    "-e",
+    "--engine",
+    help="Container engine whose containers and images are removed.",
+    type=click.Choice(["docker", "singularity", "podman"]),
+)
+@click.option(
+    "-r",
+    "--resource-manager",
+    help="Resource manager whose pods and volumes are removed.",
+    type=click.Choice(["host", "kubernetes"]),
+)
+@click.option(
+    "--older-than",
+    help=(
+        "Also remove resources of workspaces that have not been used for the "
+        "given time (e.g. 12h or 7d)."
+    ),
+    required=False,
+)
+@click.option(
+    "--dry-run",
+    help="Only list the resources that would be removed.",
+    required=False,
+    is_flag=True,
+)
+@click.option(
+    "-j",
+    "--jobs",
+    help="Maximum number of resources to remove concurrently.",
+    required=False,
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+)
+@click.option(
+    "-c", "--conf", help="Path to file with configuration options.", required=False
+)
+@pass_context
+def cli(ctx, engine, resource_manager, older_than, dry_run, jobs, conf):
+    """Removes the resources that executions of workflows leave behind:
+    clones of the repositories referenced by steps, containers of steps,
+    images built by popper (docker), SIF files (singularity) and pods, jobs
+    and volumes (kubernetes).
+
+    Resources of workspaces whose folder no longer exists are removed. When
+    --older-than is given, resources of workspaces that have not been used
+    for longer than that are removed as well, and so are images that are
+    older than that and shared SIF files that have not been used since. The
+    engine and resource manager are given by the --engine/-e and
+    --resource-manager/-r flags, or by a configuration file (--conf flag),
+    like for 'popper run'.
+    """
+    config = ConfigLoader.load(
+        engine_name=engine, resman_name=resource_manager, config_file=conf
+    )
+
+    max_age = pu.parse_duration(older_than) if older_than else None
+
+    gc = GarbageCollector(config)
+    resources = [r for r in gc.find() if gc.is_garbage(r, max_age)]
+
+    if not resources:
+        log.info("Nothing to remove.")
+        return
+
+    log.info(f"{'Kind':<14}{'Size':>10}  Name")
+    for r in resources:
+        log.info(f"{r.kind:<14}{GarbageCollector.format_size(r.size):>10}  {r.name}")
+
+    sizes = [r.size for r in resources if isinstance(r.size, int)]
+    total = GarbageCollector.format_size(sum(sizes))
+
+    if dry_run:
+        log.info(f"{len(resources)} resources ({total}) would be removed.")
+        return
+
+    failed = GarbageCollector.collect(resources, jobs)
+    if failed:
+        log.fail(f"{failed} of {len(resources)} resources could not be removed.")
+
+    log.info(f"Removed {len(resources)} resources ({total}).")
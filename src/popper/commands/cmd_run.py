@@ -5,6 +5,7 @@ import traceback
 from popper import log as logging
 from popper.cli import log, pass_context
 from popper.config import ConfigLoader
+from popper.exporter import WorkflowExporter
 from popper.parser import WorkflowParser
 from popper.runner import WorkflowRunner
 
@@ -74,6 +75,18 @@ from popper.runner import WorkflowRunner
     required=False,
     is_flag=True,
 )
+@click.option(
+    "--shallow-clone",
+    help="Fetch only the referenced version of step repositories.",
+    required=False,
+    is_flag=True,
+)
+@click.option(
+    "--skip-cache",
+    help="Execute steps even if their results are in the step cache.",
+    required=False,
+    is_flag=True,
+)
 @click.option(
     "--skip-pull",
     help="Skip pulling container images (assume they exist in local cache).",
@@ -88,6 +101,15 @@ from popper.runner import WorkflowRunner
     default=list(),
     multiple=True,
 )
+@click.option(
+    "--matrix",
+    help=(
+        "Run the workflow once for each combination of the values given to "
+        "substitutions that appear multiple times."
+    ),
+    required=False,
+    is_flag=True,
+)
 @click.option(
     "--allow-loose",
     help=(
@@ -106,6 +128,15 @@ from popper.runner import WorkflowRunner
     required=False,
     is_flag=True,
 )
+@click.option(
+    "-j",
+    "--jobs",
+    help="Maximum number of steps to execute concurrently.",
+    required=False,
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+)
 @click.option(
     "-w",
     "--workspace",
@@ -129,12 +160,16 @@ def cli(
     reuse,
     engine,
     resource_manager,
+    shallow_clone,
     skip,
+    skip_cache,
     skip_pull,
     skip_clone,
     substitution,
+    matrix,
     allow_loose,
     allow_undefined_secrets_in_ci,
+    jobs,
     workspace,
     conf,
 ):
@@ -150,6 +185,16 @@ def cli(
     If the container engine (-e) or resource manager (-r) are specified with a
     flag and a configuration file is given as well, the values passed via the
     flags are given preference over those contained in the configuration file.
+
+    Steps run one at a time in the order they are defined. When --jobs/-j is
+    given, independent steps (see the 'needs' attribute of a step) execute
+    concurrently.
+
+    When --matrix is given, the workflow runs for every combination of the
+    values of substitutions that are given more than once, e.g. '-s _A=a1 -s
+    _A=a2 -s _B=b1 -s _B=b2' runs four instances of the workflow. Locally,
+    up to --jobs/-j instances run at the same time. On Kubernetes, a step
+    executes for all the instances as an Indexed Job.
     """
     # set the logging levels.
     level = "STEP_INFO"
@@ -170,14 +215,32 @@ def cli(
     if skip and step:
         log.fail("`--skip` can not be used when STEP argument is passed.")
 
-    # invoke wf factory; handles formats, validations, filtering
-    wf = WorkflowParser.parse(
-        file,
-        step=step,
-        skipped_steps=skip,
-        substitutions=substitution,
-        allow_loose=allow_loose,
-    )
+    if matrix and not substitution:
+        log.fail("`--matrix` requires substitutions (-s/--substitution).")
+
+    if matrix:
+        variables = WorkflowExporter._get_matrix_variables(substitution)
+        wfs = []
+        for i, element in enumerate(WorkflowExporter._get_matrix(variables)):
+            log.info(f"[{i}] " + " ".join(f"_{k}={v}" for k, v in element.items()))
+            wfs.append(
+                WorkflowParser.parse(
+                    file,
+                    step=step,
+                    skipped_steps=skip,
+                    substitutions=[f"_{k}={v}" for k, v in element.items()],
+                    allow_loose=allow_loose,
+                )
+            )
+    else:
+        # invoke wf factory; handles formats, validations, filtering
+        wf = WorkflowParser.parse(
+            file,
+            step=step,
+            skipped_steps=skip,
+            substitutions=substitution,
+            allow_loose=allow_loose,
+        )
 
     config = ConfigLoader.load(
         engine_name=engine,
@@ -187,13 +250,19 @@ def cli(
         dry_run=dry_run,
         skip_pull=skip_pull,
         skip_clone=skip_clone,
+        shallow_clone=shallow_clone,
+        skip_cache=skip_cache,
         workspace_dir=workspace,
         allow_undefined_secrets_in_ci=allow_undefined_secrets_in_ci,
+        jobs=jobs,
     )
 
     with WorkflowRunner(config) as runner:
         try:
-            runner.run(wf)
+            if matrix:
+                runner.run_matrix(wfs)
+            else:
+                runner.run(wf)
         except Exception as e:
             log.debug(traceback.format_exc())
             log.fail(e)
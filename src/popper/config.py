@@ -21,8 +21,11 @@ class ConfigLoader(object):
         quiet=False,
         skip_pull=False,
         skip_clone=False,
+        shallow_clone=False,
+        skip_cache=False,
         pty=False,
         allow_undefined_secrets_in_ci=False,
+        jobs=1,
     ):
         """Loads and creates a configuration, represented by a frozen Box
         """
@@ -37,6 +40,11 @@ class ConfigLoader(object):
             cache_dir = os.environ.get("XDG_CACHE_HOME", cache_dir_default)
             cache_dir = os.path.join(cache_dir, "popper")
 
+        # wid is used to associate a unique id to this workspace. This is then
+        # used by runners to name resources in a way that there is no name
+        # clash between concurrent workflows being executed
+        wid = shake_256(workspace_dir.encode("utf-8")).hexdigest(4)
+
         from_file = ConfigLoader.__load_config_from_file(
             config_file, engine_name, resman_name
         )
@@ -48,8 +56,11 @@ class ConfigLoader(object):
             "quiet": quiet,
             "skip_pull": skip_pull,
             "skip_clone": skip_clone,
+            "shallow_clone": shallow_clone,
+            "skip_cache": skip_cache,
             "pty": pty,
             "allow_undefined_secrets_in_ci": allow_undefined_secrets_in_ci,
+            "jobs": jobs,
             # if no git repository exists in workspace_dir or its parents, the repo
             # variable is None and all git_* variables are assigned to 'na'
             "repo": repo,
@@ -58,11 +69,10 @@ class ConfigLoader(object):
             "git_branch": scm.get_branch(repo),
             "git_tag": scm.get_tag(repo),
             "git_remote_origin_url": scm.get_remote_url(repo),
-            # wid is used to associate a unique id to this workspace. This is then
-            # used by runners to name resources in a way that there is no name
-            # clash between concurrent workflows being executed
-            "wid": shake_256(workspace_dir.encode("utf-8")).hexdigest(4),
+            "wid": wid,
             "cache_dir": cache_dir,
+            # folder where repositories referenced by steps are cloned
+            "clone_dir": os.path.join(cache_dir, wid),
             "engine_name": from_file["engine_name"],
             "resman_name": from_file["resman_name"],
             "engine_opts": from_file["engine_opts"],
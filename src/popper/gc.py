@@ -0,0 +1,377 @@
+import json
+import os
+import re
+import shutil
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from popper.cli import log
+
+
+# a resource left behind by popper. The wid is None for resources that are
+# shared by workspaces, size is given in bytes (or as a string when an engine
+# reports it that way) and created is a timestamp
+Resource = namedtuple("Resource", ["kind", "name", "wid", "size", "created", "remove"])
+
+
+class GarbageCollector(object):
+    """Finds the resources that executions of workflows leave behind in a
+    machine (clones of repositories, containers, images, SIF files and
+    kubernetes pods and volumes), and removes those that belong to workspaces
+    that no longer exist or that have not been used for a while.
+
+    Each execution records the folder of its workspace and the time when it
+    ran in ``<cache_dir>/workspaces/<wid>.json`` (see record_workspace()),
+    which is how resources named after a wid are traced back to a workspace.
+    """
+
+    # matches the wid of a workspace, optionally followed by the index of a
+    # matrix element (see WorkflowRunner.run_matrix())
+    _wid_re = r"[0-9a-f]{8}(?:-[0-9]+)?"
+
+    def __init__(self, config):
+        self._config = config
+        self._workspaces = GarbageCollector._read_workspaces(config.cache_dir)
+
+    @staticmethod
+    def record_workspace(config):
+        """Records that the workspace of the given configuration is in use."""
+        workspaces_dir = os.path.join(config.cache_dir, "workspaces")
+        os.makedirs(workspaces_dir, exist_ok=True)
+        marker = {"workspace_dir": config.workspace_dir, "last_run": time.time()}
+        tmp_file = os.path.join(workspaces_dir, f".{config.wid}.json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(marker, f)
+        os.replace(tmp_file, os.path.join(workspaces_dir, f"{config.wid}.json"))
+
+    @staticmethod
+    def _read_workspaces(cache_dir):
+        """Returns a dict that maps the wid of each recorded workspace to its
+        folder and the time when it was last used."""
+        workspaces = {}
+        workspaces_dir = os.path.join(cache_dir, "workspaces")
+        if not os.path.isdir(workspaces_dir):
+            return workspaces
+        for f in os.listdir(workspaces_dir):
+            if not f.endswith(".json") or f.startswith("."):
+                continue
+            with open(os.path.join(workspaces_dir, f), "r") as marker:
+                workspaces[f[: -len(".json")]] = json.load(marker)
+        return workspaces
+
+    def find(self):
+        """Lists the resources of the engine and resource manager of the
+        configuration, as well as the repositories cloned for workspaces.
+
+        Returns:
+          list: a Resource for each of the resources that were found.
+        """
+        resources = self._find_clones()
+
+        if self._config.engine_name == "docker":
+            resources += self._find_docker()
+        elif self._config.engine_name == "podman":
+            resources += self._find_podman()
+        elif self._config.engine_name == "singularity":
+            resources += self._find_singularity()
+
+        if self._config.resman_name == "kubernetes":
+            resources += self._find_kubernetes()
+
+        return resources
+
+    def is_garbage(self, resource, older_than=None):
+        """Decides whether a resource should be removed, which is the case
+        if its workspace no longer exists or, when older_than is given, if
+        the workspace (or the resource, when it is not associated to any
+        workspace) has not been used for more than older_than seconds.
+        """
+        workspace = None
+        if resource.wid:
+            workspace = self._workspaces.get(resource.wid.split("-")[0], None)
+
+        if workspace and not os.path.isdir(workspace["workspace_dir"]):
+            return True
+
+        if older_than is None:
+            return False
+
+        last_used = workspace["last_run"] if workspace else resource.created
+        return time.time() - last_used > older_than
+
+    @staticmethod
+    def collect(resources, jobs=4):
+        """Removes the given resources, up to jobs at the same time. Failures
+        are reported but don't stop the removal of other resources.
+
+        Returns:
+          int: the number of resources that could not be removed.
+        """
+
+        def remove(resource):
+            try:
+                resource.remove()
+                log.info(f"Removed {resource.kind} {resource.name}")
+                return True
+            except Exception as e:
+                log.warning(f"Could not remove {resource.kind} {resource.name}: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            removed = list(executor.map(remove, resources))
+
+        return removed.count(False)
+
+    @staticmethod
+    def format_size(size):
+        """Returns a human readable representation of a size in bytes."""
+        if size is None:
+            return "-"
+        if isinstance(size, str):
+            return size
+        for unit in ["B", "KB", "MB", "GB"]:
+            if size < 1024:
+                return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+            size /= 1024
+        return f"{size:.1f}TB"
+
+    @staticmethod
+    def _dir_size(path):
+        size = 0
+        for d, _, files in os.walk(path):
+            for f in files:
+                try:
+                    size += os.lstat(os.path.join(d, f)).st_size
+                except OSError:
+                    pass
+        return size
+
+    def _find_dirs(self, kind, parent_dir):
+        """Lists the folders in parent_dir that are named after a wid."""
+        resources = []
+        if not os.path.isdir(parent_dir):
+            return resources
+
+        for wid in os.listdir(parent_dir):
+            path = os.path.join(parent_dir, wid)
+            if not re.fullmatch(GarbageCollector._wid_re, wid):
+                continue
+            if not os.path.isdir(path):
+                continue
+            resources.append(
+                Resource(
+                    kind,
+                    path,
+                    wid,
+                    GarbageCollector._dir_size(path),
+                    os.stat(path).st_mtime,
+                    lambda p=path: shutil.rmtree(p),
+                )
+            )
+        return resources
+
+    def _find_clones(self):
+        """Repositories are cloned in <cache_dir>/<wid>."""
+        return self._find_dirs("clone", self._config.cache_dir)
+
+    def _find_singularity(self):
+        """SIF files are stored in <cache_dir>/singularity/images, which is
+        shared by all workspaces, and were stored in
+        <cache_dir>/singularity/<wid> by earlier versions of popper. Images
+        in the store are considered to be created the last time they were
+        used (their access time is updated by the SingularityRunner).
+        """
+        singularity_dir = os.path.join(self._config.cache_dir, "singularity")
+        resources = self._find_dirs("sif", singularity_dir)
+
+        images_dir = os.path.join(singularity_dir, "images")
+        if not os.path.isdir(images_dir):
+            return resources
+
+        for f in os.listdir(images_dir):
+            path = os.path.join(images_dir, f)
+            if f.startswith(".") or not f.endswith(".sif"):
+                continue
+            st = os.stat(path)
+            resources.append(
+                Resource(
+                    "sif",
+                    path,
+                    None,
+                    st.st_size,
+                    max(st.st_atime, st.st_mtime),
+                    lambda p=path: os.remove(p),
+                )
+            )
+        return resources
+
+    @staticmethod
+    def _wid_from_name(name):
+        """Returns the wid at the end of a name such as popper_<step>_<wid>."""
+        match = re.search(f"({GarbageCollector._wid_re})$", name)
+        return match.group(1) if match else None
+
+    def _find_docker(self):
+        """Lists the containers of steps and the images built by popper."""
+        # engine clients are imported when needed, so that importing this
+        # module (which 'popper run' does to record workspaces) stays cheap
+        import docker
+
+        try:
+            d = docker.from_env()
+            d.version()
+        except Exception as e:
+            log.debug(f"Docker error: {e}")
+            log.fail("Unable to connect to the docker daemon.")
+
+        resources = []
+        for c in d.api.containers(all=True, size=True, filters={"name": "popper_"}):
+            name = c["Names"][0].lstrip("/")
+            labels = c.get("Labels", None) or {}
+            wid = labels.get("popper.wid", None) or GarbageCollector._wid_from_name(
+                name
+            )
+            if not name.startswith("popper_") or not wid:
+                continue
+            resources.append(
+                Resource(
+                    "container",
+                    name,
+                    wid,
+                    c.get("SizeRw", None),
+                    c["Created"],
+                    lambda cid=c["Id"]: d.api.remove_container(cid, force=True),
+                )
+            )
+
+        for i in d.api.images(filters={"label": "popper.context-hash"}):
+            tags = i.get("RepoTags", None) or [i["Id"]]
+            resources.append(
+                Resource(
+                    "image",
+                    tags[0],
+                    None,
+                    i.get("Size", None),
+                    i["Created"],
+                    lambda iid=i["Id"]: d.api.remove_image(iid),
+                )
+            )
+
+        return resources
+
+    def _find_podman(self):
+        """Lists the containers of steps."""
+        # imported here since runner_host depends on this module (through
+        # popper.runner)
+        from popper.runner_host import HostRunner
+
+        cmd = ["podman", "ps", "--all", "--filter", "name=popper_", "--format", "json"]
+        _, ecode, output = HostRunner._exec_cmd(cmd, logging=False)
+        if ecode != 0:
+            log.fail(f"podman ps fail: {output}")
+
+        def remove(cid):
+            cmd = ["podman", "rm", "-f", cid]
+            _, ecode, output = HostRunner._exec_cmd(cmd, logging=False)
+            if ecode != 0:
+                raise Exception(output)
+
+        resources = []
+        for c in json.loads(output) if output.strip() else []:
+            names = c.get("Names", [])
+            name = names[0] if isinstance(names, list) else names
+            labels = c.get("Labels", None) or {}
+            wid = labels.get("popper.wid", None) or GarbageCollector._wid_from_name(
+                name
+            )
+            if not name.startswith("popper_") or not wid:
+                continue
+            created = c.get("Created", 0)
+            resources.append(
+                Resource(
+                    "container",
+                    name,
+                    wid,
+                    None,
+                    created if isinstance(created, (int, float)) else 0,
+                    lambda cid=c.get("Id", name): remove(cid),
+                )
+            )
+        return resources
+
+    def _find_kubernetes(self):
+        """Lists the pods, jobs and volume claims in the namespace of the
+        configuration, and the host path volumes created by popper."""
+        from kubernetes import config
+        from kubernetes.client import V1DeleteOptions
+        from kubernetes.client.api import batch_v1_api, core_v1_api
+
+        config.load_kube_config()
+        kclient = core_v1_api.CoreV1Api()
+        batch_client = batch_v1_api.BatchV1Api()
+        namespace = self._config.resman_opts.get("namespace", "default")
+        wid_re = GarbageCollector._wid_re
+
+        resources = []
+
+        def add(kind, obj, name_re, remove, size=None):
+            match = re.match(name_re, obj.metadata.name)
+            if not match:
+                return
+            resources.append(
+                Resource(
+                    kind,
+                    obj.metadata.name,
+                    match.group(1),
+                    size,
+                    obj.metadata.creation_timestamp.timestamp(),
+                    lambda: remove(obj.metadata.name),
+                )
+            )
+
+        for pod in kclient.list_namespaced_pod(namespace).items:
+            add(
+                "pod",
+                pod,
+                f"popper-(?:pod|init-pod|sync-pod-[0-9]+)-({wid_re})",
+                lambda n: kclient.delete_namespaced_pod(
+                    n, namespace=namespace, body=V1DeleteOptions()
+                ),
+            )
+
+        for job in batch_client.list_namespaced_job(namespace).items:
+            add(
+                "job",
+                job,
+                f"popper-pod-({wid_re})-",
+                lambda n: batch_client.delete_namespaced_job(
+                    n,
+                    namespace=namespace,
+                    body=V1DeleteOptions(propagation_policy="Background"),
+                ),
+            )
+
+        claims = kclient.list_namespaced_persistent_volume_claim(namespace)
+        for claim in claims.items:
+            add(
+                "volume claim",
+                claim,
+                f"popper-pod-({wid_re})-pvc$",
+                lambda n: kclient.delete_namespaced_persistent_volume_claim(
+                    n, namespace=namespace, body=V1DeleteOptions()
+                ),
+                claim.spec.resources.requests.get("storage", None),
+            )
+
+        for vol in kclient.list_persistent_volume().items:
+            add(
+                "volume",
+                vol,
+                f"pv-hostpath-popper-({wid_re})$",
+                lambda n: kclient.delete_persistent_volume(n, body=V1DeleteOptions()),
+                (vol.spec.capacity or {}).get("storage", None),
+            )
+
+        return resources
@@ -30,6 +30,10 @@ class WorkflowParser(object):
                             "secrets": {"type": "seq", "sequence": [{"type": "str"}]},
                             "dir": {"type": "str"},
                             "skip_pull": {"type": "bool"},
+                            "pull_policy": {"type": "str"},
+                            "needs": {"type": "seq", "sequence": [{"type": "str"}]},
+                            "inputs": {"type": "seq", "sequence": [{"type": "str"}]},
+                            "outputs": {"type": "seq", "sequence": [{"type": "str"}]},
                             "env": {
                                 "type": "map",
                                 "matching-rule": "any",
@@ -106,8 +110,10 @@ class WorkflowParser(object):
         logging.disable(logging.NOTSET)
 
         WorkflowParser.__add_missing_ids(_wf_data)
+        WorkflowParser.__validate_needs(_wf_data)
         WorkflowParser.__skip_steps(_wf_data, skipped_steps)
         WorkflowParser.__filter_step(_wf_data, step)
+        WorkflowParser.__prune_needs(_wf_data)
         WorkflowParser.__propagate_options_to_steps(_wf_data)
         WorkflowParser.__apply_substitutions(
             _wf_data, substitutions=substitutions, allow_loose=allow_loose
@@ -153,6 +159,54 @@ class WorkflowParser(object):
         for i, step in enumerate(wf_data["steps"]):
             step["id"] = step.get("id", f"{i+1}")
 
+    @staticmethod
+    def __validate_needs(wf_data):
+        """Checks that the steps referenced in 'needs' attributes exist and
+        that they do not introduce a cycle.
+        """
+        ids = [step["id"] for step in wf_data["steps"]]
+        for step in wf_data["steps"]:
+            for n in step.get("needs", []):
+                if n not in ids:
+                    log.fail(f"Step '{step['id']}' needs unknown step '{n}'.")
+
+        deps = WorkflowParser.get_dependencies(wf_data)
+        finished = set()
+        while len(finished) < len(ids):
+            ready = [i for i in ids if i not in finished and deps[i] <= finished]
+            if not ready:
+                cycle = [i for i in ids if i not in finished]
+                log.fail(f"Dependency cycle between steps {cycle}.")
+            finished.update(ready)
+
+    @staticmethod
+    def __prune_needs(wf_data):
+        """Removes references to steps that were skipped or filtered out."""
+        ids = [step["id"] for step in wf_data["steps"]]
+        for step in wf_data["steps"]:
+            if "needs" in step:
+                step["needs"] = [n for n in step["needs"] if n in ids]
+
+    @staticmethod
+    def get_dependencies(wf):
+        """Returns a dictionary mapping the ID of each step to the set of IDs
+        of the steps it depends on. A step that defines a ``needs`` attribute
+        depends only on the steps listed in it, while a step without it
+        depends on the step that precedes it, so that workflows that do not
+        make use of ``needs`` keep executing in the order they are defined.
+        """
+        deps = {}
+        previous = None
+        for step in wf["steps"]:
+            if "needs" in step:
+                deps[step["id"]] = set(step["needs"])
+            elif previous:
+                deps[step["id"]] = {previous}
+            else:
+                deps[step["id"]] = set()
+            previous = step["id"]
+        return deps
+
     @staticmethod
     def __propagate_options_to_steps(wf_data):
         """Copies env and secrets attributes from 'options' to each step. Step
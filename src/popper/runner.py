@@ -1,12 +1,20 @@
 import getpass
+import hashlib
 import importlib
 import os
 import sys
+import threading
+
+from box import Box
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import popper.scm as scm
 import popper.utils as pu
 
+from popper.cache import StepCache
 from popper.config import ConfigLoader
+from popper.gc import GarbageCollector
+from popper.parser import WorkflowParser
 from popper.cli import log
 
 
@@ -15,10 +23,12 @@ class WorkflowRunner(object):
 
     # class variable that holds references to runner singletons
     __runners = {}
+    __runners_lock = threading.Lock()
 
     def __init__(self, config):
         self._config = config
         self._is_resman_module_loaded = False
+        self._step_cache = StepCache(config)
 
     def _load_resman_module(self):
         """dynamically load resource manager module."""
@@ -85,23 +95,30 @@ class WorkflowRunner(object):
                         log.fail(f"Secret {s} not defined")
 
     def _clone_repos(self, wf):
-        """Clone steps that reference a repository.
+        """Clone steps that reference a repository. Repositories are cloned
+        concurrently, from bare mirrors stored in the cache directory that are
+        shared among all workspaces, or directly from their remote when only
+        the referenced version is fetched.
 
         Args:
           wf(popper.parser.workflow): Instance of the Workflow class.
           config.dry_run(bool): True if workflow flag is being dry-run.
           config.skip_clone(bool): True if clonning step has to be skipped.
+          config.shallow_clone(bool): True if only the referenced version
+            has to be fetched, without its history.
           config.wid(str): id of the workspace
 
         Returns:
             None
         """
         # cache directory for this workspace
-        wf_cache_dir = os.path.join(self._config.cache_dir, self._config.wid)
+        wf_cache_dir = self._config.clone_dir
         os.makedirs(wf_cache_dir, exist_ok=True)
 
-        cloned = set()
-        infoed = False
+        # mirrors are shared by all workspaces
+        mirrors_dir = os.path.join(self._config.cache_dir, "mirrors")
+
+        repos = {}
 
         for step in wf.steps:
             if (
@@ -125,60 +142,328 @@ class WorkflowRunner(object):
                     log.fail(f"Expecting folder '{repo_dir}' not found.")
                 continue
 
-            if not infoed:
-                log.info("[popper] Cloning step repositories")
-                infoed = True
-
-            if f"{user}/{repo}" in cloned:
+            if f"{user}/{repo}" in repos:
                 continue
 
-            log.info(f"[popper] - {url}/{user}/{repo}@{version}")
-            scm.clone(url, user, repo, repo_dir, version)
-            cloned.add(f"{user}/{repo}")
+            mirror_dir = os.path.join(mirrors_dir, service, user, f"{repo}.git")
+            repos[f"{user}/{repo}"] = (url, user, repo, repo_dir, version, mirror_dir)
+
+        if not repos:
+            return
+
+        log.info("[popper] Cloning step repositories")
+
+        with ThreadPoolExecutor() as executor:
+            futures = []
+            for url, user, repo, repo_dir, version, mirror_dir in repos.values():
+                log.info(f"[popper] - {url}/{user}/{repo}@{version}")
+                futures.append(
+                    executor.submit(
+                        scm.clone,
+                        url,
+                        user,
+                        repo,
+                        repo_dir,
+                        version,
+                        mirror_dir=mirror_dir,
+                        shallow=self._config.shallow_clone,
+                    )
+                )
+
+            for f in futures:
+                f.result()
 
     def run(self, wf):
         """Run the given workflow.
 
         Args:
           wf(Workflow): workflow to be executed
+          config.jobs(int): maximum number of steps executing concurrently
 
         Returns:
             None
         """
         self._process_secrets(wf)
+        self._record_workspace()
         self._clone_repos(wf)
+        self._prefetch(wf)
+        self._run_steps(wf)
 
+        log.info("Workflow finished successfully.")
+
+    def _record_workspace(self):
+        """Records the workspace as being in use, so that 'popper gc' doesn't
+        remove its resources (see popper.gc.GarbageCollector)."""
+        if not self._config.dry_run:
+            GarbageCollector.record_workspace(self._config)
+
+    def _prefetch(self, wf):
+        """Lets step runners start obtaining what the steps of a workflow need
+        (e.g. pulling images) before the steps are executed."""
+        steps = {}
         for step in wf.steps:
-            log.debug(f"Executing step:\n{pu.prettystr(step)}")
-            if step.uses == "sh":
-                e = self._step_runner("host", step).run(step)
-            else:
-                e = self._step_runner(self._config.engine_name, step).run(step)
+            steps.setdefault(self._engine_name(step), []).append(step)
+
+        for engine_name, engine_steps in steps.items():
+            self._step_runner(engine_name, engine_steps[0]).prefetch(engine_steps)
+
+    def _run_steps(self, wf):
+        """Runs the steps of a workflow, concurrently if config.jobs > 1."""
+        if self._config.jobs > 1:
+            self._run_concurrently(wf)
+        else:
+            self._run_sequentially(wf)
+
+    def _run_sequentially(self, wf):
+        """Runs one step at a time, following the order in which steps are
+        defined unless a dependency given in a 'needs' attribute requires a
+        step to run later.
+        """
+        deps = WorkflowParser.get_dependencies(wf)
+        finished = set()
+        pending = list(wf.steps)
 
-            if e != 0 and e != 78:
-                log.fail(f"Step '{step.id}' failed ('{e}') !")
+        while pending:
+            step = next(s for s in pending if deps[s.id] <= finished)
+            pending.remove(step)
 
-            log.info(f"Step '{step.id}' ran successfully !")
+            e = self._run_step(step)
 
-            if e == 78:
+            if WorkflowRunner._step_finished(step, e):
                 break
 
+            finished.add(step.id)
+
+    def _run_concurrently(self, wf):
+        """Runs steps as soon as the steps they depend on have finished, with
+        up to config.jobs steps executing at the same time.
+        """
+        deps = WorkflowParser.get_dependencies(wf)
+        finished = set()
+        pending = list(wf.steps)
+        running = {}
+        stop = False
+
+        with ThreadPoolExecutor(max_workers=self._config.jobs) as executor:
+            while running or (pending and not stop):
+                for step in [s for s in pending if deps[s.id] <= finished]:
+                    if stop or len(running) == self._config.jobs:
+                        break
+                    pending.remove(step)
+                    running[executor.submit(self._run_step, step)] = step
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    step = running.pop(future)
+
+                    try:
+                        # re-raises any error (including SystemExit) from the step
+                        e = future.result()
+
+                        if WorkflowRunner._step_finished(step, e):
+                            stop = True
+                    except BaseException:
+                        # the workflow fails as soon as a step does, like when
+                        # steps run sequentially, so the steps that are still
+                        # running are stopped instead of waited for
+                        self._stop_steps(running.values())
+                        raise
+
+                    finished.add(step.id)
+
+    def _stop_steps(self, steps):
+        """Stops the tasks of the runners that execute the given steps."""
+        runners = []
+        for step in steps:
+            runner = self._step_runner(self._engine_name(step), step)
+            if runner not in runners:
+                runners.append(runner)
+
+        for runner in runners:
+            runner.stop_running_tasks()
+
+    def run_matrix(self, wfs):
+        """Run the elements of a matrix, i.e. instances of a workflow that
+        differ in the values given to its substitutions. An element that
+        fails does not stop the others. Repositories are cloned once for all
+        the elements.
+
+        On the local machine (host resource manager), elements run as
+        independent workflows, up to config.jobs at the same time. Otherwise,
+        each step is executed for all the elements at once by the step runner
+        (see StepRunner.run_matrix()).
+
+        Args:
+          wfs(list): one workflow for each element of the matrix.
+
+        Returns:
+            None
+        """
+        for wf in wfs:
+            self._process_secrets(wf)
+        self._record_workspace()
+
+        # the steps of all the elements, so that each repository is cloned once
+        steps = Box({"steps": [s for wf in wfs for s in wf.steps]})
+        self._clone_repos(steps)
+        self._prefetch(steps)
+
+        if self._config.resman_name == "host":
+            status = self._run_matrix_locally(wfs)
+        else:
+            status = self._run_matrix_by_step(wfs)
+
+        log.info(f"{'Element':<10}Status")
+        for i, s in status.items():
+            log.info(f"{i:<10}{s if s else 'finished successfully'}")
+
+        failed = len([s for s in status.values() if s and s.startswith("failed")])
+        if failed:
+            log.fail(f"{failed} of {len(wfs)} matrix elements failed.")
+
         log.info("Workflow finished successfully.")
 
-    def _step_runner(self, engine_name, step):
-        """Factory of singleton runners."""
-        if not self._is_resman_module_loaded:
-            self._load_resman_module()
+    def _run_matrix_locally(self, wfs):
+        """Runs each element of a matrix as a workflow of its own, with a
+        distinct wid so that the names of the containers of distinct elements
+        don't clash. Elements share the workspace and the cloned repositories.
 
-        runner = WorkflowRunner.__runners.get(engine_name, None)
+        Returns:
+          dict: maps the index of each element to None if it finished
+            successfully, or to a description of its failure.
+        """
+        status = {}
+
+        def run_element(i, wf):
+            conf = self._config.to_dict()
+            conf.update({"wid": f"{self._config.wid}-{i}", "jobs": 1})
+            conf = Box(conf, default_box=True, frozen_box=True)
+            try:
+                # runners are shared through the class, so they get released
+                # when this runner exits
+                WorkflowRunner(conf)._run_steps(wf)
+            except SystemExit:
+                status[i] = "failed"
+
+        with ThreadPoolExecutor(max_workers=self._config.jobs) as executor:
+            futures = [executor.submit(run_element, i, wf) for i, wf in enumerate(wfs)]
+            for f in futures:
+                f.result()
+
+        return {i: status.get(i, None) for i in range(len(wfs))}
+
+    def _run_matrix_by_step(self, wfs):
+        """Executes each step of a matrix for all the elements at once, in
+        the step runner, following the dependencies among steps. The steps of
+        an element that failed or stopped are not executed further.
 
-        if not runner:
-            engine_cls_name = f"{engine_name.capitalize()}Runner"
-            engine_cls = getattr(self._resman_mod, engine_cls_name, None)
-            if not engine_cls:
-                raise ValueError(f"Cannot find class for {engine_name}")
-            runner = engine_cls(config=self._config)
-            WorkflowRunner.__runners[engine_name] = runner
+        Returns:
+          dict: maps the index of each element to None if it finished
+            successfully, or to a description of its failure.
+        """
+        deps = WorkflowParser.get_dependencies(wfs[0])
+        finished = set()
+        pending = list(wfs[0].steps)
+
+        # status of each element, None while it is still executing
+        status = {i: None for i in range(len(wfs))}
+
+        while pending:
+            active = [i for i in status if not status[i]]
+            if not active:
+                break
+
+            step = next(s for s in pending if deps[s.id] <= finished)
+            pending.remove(step)
+
+            steps = {
+                i: next(s for s in wfs[i].steps if s.id == step.id) for i in active
+            }
+            runner = self._step_runner(self._engine_name(step), step)
+            ecodes = runner.run_matrix(steps)
+
+            for i, e in ecodes.items():
+                if e == 78:
+                    status[i] = f"stopped at step '{step.id}'"
+                elif e != 0:
+                    status[i] = f"failed at step '{step.id}' ('{e}')"
+
+            finished.add(step.id)
+
+        # stopping is not a failure
+        return {
+            i: s if s and s.startswith("failed") else None for i, s in status.items()
+        }
+
+    def _engine_name(self, step):
+        """Returns the name of the engine that executes the given step."""
+        if step.uses == "sh":
+            return "host"
+        return self._config.engine_name
+
+    def _run_step(self, step):
+        """Executes a step in its runner and returns its exit code. Steps that
+        declare inputs or outputs are skipped if an entry for them exists in
+        the step cache, in which case their outputs are restored from it.
+        """
+        log.debug(f"Executing step:\n{pu.prettystr(step)}")
+        engine_name = self._engine_name(step)
+        runner = self._step_runner(engine_name, step)
+
+        if self._config.dry_run or not StepCache.is_cacheable(step):
+            return runner.run(step)
+
+        if not self._config.skip_cache:
+            key = self._step_cache.key(
+                step, engine_name, runner._get_image_digest(step)
+            )
+            if self._step_cache.restore(key, step):
+                log.info(f"[{step.id}] restored from step cache")
+                return 0
+
+        e = runner.run(step)
+
+        if e == 0:
+            # image and inputs might have changed while executing the step
+            key = self._step_cache.key(
+                step, engine_name, runner._get_image_digest(step)
+            )
+            self._step_cache.store(key, step)
+
+        return e
+
+    @staticmethod
+    def _step_finished(step, e):
+        """Checks the exit code of a step, failing if it is not 0 or 78.
+
+        Returns:
+          bool: True if the step asked to stop the workflow (exit code 78).
+        """
+        if e != 0 and e != 78:
+            log.fail(f"Step '{step.id}' failed ('{e}') !")
+
+        log.info(f"Step '{step.id}' ran successfully !")
+
+        return e == 78
+
+    def _step_runner(self, engine_name, step):
+        """Factory of singleton runners."""
+        with WorkflowRunner.__runners_lock:
+            if not self._is_resman_module_loaded:
+                self._load_resman_module()
+
+            # elements of a matrix have a distinct wid and runners of their own
+            key = (engine_name, self._config.wid)
+            runner = WorkflowRunner.__runners.get(key, None)
+
+            if not runner:
+                engine_cls_name = f"{engine_name.capitalize()}Runner"
+                engine_cls = getattr(self._resman_mod, engine_cls_name, None)
+                if not engine_cls:
+                    raise ValueError(f"Cannot find class for {engine_name}")
+                runner = engine_cls(config=self._config)
+                WorkflowRunner.__runners[key] = runner
 
         return runner
 
@@ -190,6 +475,13 @@ class WorkflowRunner(object):
 class StepRunner(object):
     """Base class for step runners, assumed to be singletons."""
 
+    # options in the engine configuration that are interpreted by the runner
+    # instead of being passed to the container engine
+    _popper_engine_opts = set()
+
+    # label of built images that holds the digest of their build context
+    _context_label = "popper.context-hash"
+
     def __init__(self, config=None):
         if not config:
             self._config = ConfigLoader.load()
@@ -202,6 +494,28 @@ class StepRunner(object):
     def __exit__(self, exc_type, exc, traceback):
         pass
 
+    def prefetch(self, steps):
+        """Starts obtaining the resources needed by the given steps (e.g.
+        images) in the background, before the steps are executed. Does
+        nothing by default.
+
+        Args:
+          steps(list): steps that this runner is going to execute.
+        """
+        pass
+
+    def run_matrix(self, steps):
+        """Executes a step for several elements of a matrix.
+
+        Args:
+          steps(dict): maps the index of each matrix element to the step, as
+            it is defined for that element.
+
+        Returns:
+          dict: maps the index of each element to the exit code of the step.
+        """
+        log.fail(f"Matrix executions are not supported by {type(self).__name__}.")
+
     def _prepare_environment(self, step, env={}):
         """Prepare environment variables for a step, which includes those in
         the 'env' and 'secrets' attributes.
@@ -232,6 +546,25 @@ class StepRunner(object):
             )
         return step_env
 
+    def _get_output_options(self, step):
+        """Obtains the keyword arguments for HostRunner._exec_cmd() that
+        control how the output of a step is logged, from the
+        'output_rate_limit' and 'output_spill' resource manager options.
+        """
+        rate_limit = self._config.resman_opts.get("output_rate_limit", None)
+        if not rate_limit:
+            return {}
+
+        spill_file = None
+        if self._config.resman_opts.get("output_spill", False):
+            spill_file = os.path.join(
+                self._config.cache_dir,
+                "logs",
+                f"{pu.sanitized_name(step.id, self._config.wid)}.log",
+            )
+
+        return {"rate_limit": rate_limit, "spill_file": spill_file}
+
     def _get_build_info(self, step):
 
         """Parses the `uses` attribute and returns build information needed.
@@ -259,13 +592,14 @@ class StepRunner(object):
         elif "./" in step.uses:
             img_full = f'{pu.sanitized_name(step.id, "step")}'
             img = img_full.lower()
-            tag = self._config.git_sha_short if self._config.git_sha_short else "na"
             build_ctx_path = os.path.join(self._config.workspace_dir, step.uses)
+            # tag with the contents of the context, so that images are rebuilt
+            # only when something in the context changes
+            tag = self._get_context_digest(build_ctx_path)[:12]
 
         else:
             _, service, user, repo, step_dir, version = scm.parse(step.uses)
-            wf_cache_dir = os.path.join(self._config.cache_dir, self._config.wid)
-            repo_dir = os.path.join(wf_cache_dir, service, user, repo)
+            repo_dir = os.path.join(self._config.clone_dir, service, user, repo)
             img_full = f"{user}/{repo}".lower()
             img = img_full
             tag = version
@@ -273,6 +607,40 @@ class StepRunner(object):
 
         return (build, img_full, img, tag, build_ctx_path)
 
+    def _get_context_digest(self, build_ctx_path):
+        """Returns the digest of the contents of a build context (see
+        popper.utils.build_context_digest). The digests of the files in each
+        context are indexed in <cache_dir>/contexts.
+        """
+        ctx_id = hashlib.sha256(os.path.realpath(build_ctx_path).encode("utf-8"))
+        index_file = os.path.join(
+            self._config.cache_dir, "contexts", f"{ctx_id.hexdigest()[:16]}.json"
+        )
+        return pu.build_context_digest(build_ctx_path, index_file)
+
+    def _get_pull_policy(self, step):
+        """Returns the pull policy of a step, given in its 'pull_policy'
+        attribute or in the 'pull_policy' engine option: 'always' (default),
+        'if-not-present' or 'if-older-than=<duration>'.
+        """
+        if "pull_policy" in step:
+            policy = step.pull_policy
+        else:
+            policy = self._config.engine_opts.get("pull_policy", "always")
+
+        if policy not in ["always", "if-not-present"] and not policy.startswith(
+            "if-older-than="
+        ):
+            log.fail(f"Invalid pull policy '{policy}' for step '{step.id}'.")
+
+        return policy
+
+    def _get_image_digest(self, step):
+        """Returns an identifier of the image that the step executes in, as
+        available locally, or None if the engine cannot obtain one.
+        """
+        return None
+
     def _update_with_engine_config(self, container_args):
         """Given container arguments, it extends it so it includes options
         obtained from the popper.config.Config.engine_opts property.
@@ -296,7 +664,7 @@ class StepRunner(object):
             container_args["environment"].update({k: v})
 
         for k, v in update_with.items():
-            if k not in container_args.keys():
+            if k not in container_args.keys() and k not in self._popper_engine_opts:
                 container_args[k] = update_with[k]
 
     def _get_container_kwargs(self, step, img, name):
@@ -311,6 +679,9 @@ class StepRunner(object):
             "detach": not self._config.pty,
             "tty": self._config.pty,
             "stdin_open": self._config.pty,
+            # labels identify the containers of a workspace, so that they can
+            # all be listed at once
+            "labels": {"popper.wid": self._config.wid, "popper.step": step.id},
         }
 
         self._update_with_engine_config(args)
@@ -1,11 +1,25 @@
+import codecs
+import contextlib
+import hashlib
+import http.client
+import io
+import json
 import os
+import queue
 import signal
+import socket
+import stat
+import struct
+import tempfile
 import threading
+import time
+import urllib.parse
 
 import docker
 import dockerpty
 
-from subprocess import Popen, STDOUT, PIPE, SubprocessError, CalledProcessError
+from concurrent.futures import Future, ThreadPoolExecutor
+from subprocess import Popen, STDOUT, PIPE, SubprocessError
 
 import spython
 from spython.main.parse.parsers import DockerParser
@@ -13,6 +27,7 @@ from spython.main.parse.writers import SingularityWriter
 
 from popper import utils as pu
 from popper.cli import log as log
+from popper.log import STEP_INFO
 from popper.runner import StepRunner as StepRunner
 from popper.utils import assert_executable_exists
 
@@ -49,7 +64,11 @@ class HostRunner(StepRunner):
         log.debug(f"Environment:\n{pu.prettystr(step_env)}")
 
         pid, ecode, _ = HostRunner._exec_cmd(
-            cmd, env=step_env, cwd=self._config.workspace_dir, pids=self._spawned_pids
+            cmd,
+            env=step_env,
+            cwd=self._config.workspace_dir,
+            pids=self._spawned_pids,
+            **self._get_output_options(step),
         )
         if pid != 0:
             self._spawned_pids.remove(pid)
@@ -57,34 +76,55 @@ class HostRunner(StepRunner):
         return ecode
 
     def stop_running_tasks(self):
-        for pid in self._spawned_pids:
+        # the set is copied, since steps that finish remove their pid from it
+        for pid in list(self._spawned_pids):
             log.info(f"Stopping proces {pid}")
-            os.kill(pid, signal.SIGKILL)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
 
     @staticmethod
-    def _exec_cmd(cmd, env=None, cwd=os.getcwd(), pids=set(), logging=True):
+    def _exec_cmd(
+        cmd,
+        env=None,
+        cwd=os.getcwd(),
+        pids=set(),
+        logging=True,
+        rate_limit=None,
+        spill_file=None,
+    ):
+        """Executes a command and logs (or captures) its output.
+
+        Args:
+          cmd(list): command to execute.
+          env(dict): environment for the command.
+          cwd(str): folder where the command executes.
+          pids(set): set where the PID of the process is added.
+          logging(bool): log output at STEP_INFO level. If False, the output
+            is captured and returned instead.
+          rate_limit(int): maximum number of lines logged per second.
+          spill_file(str): file where the lines exceeding the rate limit are
+            written instead of being discarded.
+
+        Returns:
+          (int, int, str): PID of the process, its exit code and its output
+            (empty if logging=True).
+        """
         pid = 0
         ecode = None
         try:
             with Popen(
-                cmd,
-                stdout=PIPE,
-                stderr=STDOUT,
-                universal_newlines=True,
-                preexec_fn=os.setsid,
-                env=env,
-                cwd=cwd,
+                cmd, stdout=PIPE, stderr=STDOUT, preexec_fn=os.setsid, env=env, cwd=cwd,
             ) as p:
                 pid = p.pid
                 pids.add(p.pid)
                 log.debug("Reading process output")
 
-                output = []
-                for line in iter(p.stdout.readline, ""):
-                    if logging:
-                        log.step_info(line.rstrip())
-                    else:
-                        output.append(line.rstrip())
+                pump = OutputPump(
+                    logging=logging, rate_limit=rate_limit, spill_file=spill_file
+                )
+                output = pump.drain(p.stdout)
 
                 p.wait()
                 ecode = p.poll()
@@ -104,14 +144,221 @@ class HostRunner(StepRunner):
         return pid, ecode, "\n".join(output)
 
 
+class OutputPump(object):
+    """Reads the output of a process in chunks of bytes and logs it in batches
+    of lines, one log record per batch, instead of one record per line. The
+    stream is read by a separate thread, so the process does not block on a
+    full pipe while its previous output is being logged; all the chunks read
+    in the meantime are then logged together. Optionally, it limits the
+    number of lines logged per second; the lines over the limit are discarded
+    or, if a spill file is given, written to it.
+    """
+
+    chunk_size = 64 * 1024
+
+    # maximum number of chunks read ahead of the ones being logged
+    max_pending = 64
+
+    def __init__(self, logging=True, rate_limit=None, spill_file=None):
+        self._logging = logging
+        self._rate_limit = rate_limit
+        self._spill_file = spill_file
+        self._spill = None
+        self._output = []
+        self._window_start = time.monotonic()
+        self._window_lines = 0
+        self._suppressed = 0
+        # decode UTF-8 and translate '\r\n' and '\r' to '\n', as it would be
+        # done by opening the stream in text mode
+        self._decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder("utf-8")(errors="replace"), translate=True
+        )
+        self._partial = ""
+
+    def drain(self, stream):
+        """Consumes the given binary stream until EOF.
+
+        Returns:
+          list: lines of output, if logging is disabled; empty otherwise.
+        """
+        chunks = queue.Queue(OutputPump.max_pending)
+        done = threading.Event()
+        reader = threading.Thread(
+            target=OutputPump._read, args=(stream, chunks, done), daemon=True
+        )
+        reader.start()
+
+        try:
+            end = False
+            while not end:
+                batch = [chunks.get()]
+                while isinstance(batch[-1], bytes) and not chunks.empty():
+                    batch.append(chunks.get_nowait())
+                if not isinstance(batch[-1], bytes):
+                    end = batch.pop()
+                    if isinstance(end, Exception):
+                        raise end
+                if batch:
+                    self.feed(b"".join(batch))
+            self._flush()
+        finally:
+            done.set()
+            self._finish()
+
+        return self._output
+
+    @staticmethod
+    def _read(stream, chunks, done):
+        """Puts the chunks read from a stream in a queue, until EOF or until
+        the done event is set. The last item is True on EOF or the exception
+        raised while reading.
+        """
+
+        def put(item):
+            while not done.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for chunk in iter(lambda: stream.read1(OutputPump.chunk_size), b""):
+                if not put(chunk):
+                    return
+            put(True)
+        except Exception as ex:
+            put(ex)
+
+    def feed(self, chunk):
+        """Logs the lines completed by a chunk of output. The last line is
+        kept until a later chunk completes it, or until close() is called.
+        """
+        lines = (self._partial + self._decoder.decode(chunk)).split("\n")
+        self._partial = lines.pop()
+        self._emit(lines)
+
+    def close(self):
+        """Logs what is left of the output given to feed().
+
+        Returns:
+          list: lines of output, if logging is disabled; empty otherwise.
+        """
+        try:
+            self._flush()
+        finally:
+            self._finish()
+
+        return self._output
+
+    def _flush(self):
+        lines = (self._partial + self._decoder.decode(b"", final=True)).split("\n")
+        self._partial = ""
+        if not lines[-1]:
+            lines.pop()
+        self._emit(lines)
+
+    def _finish(self):
+        if self._spill:
+            self._spill.close()
+        if self._suppressed:
+            log.warning(
+                f"{self._suppressed} lines of output exceeded the limit of "
+                f"{self._rate_limit} lines per second and were discarded."
+            )
+
+    def _emit(self, lines):
+        if not lines:
+            return
+
+        if not self._logging:
+            self._output.extend(line.rstrip() for line in lines)
+            return
+
+        if not log.isEnabledFor(STEP_INFO):
+            return
+
+        if self._rate_limit:
+            lines = self._limit(lines)
+
+        if lines:
+            log.step_info("\n".join(line.rstrip() for line in lines))
+
+    def _limit(self, lines):
+        """Returns the lines that can be logged in the current one-second
+        window, and spills or discards the rest.
+        """
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self._window_start = now
+            self._window_lines = 0
+
+        allowed = max(self._rate_limit - self._window_lines, 0)
+        self._window_lines += len(lines)
+
+        excess = lines[allowed:]
+        if not excess:
+            return lines
+
+        if self._spill_file:
+            if not self._spill:
+                dirname = os.path.dirname(self._spill_file)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                self._spill = open(self._spill_file, "w")
+                log.warning(
+                    f"Output exceeds {self._rate_limit} lines per second. "
+                    f"Writing excess lines to {self._spill_file}"
+                )
+            self._spill.write("\n".join(excess) + "\n")
+        else:
+            self._suppressed += len(excess)
+
+        return lines[:allowed]
+
+
 class DockerRunner(StepRunner):
     """Runs steps in docker on the local machine."""
 
+    # images that have been pulled or built by runners of this process (e.g.
+    # for distinct elements of a matrix), mapped to a future that completes
+    # once the image is available
+    _images = {}
+    _images_lock = threading.Lock()
+
+    # maximum number of images that are prefetched at the same time
+    _prefetch_jobs = 4
+
+    _popper_engine_opts = {"pull_policy", "buildkit", "buildkit_builder", "warm_pool"}
+
+    # serializes updates to the record of pulled images
+    _pulls_lock = threading.Lock()
+
+    # container arguments that can be given to each exec in a container of
+    # the warm pool, instead of being fixed when the container is created
+    _exec_args = {
+        "name",
+        "command",
+        "entrypoint",
+        "environment",
+        "working_dir",
+        "detach",
+        "tty",
+        "stdin_open",
+    }
+
     def __init__(self, init_docker_client=True, **kw):
         super(DockerRunner, self).__init__(**kw)
 
         self._spawned_containers = set()
         self._d = None
+        self._prefetch_executor = None
+        self._prefetches = []
+        self._pool = {}
+        self._pool_lock = threading.Lock()
+        self._containers = None
+        self._containers_lock = threading.Lock()
 
         if not init_docker_client:
             return
@@ -126,11 +373,30 @@ class DockerRunner(StepRunner):
         log.debug(f"Docker info: {pu.prettystr(self._d.info())}")
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self._prefetch_executor:
+            # images that are not being prepared yet are dropped; waits for
+            # the pulls and builds that are in progress
+            for task, future in self._prefetches:
+                if task.cancel():
+                    future.cancel()
+            self._prefetch_executor.shutdown(wait=True)
+        for c in self._pool.values():
+            if c:
+                log.debug(f"Removing container {c.name}")
+                self._remove_container(c)
         if self._d:
             self._d.close()
+        with DockerRunner._images_lock:
+            DockerRunner._images = {}
 
     def run(self, step):
         """Execute the given step in docker."""
+        if self._config.engine_opts.get("warm_pool", False):
+            if not self._config.reuse and not self._config.pty:
+                e = self._run_in_pool(step)
+                if e is not None:
+                    return e
+
         cid = pu.sanitized_name(step.id, self._config.wid)
 
         container = self._find_container(cid)
@@ -141,7 +407,7 @@ class DockerRunner(StepRunner):
             )
 
         if container and not self._config.reuse and not self._config.dry_run:
-            container.remove(force=True)
+            self._remove_container(container)
             container = None
 
         if not container and not self._config.reuse:
@@ -174,14 +440,287 @@ class DockerRunner(StepRunner):
             log.info(f"Stopping container {c.name}")
             c.stop()
 
+    def prefetch(self, steps):
+        """Pulls and builds the images of the given steps in the background,
+        concurrently. Each image is obtained once, and steps wait for their
+        image when they are about to be executed."""
+        if self._config.dry_run or self._config.reuse:
+            return
+
+        images = {}
+        for step in steps:
+            build, _, img, tag, build_ctx_path = self._get_build_info(step)
+            if build or (not self._config.skip_pull and not step.skip_pull):
+                images.setdefault(
+                    f"{img}:{tag}", (step, build, img, tag, build_ctx_path)
+                )
+
+        if not images:
+            return
+
+        if not self._prefetch_executor:
+            self._prefetch_executor = ThreadPoolExecutor(
+                max_workers=DockerRunner._prefetch_jobs
+            )
+
+        for args in images.values():
+            self._prepare_image_once(*args, executor=self._prefetch_executor)
+
+    def _run_in_pool(self, step):
+        """Executes a step in a container of the warm pool, which has the
+        image, volumes and options of the step, instead of creating a
+        container for it. The command of the step is executed with 'docker
+        exec', with the environment and working directory of the step.
+
+        Returns:
+          int: the exit code of the step, or None if no container of the
+            pool can execute the step.
+        """
+        build, _, img, tag, build_ctx_path = self._get_build_info(step)
+        self._obtain_image(step, build, img, tag, build_ctx_path)
+
+        container_args = self._get_docker_kwargs(step, f"{img}:{tag}", None)
+        container_args["labels"] = {"popper.wid": self._config.wid}
+        exec_args = {
+            k: container_args.pop(k)
+            for k in DockerRunner._exec_args
+            if k in container_args
+        }
+
+        if self._config.dry_run:
+            log.info(f"[{step.id}] docker exec image={img}:{tag}")
+            return 0
+
+        container = self._pool_container(step, container_args)
+        if not container:
+            return None
+
+        image = self._d.images.get(f"{img}:{tag}")
+        cmd = list(exec_args["entrypoint"] or image.attrs["Config"]["Entrypoint"] or [])
+        if exec_args["command"]:
+            cmd += exec_args["command"]
+        elif not exec_args["entrypoint"]:
+            cmd += image.attrs["Config"]["Cmd"] or []
+
+        log.info(f"[{step.id}] docker exec name={container.name} command={cmd}")
+
+        ecode = 1
+        try:
+            exec_id = self._d.api.exec_create(
+                container.id,
+                cmd,
+                environment=exec_args["environment"],
+                workdir=exec_args["working_dir"],
+            )["Id"]
+            # chunks are not aligned to lines, or even to characters
+            pump = OutputPump(**self._get_output_options(step))
+            try:
+                for chunk in self._d.api.exec_start(exec_id, stream=True):
+                    pump.feed(chunk)
+            finally:
+                pump.close()
+            ecode = self._d.api.exec_inspect(exec_id)["ExitCode"]
+        except Exception as exc:
+            log.fail(exc)
+        return ecode
+
+    def _pool_container(self, step, container_args):
+        """Returns the container of the warm pool that has the given
+        arguments, creating and starting it if it doesn't exist yet. Returns
+        None if the container does not keep running (e.g. if its image does
+        not include the 'tail' command).
+        """
+        key = json.dumps(container_args, sort_keys=True, default=str)
+
+        with self._pool_lock:
+            if key in self._pool:
+                return self._pool[key]
+
+            cid = pu.sanitized_name(
+                f"pool_{hashlib.sha256(key.encode()).hexdigest()[:8]}",
+                self._config.wid,
+            )
+            container = self._find_container(cid)
+            if container:
+                self._remove_container(container)
+
+            log.info(
+                f"[{step.id}] docker create name={cid}"
+                f' image={container_args["image"]} (warm pool)'
+            )
+            container = self._docker_create(
+                name=cid,
+                entrypoint=["tail", "-f", "/dev/null"],
+                detach=True,
+                **container_args,
+            )
+            container.start()
+            container.reload()
+
+            if container.status != "running":
+                log.warning(
+                    f"Image {container_args['image']} can't be used in the warm pool."
+                )
+                self._remove_container(container)
+                container = None
+            else:
+                self._spawned_containers.add(container)
+
+            self._pool[key] = container
+            return container
+
+    def _obtain_image(self, step, build, img, tag, build_ctx_path):
+        """Pulls or builds the image of a step, if needed."""
+        if self._config.dry_run:
+            self._prepare_image(step, build, img, tag, build_ctx_path)
+        elif build or (not self._config.skip_pull and not step.skip_pull):
+            self._prepare_image_once(step, build, img, tag, build_ctx_path)
+
+    def _get_docker_kwargs(self, step, img, name):
+        """Returns the arguments for creating the container of a step, which
+        gives it access to the docker daemon."""
+        container_args = self._get_container_kwargs(step, img, name)
+
+        if "volumes" not in container_args:
+            container_args["volumes"] = []
+        else:
+            container_args["volumes"] = list(container_args["volumes"])
+
+        container_args["volumes"].append("/var/run/docker.sock:/var/run/docker.sock")
+
+        return container_args
+
     def _create_container(self, cid, step):
         build, _, img, tag, build_ctx_path = self._get_build_info(step)
 
+        self._obtain_image(step, build, img, tag, build_ctx_path)
+
+        if self._config.dry_run:
+            return
+
+        container_args = self._get_docker_kwargs(step, f"{img}:{tag}", cid)
+
+        log.debug(f"Container args: {container_args}")
+
+        msg = f"[{step.id}] docker create name={cid}"
+        msg += f' image={container_args["image"]}'
+        if container_args["entrypoint"]:
+            msg += f' entrypoint={container_args["entrypoint"]}'
+        if container_args["command"]:
+            msg += f' command={container_args["command"]}'
+        log.info(msg)
+
+        container = self._docker_create(**container_args)
+
+        return container
+
+    def _docker_create(self, **container_args):
+        """Creates a container and adds it to the index of containers."""
+        try:
+            container = self._d.containers.create(**container_args)
+        except docker.errors.APIError as e:
+            if e.status_code != 409:
+                raise
+            # the name is taken by a container without labels (e.g. created by
+            # an older version of popper), so it is not in the index
+            cid = container_args["name"]
+            log.debug(f"Removing unlabeled container {cid}")
+            self._d.containers.get(cid).remove(force=True)
+            container = self._d.containers.create(**container_args)
+
+        with self._containers_lock:
+            if self._containers is not None:
+                self._containers[container.name] = container
+
+        return container
+
+    def _remove_container(self, container):
+        """Removes a container and deletes it from the index of containers."""
+        with self._containers_lock:
+            if self._containers is not None:
+                self._containers.pop(container.name, None)
+        try:
+            container.remove(force=True)
+        except docker.errors.NotFound:
+            pass
+
+    def _prepare_image_once(self, step, build, img, tag, build_ctx_path, executor=None):
+        """Pulls or builds an image, unless another step did so already (or
+        is doing it), in which case it waits for the image to be available.
+        If an executor is given, the image is prepared in the background by
+        it, and this method doesn't wait for it.
+        """
+        with DockerRunner._images_lock:
+            future = DockerRunner._images.get(f"{img}:{tag}", None)
+            if not future:
+                future = Future()
+                DockerRunner._images[f"{img}:{tag}"] = future
+                prepare = True
+            else:
+                prepare = False
+
+        if prepare and executor:
+            task = executor.submit(
+                self._prepare_image_future,
+                future,
+                step,
+                build,
+                img,
+                tag,
+                build_ctx_path,
+            )
+            self._prefetches.append((task, future))
+            return
+
+        if prepare:
+            self._prepare_image_future(future, step, build, img, tag, build_ctx_path)
+        elif executor:
+            return
+        elif not future.done():
+            log.info(f"[{step.id}] waiting for image {img}:{tag}")
+
+        # raises the error of a failed pull or build
+        future.result()
+
+    def _prepare_image_future(self, future, step, build, img, tag, build_ctx_path):
+        """Prepares an image and completes the future associated to it."""
+        try:
+            self._prepare_image(step, build, img, tag, build_ctx_path)
+        except BaseException as e:
+            # steps that wait for the image fail too; later ones try again,
+            # unless the record of images was reset in the meantime
+            with DockerRunner._images_lock:
+                if DockerRunner._images.get(f"{img}:{tag}", None) is future:
+                    del DockerRunner._images[f"{img}:{tag}"]
+            future.set_exception(e)
+            return
+        future.set_result(True)
+
+    def _prepare_image(self, step, build, img, tag, build_ctx_path):
+        """Pulls or builds the image of a step."""
         if build:
+            if not self._config.dry_run:
+                ctx_digest = self._get_context_digest(build_ctx_path)
+                if self._image_context_digest(img, tag) == ctx_digest:
+                    log.info(f"[{step.id}] docker image {img}:{tag} is up to date")
+                    return
+
+            if self._config.engine_opts.get("buildkit", False):
+                log.info(
+                    f"[{step.id}] docker buildx build {img}:{tag} {build_ctx_path}"
+                )
+                if not self._config.dry_run:
+                    self._buildx_build(img, tag, build_ctx_path, ctx_digest)
+                return
+
             log.info(f"[{step.id}] docker build {img}:{tag} {build_ctx_path}")
             if not self._config.dry_run:
                 streamer = self._d.api.build(
-                    decode=True, path=build_ctx_path, tag=f"{img}:{tag}", rm=True,
+                    decode=True,
+                    path=build_ctx_path,
+                    tag=f"{img}:{tag}",
+                    rm=True,
+                    labels={DockerRunner._context_label: ctx_digest},
                 )
                 for chunk in streamer:
                     if self._config.quiet:
@@ -192,6 +731,10 @@ class DockerRunner(StepRunner):
                             log.step_info(line.strip())
 
         elif not self._config.skip_pull and not step.skip_pull:
+            if not self._config.dry_run and not self._pull_needed(step, img, tag):
+                log.info(f"[{step.id}] docker image {img}:{tag} is up to date")
+                return
+
             log.info(f"[{step.id}] docker pull {img}:{tag}")
             if not self._config.dry_run:
                 streamer = self._d.api.pull(repository=f"{img}:{tag}", decode=True,)
@@ -201,64 +744,366 @@ class DockerRunner(StepRunner):
                         continue
                     chunk = chunk.strip()
                     if chunk:
-                        import json
-
                         chunk = json.loads(chunk)
                         if "id" in chunk:
                             log.step_info(chunk["id"] + ": " + chunk["status"])
                         else:
                             log.step_info(chunk["status"])
 
-        if self._config.dry_run:
-            return
+                self._record_pull(img, tag)
 
-        container_args = self._get_container_kwargs(step, f"{img}:{tag}", cid)
+    def _buildx_build(self, img, tag, build_ctx_path, ctx_digest):
+        """Builds an image with BuildKit, through 'docker buildx build'. The
+        layers of the image are exported to a local cache (a folder in
+        <cache_dir>/buildkit) and imported from it by later builds, so they
+        can be reused in hosts that don't keep docker's own build cache.
+        """
+        assert_executable_exists("docker")
 
-        if "volumes" not in container_args:
-            container_args["volumes"] = []
-        else:
-            container_args["volumes"] = list(container_args["volumes"])
+        cache_dir = os.path.join(
+            self._config.cache_dir, "buildkit", img.replace("/", "_")
+        )
+        cmd = ["docker", "buildx", "build"]
+
+        builder = self._config.engine_opts.get("buildkit_builder", None)
+        if builder:
+            cmd += ["--builder", builder]
+
+        # a cache that hasn't been exported yet can't be imported
+        if os.path.isfile(os.path.join(cache_dir, "index.json")):
+            cmd += ["--cache-from", f"type=local,src={cache_dir}"]
+
+        cmd += [
+            "--cache-to",
+            f"type=local,dest={cache_dir},mode=max",
+            "--load",
+            "--tag",
+            f"{img}:{tag}",
+            "--label",
+            f"{DockerRunner._context_label}={ctx_digest}",
+            build_ctx_path,
+        ]
+        log.debug(f"Command: {cmd}")
+
+        _, ecode, _ = HostRunner._exec_cmd(cmd, logging=not self._config.quiet)
+        if ecode != 0:
+            log.fail(f"Failed to build image {img}:{tag} with BuildKit.")
 
-        container_args["volumes"].append("/var/run/docker.sock:/var/run/docker.sock")
+    def _image_context_digest(self, img, tag):
+        """Returns the digest of the build context that a local image was
+        built from, or None if the image doesn't exist or wasn't built by
+        popper."""
+        try:
+            image = self._d.images.get(f"{img}:{tag}")
+        except docker.errors.ImageNotFound:
+            return None
+        labels = image.labels if image.labels else {}
+        return labels.get(DockerRunner._context_label, None)
 
-        log.debug(f"Container args: {container_args}")
+    def _pull_needed(self, step, img, tag):
+        """Decides whether an image has to be pulled, according to the pull
+        policy of the step (given in its 'pull_policy' attribute or in the
+        'pull_policy' engine option):
 
-        msg = f"[{step.id}] docker create name={cid}"
-        msg += f' image={container_args["image"]}'
-        if container_args["entrypoint"]:
-            msg += f' entrypoint={container_args["entrypoint"]}'
-        if container_args["command"]:
-            msg += f' command={container_args["command"]}'
-        log.info(msg)
+          * always: the image is always pulled (default).
+          * if-not-present: the image is pulled if it doesn't exist locally.
+          * if-older-than=<duration>: the image is pulled if it doesn't exist
+            locally, if it was pulled more than <duration> ago (e.g. 12h), or
+            if the local image is not the one that was last pulled.
+        """
+        policy = self._get_pull_policy(step)
 
-        container = self._d.containers.create(**container_args)
+        if policy == "always":
+            return True
 
-        return container
+        try:
+            image = self._d.images.get(f"{img}:{tag}")
+        except docker.errors.ImageNotFound:
+            return True
+
+        if policy == "if-not-present":
+            return False
+
+        max_age = pu.parse_duration(policy[len("if-older-than=") :])
+        record = self._read_pull_records().get(f"{img}:{tag}", None)
+
+        if not record or record["id"] != image.id:
+            return True
+
+        return time.time() - record["pulled"] > max_age
+
+    def _pull_records_file(self):
+        return os.path.join(self._config.cache_dir, "docker", "pulls.json")
+
+    def _read_pull_records(self):
+        """Returns the record of pulled images, which maps the reference of
+        each image to its id, digest and the time when it was pulled."""
+        if not os.path.isfile(self._pull_records_file()):
+            return {}
+        with open(self._pull_records_file(), "r") as f:
+            return json.load(f)
+
+    def _record_pull(self, img, tag):
+        """Adds an image that was just pulled to the record of pulled images.
+        """
+        image = self._d.images.get(f"{img}:{tag}")
+        with DockerRunner._pulls_lock:
+            records = self._read_pull_records()
+            records[f"{img}:{tag}"] = {
+                "id": image.id,
+                "digest": next(iter(image.attrs.get("RepoDigests", [])), None),
+                "pulled": time.time(),
+            }
+            os.makedirs(os.path.dirname(self._pull_records_file()), exist_ok=True)
+            tmp_file = f"{self._pull_records_file()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(records, f)
+            os.replace(tmp_file, self._pull_records_file())
+
+    def _get_image_digest(self, step):
+        _, _, img, tag, _ = self._get_build_info(step)
+        try:
+            return self._d.images.get(f"{img}:{tag}").id
+        except docker.errors.ImageNotFound:
+            return None
 
     def _find_container(self, cid):
-        """Check whether the container exists."""
-        containers = self._d.containers.list(all=True, filters={"name": cid})
+        """Returns the container with the given name, or None if it doesn't
+        exist. The containers of the workspace are listed once, by their
+        popper.wid label, and the runner keeps this index updated when it
+        creates or removes containers.
+        """
+        with self._containers_lock:
+            if self._containers is None:
+                containers = self._d.containers.list(
+                    all=True, filters={"label": f"popper.wid={self._config.wid}"}
+                )
+                self._containers = {c.name: c for c in containers}
+            container = self._containers.get(cid, None)
+
+        if not container and self._config.reuse:
+            # containers created by older versions of popper have no labels
+            try:
+                container = self._d.containers.get(cid)
+            except docker.errors.NotFound:
+                pass
+
+        return container
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket."""
+
+    def __init__(self, socket_path):
+        super(UnixHTTPConnection, self).__init__("localhost")
+        self._socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._socket_path)
+
+
+class LibpodError(Exception):
+    """Error returned by the libpod REST API."""
+
+    def __init__(self, status, message):
+        super(LibpodError, self).__init__(f"podman API error {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class LibpodClient(object):
+    """Client of the libpod REST API, served by the podman service (see
+    'podman system service') on a unix socket. Requests are sent over a
+    persistent connection, except for those whose responses are streamed
+    (e.g. logs), which use a connection of their own.
+    """
+
+    api_version = "v3.0.0"
 
-        filtered_containers = [c for c in containers if c.name == cid]
+    def __init__(self, socket_path):
+        self._socket_path = socket_path
+        self._conn = None
+        self._lock = threading.Lock()
 
-        if len(filtered_containers):
-            return filtered_containers[0]
+    @staticmethod
+    def find_socket():
+        """Returns the path to the socket of the podman service, as given by
+        the CONTAINER_HOST variable or in its default locations, or None if
+        there is no such socket."""
+        candidates = []
+        host = os.environ.get("CONTAINER_HOST", "")
+        if host.startswith("unix://"):
+            candidates.append(host[len("unix://") :])
+        if os.environ.get("XDG_RUNTIME_DIR", None):
+            candidates.append(
+                os.path.join(os.environ["XDG_RUNTIME_DIR"], "podman", "podman.sock")
+            )
+        candidates.append("/run/podman/podman.sock")
 
+        for path in candidates:
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                return path
         return None
 
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def request(self, method, path, params=None, body=None):
+        """Sends a request and returns the decoded JSON response (or None if
+        the response is empty). Raises LibpodError if the request fails."""
+        url, body, headers = self._prepare(path, params, body)
+
+        with self._lock:
+            # a persistent connection might have been closed by the service
+            for retry in [True, False]:
+                if not self._conn:
+                    self._conn = UnixHTTPConnection(self._socket_path)
+                try:
+                    self._conn.request(method, url, body=body, headers=headers)
+                    response = self._conn.getresponse()
+                    data = response.read()
+                    break
+                except (http.client.HTTPException, ConnectionError):
+                    self._conn.close()
+                    self._conn = None
+                    if not retry:
+                        raise
+
+        if response.status >= 400:
+            raise LibpodError(response.status, LibpodClient._error_message(data))
+
+        return json.loads(data) if data else None
+
+    @contextlib.contextmanager
+    def stream(self, method, path, params=None, body=None):
+        """Sends a request and yields its response, to be read as it arrives.
+        Raises LibpodError if the request fails."""
+        url, body, headers = self._prepare(path, params, body)
+        conn = UnixHTTPConnection(self._socket_path)
+        try:
+            conn.request(method, url, body=body, headers=headers)
+            response = conn.getresponse()
+            if response.status >= 400:
+                message = LibpodClient._error_message(response.read())
+                raise LibpodError(response.status, message)
+            yield response
+        finally:
+            conn.close()
+
+    def _prepare(self, path, params, body):
+        url = f"/{LibpodClient.api_version}/libpod{path}"
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+
+        headers = {}
+        if isinstance(body, dict):
+            body = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        elif body is not None:
+            # a file, such as the archive of a build context
+            headers["Content-Type"] = "application/x-tar"
+            headers["Content-Length"] = str(os.fstat(body.fileno()).st_size)
+
+        return url, body, headers
+
+    @staticmethod
+    def _error_message(data):
+        try:
+            return json.loads(data)["message"]
+        except (ValueError, KeyError, TypeError):
+            return data.decode("utf-8", errors="replace")
+
+    @staticmethod
+    def read_json_stream(response):
+        """Yields the JSON objects of a response that consists of one object
+        per line (e.g. the progress of a build or a pull)."""
+        for line in iter(response.readline, b""):
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class LogFrameReader(object):
+    """Reads the payload of the frames in which the logs of a container are
+    multiplexed by the API. Each frame has an 8 byte header: the stream it
+    belongs to (stdout or stderr), three zero bytes and the size of the
+    payload (4 bytes, big endian). Frames of both streams are read in the
+    order they arrive.
+    """
+
+    def __init__(self, response):
+        self._response = response
+
+    def read1(self, size=-1):
+        """Returns the payload of the next frame, or b'' at the end."""
+        header = self._response.read(8)
+        if len(header) < 8:
+            return b""
+        (length,) = struct.unpack(">I", header[4:])
+        return self._response.read(length)
+
 
 class PodmanRunner(StepRunner):
 
-    """Runs steps in podman on the local machine."""
+    """Runs steps in podman on the local machine. The podman service is used
+    through its REST API when its socket is found (or given in the
+    'api_socket' engine option); otherwise, the podman command is used.
+    """
+
+    _popper_engine_opts = {"api_socket", "layers", "cache_from", "build_jobs"}
+
+    # container options that are given to the API when creating containers;
+    # containers with other options are created with the podman command, so
+    # that steps behave the same whether the API is available or not
+    _api_container_opts = {
+        "image",
+        "command",
+        "name",
+        "volumes",
+        "working_dir",
+        "environment",
+        "entrypoint",
+        "detach",
+        "tty",
+        "stdin_open",
+        "labels",
+        "hostname",
+        "privileged",
+    }
 
     def __init__(self, init_podman_client=True, **kw):
         super(PodmanRunner, self).__init__(**kw)
 
         self._spawned_containers = set()
+        self._containers = None
+        self._containers_lock = threading.Lock()
+        self._api = None
 
         if not init_podman_client:
             return
 
+        socket_path = self._config.engine_opts.get("api_socket", None)
+        if socket_path is None:
+            socket_path = LibpodClient.find_socket()
+
+        if socket_path:
+            try:
+                self._api = LibpodClient(socket_path)
+                self._p_info = self._api.request("GET", "/info")
+                self._p_version = self._api.request("GET", "/version")
+            except Exception as e:
+                log.debug(f"Podman API error: {e}")
+                log.debug("Unable to use the podman service, using podman command")
+                self._api = None
+
+        if self._api:
+            log.debug(f"Podman info: {pu.prettystr(self._p_info)}")
+            return
+
         podman_executables = ["podman"]
         for exe in podman_executables:
             assert_executable_exists(exe)
@@ -272,6 +1117,10 @@ class PodmanRunner(StepRunner):
 
         log.debug(f"Podman info: {pu.prettystr(self._p_info)}")
 
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self._api:
+            self._api.close()
+
     def run(self, step):
         """Executes the given step in podman."""
         cid = pu.sanitized_name(step.id, self._config.wid)
@@ -283,8 +1132,7 @@ class PodmanRunner(StepRunner):
             )
 
         if container and not self._config.reuse and not self._config.dry_run:
-            cmd = ["podman", "rm", "-f", container]
-            HostRunner._exec_cmd(cmd, logging=False)
+            self._remove_container(cid)
             container = None
 
         if not container and not self._config.reuse:
@@ -297,8 +1145,11 @@ class PodmanRunner(StepRunner):
 
         self._spawned_containers.add(container)
 
+        if self._api and not self._config.pty:
+            return self._api_start(container, step)
+
         cmd = ["podman", "start", "-a", container]
-        _, e, _ = HostRunner._exec_cmd(cmd)
+        _, e, _ = HostRunner._exec_cmd(cmd, **self._get_output_options(step))
 
         return e
 
@@ -306,22 +1157,102 @@ class PodmanRunner(StepRunner):
         """Stop containers started by Popper."""
         for c in self._spawned_containers:
             log.info(f"Stopping container {c}")
+            if self._api:
+                try:
+                    self._api.request("POST", f"/containers/{c}/stop")
+                except Exception as e:
+                    log.warning(f"Failed to stop the {c} container: {e}")
+                continue
             _, ecode, _ = HostRunner._exec_cmd(["podman", "stop", c], logging=False)
             if ecode != 0:
                 log.warning(f"Failed to stop the {c} container")
 
+    def _api_start(self, container, step):
+        """Starts a container through the API, logs its output while it runs
+        and returns its exit code."""
+        try:
+            self._api.request("POST", f"/containers/{container}/start")
+            params = {"follow": "true", "stdout": "true", "stderr": "true"}
+            with self._api.stream("GET", f"/containers/{container}/logs", params) as r:
+                OutputPump(**self._get_output_options(step)).drain(LogFrameReader(r))
+            return self._api.request("POST", f"/containers/{container}/wait")
+        except Exception as e:
+            log.fail(e)
+
     def _find_container(self, cid):
-        """Checks whether the container exists."""
-        cmd = ["podman", "inspect", "-f", "{{.Id}}", cid]
-        _, ecode, containers = HostRunner._exec_cmd(cmd, logging=False)
+        """Returns the ID of the container with the given name, or None if it
+        doesn't exist. The containers of the workspace are listed once, by
+        their popper.wid label, and the runner keeps this index updated when
+        it creates or removes containers.
+        """
+        with self._containers_lock:
+            if self._containers is None:
+                self._containers = self._list_containers()
+            container = self._containers.get(cid, None)
 
-        if ecode == 125:
-            return None
+        if not container and self._config.reuse:
+            # containers created by older versions of popper have no labels
+            if self._api:
+                try:
+                    container = self._api.request("GET", f"/containers/{cid}/json")
+                    container = container["Id"]
+                except LibpodError:
+                    pass
+            else:
+                cmd = ["podman", "inspect", "-f", "{{.Id}}", cid]
+                _, ecode, output = HostRunner._exec_cmd(cmd, logging=False)
+                if ecode == 0:
+                    container = output.strip()
+
+        return container
+
+    def _list_containers(self):
+        """Returns a dict that maps the names of the containers of the
+        workspace to their IDs."""
+        label = f"popper.wid={self._config.wid}"
+
+        if self._api:
+            params = {"all": "true", "filters": json.dumps({"label": [label]})}
+            containers = self._api.request("GET", "/containers/json", params)
+            return {c["Names"][0]: c["Id"] for c in containers or []}
+
+        cmd = [
+            "podman",
+            "ps",
+            "--all",
+            "--no-trunc",
+            "--filter",
+            f"label={label}",
+            "--format",
+            "{{.ID}} {{.Names}}",
+        ]
+        _, ecode, output = HostRunner._exec_cmd(cmd, logging=False)
 
         if ecode != 0:
-            log.fail(f"podman inspect fail: {containers}")
+            log.fail(f"podman ps fail: {output}")
+
+        containers = {}
+        for line in output.splitlines():
+            if line.strip():
+                container_id, name = line.split()
+                containers[name] = container_id
+        return containers
+
+    def _remove_container(self, cid):
+        """Removes a container and deletes it from the index of containers."""
+        with self._containers_lock:
+            if self._containers is not None:
+                self._containers.pop(cid, None)
+
+        if not self._api:
+            HostRunner._exec_cmd(["podman", "rm", "-f", cid], logging=False)
+            return
 
-        return containers.strip()
+        try:
+            self._api.request("DELETE", f"/containers/{cid}", {"force": "true"})
+        except LibpodError as e:
+            if e.status != 404:
+                raise
 
     def _create_container(self, cid, step):
         build, _, img, tag, build_ctx_path = self._get_build_info(step)
@@ -329,21 +1260,11 @@ class PodmanRunner(StepRunner):
         if build:
             log.info(f"[{step.id}] podman build {img}:{tag} {build_ctx_path}")
             if not self._config.dry_run:
-                cmd = [
-                    "podman",
-                    "build",
-                    "--tag",
-                    f"{img}:{tag}",
-                    "--rm",
-                    "--file",
-                    build_ctx_path,
-                ]
-                HostRunner._exec_cmd(cmd)
+                self._build_image(step, img, tag, build_ctx_path)
         elif not self._config.skip_pull and not step.skip_pull:
             log.info(f"[{step.id}] podman pull {img}:{tag}")
             if not self._config.dry_run:
-                cmd = ["podman", "pull", f"{img}:{tag}"]
-                HostRunner._exec_cmd(cmd, logging=False)
+                self._pull_image(img, tag)
 
         if self._config.dry_run:
             return
@@ -357,16 +1278,183 @@ class PodmanRunner(StepRunner):
         msg.append(f"command={container_args.get('command')}" or "")
         log.info(msg)
 
+        options = {k for k, v in container_args.items() if v}
+        if self._api and options <= PodmanRunner._api_container_opts:
+            container = self._api_create(cid, container_args)
+        else:
+            if self._api:
+                unsupported = sorted(options - PodmanRunner._api_container_opts)
+                log.debug(f"Creating {cid} with podman create due to {unsupported}")
+            container = self._cmd_create(cid, container_args)
+
+        if container:
+            with self._containers_lock:
+                if self._containers is not None:
+                    self._containers[cid] = container
+
+        return container
+
+    def _build_image(self, step, img, tag, build_ctx_path):
+        """Builds the image of a step, unless an image built from the same
+        contents exists. The 'layers', 'cache_from' and 'build_jobs' engine
+        options are passed to the build.
+        """
+        ctx_digest = self._get_context_digest(build_ctx_path)
+        if self._image_context_digest(img, tag) == ctx_digest:
+            log.info(f"[{step.id}] podman image {img}:{tag} is up to date")
+            return
+
+        labels = {PodmanRunner._context_label: ctx_digest}
+        layers = self._config.engine_opts.get("layers", None)
+        cache_from = self._config.engine_opts.get("cache_from", [])
+        if isinstance(cache_from, str):
+            cache_from = [cache_from]
+        build_jobs = self._config.engine_opts.get("build_jobs", None)
+
+        if not self._api:
+            cmd = ["podman", "build", "--tag", f"{img}:{tag}", "--rm"]
+            cmd += ["--file", os.path.join(build_ctx_path, "Dockerfile")]
+            for k, v in labels.items():
+                cmd += ["--label", f"{k}={v}"]
+            if layers is not None:
+                cmd.append(f"--layers={str(layers).lower()}")
+            for c in cache_from:
+                cmd += ["--cache-from", c]
+            if build_jobs:
+                cmd += ["--jobs", str(build_jobs)]
+            cmd.append(build_ctx_path)
+
+            _, ecode, _ = HostRunner._exec_cmd(cmd, logging=not self._config.quiet)
+            if ecode != 0:
+                log.fail(f"Failed to build image {img}:{tag}.")
+            return
+
+        exclude = pu.read_dockerignore(build_ctx_path)
+        params = {
+            "t": f"{img}:{tag}",
+            "rm": "true",
+            "dockerfile": "Dockerfile",
+            "labels": json.dumps(labels),
+        }
+        if layers is not None:
+            params["layers"] = str(layers).lower()
+        if cache_from:
+            params["cachefrom"] = json.dumps(cache_from)
+        if build_jobs:
+            params["jobs"] = build_jobs
+        with docker.utils.tar(build_ctx_path, exclude=exclude) as context:
+            with self._api.stream("POST", "/build", params, context) as r:
+                for chunk in LibpodClient.read_json_stream(r):
+                    if "error" in chunk:
+                        log.fail(f"Failed to build image {img}:{tag}: {chunk['error']}")
+                    if "stream" in chunk and not self._config.quiet:
+                        for line in chunk["stream"].splitlines():
+                            if line.strip():
+                                log.step_info(line.strip())
+
+    def _get_image_digest(self, step):
+        _, _, img, tag, _ = self._get_build_info(step)
+        if self._api:
+            try:
+                return self._api.request("GET", f"/images/{img}:{tag}/json")["Id"]
+            except LibpodError:
+                return None
+
+        cmd = ["podman", "image", "inspect", "--format", "{{.Id}}", f"{img}:{tag}"]
+        _, ecode, output = HostRunner._exec_cmd(cmd, logging=False)
+        return output.strip() if ecode == 0 else None
+
+    def _image_context_digest(self, img, tag):
+        """Returns the digest of the build context that a local image was
+        built from, or None if the image doesn't exist or wasn't built by
+        popper."""
+        if self._api:
+            try:
+                image = self._api.request("GET", f"/images/{img}:{tag}/json")
+            except LibpodError:
+                return None
+            labels = image.get("Labels", None) or {}
+        else:
+            cmd = ["podman", "image", "inspect", "--format", "{{json .Labels}}"]
+            _, ecode, output = HostRunner._exec_cmd(
+                cmd + [f"{img}:{tag}"], logging=False
+            )
+            if ecode != 0:
+                return None
+            labels = json.loads(output) or {}
+        return labels.get(PodmanRunner._context_label, None)
+
+    def _pull_image(self, img, tag):
+        if not self._api:
+            cmd = ["podman", "pull", f"{img}:{tag}"]
+            HostRunner._exec_cmd(cmd, logging=False)
+            return
+
+        params = {"reference": f"{img}:{tag}"}
+        with self._api.stream("POST", "/images/pull", params) as r:
+            for chunk in LibpodClient.read_json_stream(r):
+                if chunk.get("error", None):
+                    log.fail(f"Failed to pull image {img}:{tag}: {chunk['error']}")
+                if "stream" in chunk:
+                    log.debug(chunk["stream"].strip())
+
+    def _api_create(self, cid, container_args):
+        """Creates a container through the API and returns its ID."""
+        spec = {
+            "name": cid,
+            "image": container_args["image"],
+            "command": list(container_args["command"]),
+            "env": container_args.get("environment", {}),
+            "work_dir": container_args["working_dir"],
+            "labels": container_args.get("labels", {}),
+            "terminal": bool(container_args.get("tty", False)),
+            "mounts": [],
+        }
+        for v in container_args.get("volumes", []):
+            source, destination, *options = v.split(":")
+            spec["mounts"].append(
+                {
+                    "type": "bind",
+                    "source": source,
+                    "destination": destination,
+                    "options": options[0].split(",") if options else [],
+                }
+            )
+        if container_args.get("entrypoint", None):
+            spec["entrypoint"] = list(container_args["entrypoint"])
+        if container_args.get("hostname", None):
+            spec["hostname"] = container_args["hostname"]
+        if container_args.get("privileged", False):
+            spec["privileged"] = True
+
+        try:
+            return self._api.request("POST", "/containers/create", body=spec)["Id"]
+        except LibpodError as e:
+            if e.status != 409 and "already in use" not in e.message:
+                log.fail(f"Failed to create container {cid}: {e.message}")
+
+        # the name is taken by a container without labels (e.g. created by an
+        # older version of popper), so it is not in the index
+        log.debug(f"Removing unlabeled container {cid}")
+        self._remove_container(cid)
+        return self._api.request("POST", "/containers/create", body=spec)["Id"]
+
+    def _cmd_create(self, cid, container_args):
+        """Creates a container with the podman command and returns its ID."""
         cmd = ["podman", "create"]
 
         cmd.extend(["--name", container_args.get("name") or ""])
-        cmd.extend(["-v", container_args.get("volumes")[0] or ""])
+        for v in container_args.get("volumes"):
+            cmd.extend(["-v", v or ""])
 
         env = container_args.get("environment")
         if env:
             for i, j in env.items():
                 cmd.extend(["-e", f"{i}={j}"])
 
+        for k, v in container_args.get("labels", {}).items():
+            cmd.extend(["--label", f"{k}={v}"])
+
         cmd.extend(["-d" if container_args.get("detach") else ""])
 
         cmd.extend(["-w", container_args.get("working_dir")])
@@ -379,6 +1467,9 @@ class PodmanRunner(StepRunner):
         if domain_name:
             cmd.extend(["--domainname", domain_name])
 
+        if container_args.get("privileged", False):
+            cmd.append("--privileged")
+
         tty = container_args.get("tty", None)
         if tty:
             cmd.extend(["-t", tty])
@@ -399,6 +1490,13 @@ class PodmanRunner(StepRunner):
 
         _, ecode, container = HostRunner._exec_cmd(cmd, logging=False)
 
+        if ecode != 0 and "already in use" in container:
+            # the name is taken by a container without labels (e.g. created by
+            # an older version of popper), so it is not in the index
+            log.debug(f"Removing unlabeled container {cid}")
+            self._remove_container(cid)
+            _, ecode, container = HostRunner._exec_cmd(cmd, logging=False)
+
         if ecode != 0:
             return None
 
@@ -409,17 +1507,49 @@ class PodmanRunner(StepRunner):
         return container[-1]
 
 
+class ContextDockerParser(DockerParser):
+    """Parses a Dockerfile into a singularity recipe where the sources of
+    ADD and COPY instructions are absolute paths in the build context (the
+    folder of the Dockerfile), so that the recipe can be built from any
+    directory."""
+
+    def __init__(self, dockerfile):
+        self._build_ctx_path = os.path.dirname(os.path.abspath(dockerfile))
+        super(ContextDockerParser, self).__init__(dockerfile)
+
+    def _add_files(self, source, dest):
+        source = os.path.join(self._build_ctx_path, source.strip('"'))
+        super(ContextDockerParser, self)._add_files(source, dest.strip('"'))
+
+
 class SingularityRunner(StepRunner):
-    """Runs steps in singularity on the local machine."""
+    """Runs steps in singularity on the local machine.
+
+    SIF images are kept in a store that is shared by all workspaces
+    (<cache_dir>/singularity/images), named after a hash of what they are
+    made from (see _get_image_info()), so that an image is only built again
+    when its build context changes.
+    """
 
-    lock = threading.Lock()
+    _popper_engine_opts = {"pull_policy", "instances"}
+
+    # one lock for each image in the store, so that steps that use the same
+    # image wait for it to be built (or pulled) once, while distinct images
+    # are obtained concurrently
+    _image_locks = {}
+    _image_locks_lock = threading.Lock()
 
     def __init__(self, init_spython_client=True, **kw):
         super(SingularityRunner, self).__init__(**kw)
 
         self._spawned_containers = set()
+        self._spawned_pids = set()
         self._s = None
 
+        # instances started for each image (see _instance_start())
+        self._instances = {}
+        self._instances_lock = threading.Lock()
+
         if SingularityRunner._in_docker():
             log.fail(
                 (
@@ -446,25 +1576,21 @@ class SingularityRunner(StepRunner):
         self._s = spython.main.Client
         self._s.quiet = True
 
+    def __exit__(self, exc_type, exc, traceback):
+        self._stop_instances()
+
     def run(self, step):
         self._setup_singularity_cache()
         cid = pu.sanitized_name(step.id, self._config.wid) + ".sif"
-        self._container = os.path.join(self._singularity_cache, cid)
-
-        exists = os.path.exists(self._container)
-        if exists and not self._config.dry_run and not self._config.skip_pull:
-            os.remove(self._container)
 
-        self._create_container(step, cid)
-        ecode = self._singularity_start(step, cid)
+        sif = self._create_container(step, cid)
+        ecode = self._singularity_start(step, cid, sif)
         return ecode
 
     @staticmethod
     def _convert(dockerfile, singularityfile):
-        parser = DockerParser(dockerfile)
+        parser = ContextDockerParser(dockerfile)
         for p in parser.recipe.files:
-            p[0] = p[0].strip('"')
-            p[1] = p[1].strip('"')
             if os.path.isdir(p[0]):
                 p[0] += "/."
 
@@ -475,17 +1601,26 @@ class SingularityRunner(StepRunner):
         return singularityfile
 
     @staticmethod
-    def _get_recipe_file(build_ctx_path, cid):
+    def _get_recipe_file(build_ctx_path, singularityfile):
+        """Converts the Dockerfile of a build context into a singularity
+        recipe, unless singularityfile (which is named after the digest of
+        the context) was already generated.
+        """
         dockerfile = os.path.join(build_ctx_path, "Dockerfile")
-        singularityfile = os.path.join(
-            build_ctx_path, "Singularity.{}".format(cid[:-4])
-        )
 
-        if os.path.isfile(dockerfile):
-            return SingularityRunner._convert(dockerfile, singularityfile)
-        else:
+        if not os.path.isfile(dockerfile):
             log.fail("No Dockerfile was found.")
 
+        if os.path.isfile(singularityfile):
+            return singularityfile
+
+        os.makedirs(os.path.dirname(singularityfile), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(singularityfile))
+        os.close(fd)
+        SingularityRunner._convert(dockerfile, tmp_file)
+        os.replace(tmp_file, singularityfile)
+        return singularityfile
+
     @staticmethod
     def _in_docker():
         """ Returns TRUE if we are being executed in a Docker container. """
@@ -493,27 +1628,113 @@ class SingularityRunner(StepRunner):
             with open("/proc/1/cgroup", "r") as f:
                 return "docker" in f.read() or "lxc" in f.read()
 
-    def _build_from_recipe(self, build_ctx_path, build_dest, cid):
-        SingularityRunner.lock.acquire()
-        pwd = os.getcwd()
-        os.chdir(build_ctx_path)
-        recipefile = SingularityRunner._get_recipe_file(build_ctx_path, cid)
+    def _build_from_recipe(self, recipefile, image):
+        """Builds an image from a recipe. Recipes only contain absolute
+        paths, so builds don't depend on the current directory and distinct
+        images can be built at the same time."""
         self._s.build(
             recipe=recipefile,
-            image=cid,
-            build_folder=build_dest,
+            image=os.path.basename(image),
+            build_folder=os.path.dirname(image),
             force=True,
             quiet=self._config.quiet,
         )
-        os.chdir(pwd)
-        SingularityRunner.lock.release()
 
     def _setup_singularity_cache(self):
         self._singularity_cache = os.path.join(
-            self._config.cache_dir, "singularity", self._config.wid
+            self._config.cache_dir, "singularity", "images"
         )
         os.makedirs(self._singularity_cache, exist_ok=True)
 
+    def _get_recipe_path(self, sif, build_ctx_path):
+        """Returns the path of the recipe that the given image is built from.
+        Recipes refer to the files in the build context by their absolute
+        path, so these are also named after the location of the context.
+        """
+        key = os.path.basename(sif)[: -len(".sif")]
+        key = f"{key}:{os.path.realpath(build_ctx_path)}"
+        return os.path.join(
+            self._config.cache_dir,
+            "singularity",
+            "recipes",
+            hashlib.sha256(key.encode("utf-8")).hexdigest()[:16],
+        )
+
+    @staticmethod
+    def _image_lock(sif):
+        with SingularityRunner._image_locks_lock:
+            return SingularityRunner._image_locks.setdefault(sif, threading.Lock())
+
+    def _get_image_info(self, step):
+        """Returns whether the image of a step is built, the image (or build
+        context) it is made from, and the path of its SIF file in the store.
+        The file is named after the digest of the build context when the
+        image is built from a Dockerfile, or after the URI of the image when
+        it is pulled.
+
+        Returns:
+          (bool, str, str, str): build, image, build_ctx_path, SIF file.
+        """
+        build, image, _, _, build_ctx_path = self._get_build_info(step)
+
+        if "shub://" in step.uses or "library://" in step.uses:
+            build = False
+            image = step.uses
+            build_ctx_path = None
+
+        if build:
+            key = self._get_context_digest(build_ctx_path)
+        else:
+            key = hashlib.sha256(image.encode("utf-8")).hexdigest()
+
+        sif = os.path.join(self._singularity_cache, f"{key[:16]}.sif")
+        return build, image, build_ctx_path, sif
+
+    def _get_image_digest(self, step):
+        """Identifies the SIF file of a step by its name, which is a digest of
+        the build context for built images, and by its modification time,
+        which changes when a pulled image is pulled again."""
+        self._setup_singularity_cache()
+        _, _, _, sif = self._get_image_info(step)
+        if not os.path.isfile(sif):
+            return None
+        st = os.stat(sif)
+        return f"{os.path.basename(sif)}:{st.st_size}:{st.st_mtime_ns}"
+
+    @staticmethod
+    def _get_tmp_image(sif, cid):
+        """Returns the file where an image is built or pulled before being
+        moved to its place in the store, so that other runs never see a
+        partially written image."""
+        return os.path.join(os.path.dirname(sif), f".{os.path.basename(sif)}.{cid}")
+
+    def _pull_needed(self, step, sif):
+        """Decides whether the image of a step has to be pulled, according
+        to its pull policy (see StepRunner._get_pull_policy()). The SIF file
+        of an image is written when it is pulled, so its modification time
+        tells how old it is.
+        """
+        if self._config.skip_pull or step.skip_pull:
+            return False
+
+        policy = self._get_pull_policy(step)
+
+        if policy == "always" or not os.path.isfile(sif):
+            return True
+
+        if policy == "if-not-present":
+            return False
+
+        max_age = pu.parse_duration(policy[len("if-older-than=") :])
+        return time.time() - os.stat(sif).st_mtime > max_age
+
+    @staticmethod
+    def _mark_used(sif):
+        """Updates the access time of an image in the store, which is what
+        'popper gc' looks at to find images that are no longer used."""
+        if os.path.isfile(sif):
+            os.utime(sif, (time.time(), os.stat(sif).st_mtime))
+
     def _get_container_options(self):
         container_args = {
             "userns": True,
@@ -537,57 +1758,148 @@ class SingularityRunner(StepRunner):
         return options
 
     def _create_container(self, step, cid):
-        build, image, _, _, build_ctx_path = self._get_build_info(step)
-
-        if "shub://" in step.uses or "library://" in step.uses:
-            build = False
-            image = step.uses
-            build_ctx_path = None
-
-        if build:
-            log.info(f"[{step.id}] singularity build {cid} {build_ctx_path}")
-            if not self._config.dry_run:
-                self._build_from_recipe(build_ctx_path, self._singularity_cache, cid)
-        elif not self._config.skip_pull and not step.skip_pull:
-            log.info(f"[{step.id}] singularity pull {cid} {image}")
-            if not self._config.dry_run:
-                self._s.pull(image=image, name=cid, pull_folder=self._singularity_cache)
-
-    def _singularity_start(self, step, cid):
-        env = self._prepare_environment(step)
-
-        # set the environment variables
-        for k, v in env.items():
-            os.environ[k] = str(v)
-
+        """Builds or pulls the image of a step, unless it is in the store
+        already, and returns the path of its SIF file."""
+        build, image, build_ctx_path, sif = self._get_image_info(step)
+        tmp_image = SingularityRunner._get_tmp_image(sif, cid)
+
+        with SingularityRunner._image_lock(sif):
+            if build and os.path.isfile(sif):
+                log.info(f"[{step.id}] singularity image {cid} is up to date")
+            elif build:
+                log.info(f"[{step.id}] singularity build {cid} {build_ctx_path}")
+                if not self._config.dry_run:
+                    recipefile = SingularityRunner._get_recipe_file(
+                        build_ctx_path, self._get_recipe_path(sif, build_ctx_path)
+                    )
+                    self._build_from_recipe(recipefile, tmp_image)
+            elif self._pull_needed(step, sif):
+                log.info(f"[{step.id}] singularity pull {cid} {image}")
+                if not self._config.dry_run:
+                    self._s.pull(
+                        image=image,
+                        name=os.path.basename(tmp_image),
+                        pull_folder=self._singularity_cache,
+                    )
+
+            if self._config.dry_run:
+                return sif
+
+            if os.path.isfile(tmp_image):
+                os.replace(tmp_image, sif)
+            elif not os.path.isfile(sif):
+                log.fail(f"[{step.id}] Could not obtain singularity image {image}")
+
+            SingularityRunner._mark_used(sif)
+
+        return sif
+
+    def _get_singularity_env(self, step):
+        """Returns the environment of the singularity commands of a step: the
+        environment of popper, plus the variables of the step prefixed with
+        SINGULARITYENV_, which singularity defines in the container. Each
+        command gets an environment of its own, instead of the variables of
+        the step being set in os.environ, so steps can run concurrently.
+        """
+        env = dict(os.environ)
+        for k, v in self._prepare_environment(step).items():
+            env[f"SINGULARITYENV_{k}"] = str(v)
+        return env
+
+    def _create_cmd(self, step, sif, options=None):
+        if step.runs:
+            commands = step.runs
+            cmd = ["singularity", "exec"]
+        else:
+            commands = step.args
+            cmd = ["singularity", "run"]
+
+        if options is None:
+            options = self._get_container_options()
+
+        cmd.extend(options)
+        cmd.extend([sif])
+        cmd.extend(commands)
+
+        return cmd
+
+    def _instance_start(self, step, sif):
+        """Starts an instance of an image, unless one was started already,
+        and returns its name. Instances are enabled by the 'instances' engine
+        option; steps then execute in the instance of their image, which
+        saves mounting the image and setting up namespaces for each step.
+        The options of the container are given when the instance starts.
+        """
+        with self._instances_lock:
+            if sif in self._instances:
+                return self._instances[sif]
+
+            name = f"popper_{os.path.basename(sif)[: -len('.sif')]}_{self._config.wid}"
+            log.info(f"[{step.id}] singularity instance start {name}")
+
+            cmd = ["singularity", "--quiet", "instance", "start"]
+            cmd.extend(self._get_container_options())
+            cmd.extend([sif, name])
+            _, ecode, output = HostRunner._exec_cmd(cmd, logging=False)
+            if ecode != 0:
+                log.fail(f"Failed to start singularity instance {name}: {output}")
+
+            self._instances[sif] = name
+            return name
+
+    def _stop_instances(self):
+        with self._instances_lock:
+            for name in self._instances.values():
+                log.info(f"Stopping singularity instance {name}")
+                cmd = ["singularity", "--quiet", "instance", "stop", name]
+                _, ecode, output = HostRunner._exec_cmd(cmd, logging=False)
+                if ecode != 0:
+                    log.warning(f"Failed to stop singularity instance {name}: {output}")
+            self._instances = {}
+
+    def _singularity_start(self, step, cid, sif):
         args = list(step.args)
         runs = list(step.runs)
-        ecode = None
+        instances = self._config.engine_opts.get("instances", False)
+
+        if instances and not self._config.dry_run:
+            target = f"instance://{self._instance_start(step, sif)}"
+        else:
+            target = cid
 
         if runs:
-            info = f"[{step.id}] singularity exec {cid} {runs}"
-            commands = runs
-            start_fn = self._s.execute
+            info = f"[{step.id}] singularity exec {target} {runs}"
         else:
-            info = f"[{step.id}] singularity run {cid} {args}"
-            commands = args
-            start_fn = self._s.run
+            info = f"[{step.id}] singularity run {target} {args}"
 
         log.info(info)
 
         if self._config.dry_run:
             return 0
 
-        options = self._get_container_options()
-        output = start_fn(self._container, commands, stream=True, options=options)
-        try:
-            for line in output:
-                log.step_info(line.strip("\n"))
-            ecode = 0
-        except CalledProcessError as ex:
-            ecode = ex.returncode
+        if instances:
+            cmd = self._create_cmd(step, target, ["--pwd", "/workspace"])
+        else:
+            cmd = self._create_cmd(step, sif)
+        # leave messages of singularity itself out of the output of the step
+        cmd.insert(1, "--quiet")
+
+        pid, ecode, _ = HostRunner._exec_cmd(
+            cmd,
+            env=self._get_singularity_env(step),
+            pids=self._spawned_pids,
+            **self._get_output_options(step),
+        )
+        if pid != 0:
+            self._spawned_pids.discard(pid)
 
         return ecode
 
     def stop_running_tasks(self):
-        pass
+        for pid in list(self._spawned_pids):
+            log.info(f"Stopping process {pid}")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self._stop_instances()
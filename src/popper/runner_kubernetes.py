@@ -1,12 +1,19 @@
+import datetime
+import io
+import json
 import os
-import base64
-import time
+import re
+import shlex
+import stat
 import tarfile
+import threading
+import time
 
-from kubernetes import config, client
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import config, client, watch
 from kubernetes.client import Configuration, V1DeleteOptions
 from kubernetes.client.rest import ApiException
-from kubernetes.client.api import core_v1_api
+from kubernetes.client.api import batch_v1_api, core_v1_api
 from kubernetes.stream import stream
 
 from popper import utils as pu
@@ -18,6 +25,20 @@ from popper.runner_host import DockerRunner as HostDockerRunner
 class KubernetesRunner(StepRunner):
     """Runs steps on a kubernetes cluster."""
 
+    # file that lists the paths that an incremental copy of the workspace
+    # deletes from the volume
+    _sync_deleted_file = ".popper_sync_deleted"
+
+    # label that identifies the persistent sync pod of a volume claim
+    _sync_pod_label = "popper-sync-pod"
+
+    # label with the completion index of the pods of an Indexed Job
+    _completion_index_label = "batch.kubernetes.io/job-completion-index"
+
+    # oldest version of kubernetes with Indexed Jobs and per-index backoff
+    # limits (and completion index labels) enabled by default
+    _indexed_job_version = (1, 29)
+
     def __init__(self, **kw):
         super(KubernetesRunner, self).__init__(**kw)
 
@@ -27,6 +48,7 @@ class KubernetesRunner(StepRunner):
         c.assert_hostname = False
         Configuration.set_default(c)
         self._kclient = core_v1_api.CoreV1Api()
+        self._batch_client = batch_v1_api.BatchV1Api()
 
         config.list_kube_config_contexts()
 
@@ -40,10 +62,22 @@ class KubernetesRunner(StepRunner):
 
         self._vol_claim_name = f"{self._base_pod_name}-pvc"
         self._vol_size = self._config.resman_opts.get("volume_size", "500Mi")
+        self._pod_timeout = self._config.resman_opts.get("pod_retry_limit", 60)
+
+        self._persistent_sync_pod = self._config.resman_opts.get(
+            "persistent_sync_pod", False
+        )
 
         self._init_pod_created = False
         self._vol_claim_created = False
 
+        # pods and jobs of steps that are currently executing
+        self._spawned_pods = set()
+        self._spawned_jobs = set()
+        self._setup_lock = threading.Lock()
+
+        self._version = None
+
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self._kclient.api_client.rest_client.pool_manager.clear()
         self._kclient.api_client.close()
@@ -51,17 +85,32 @@ class KubernetesRunner(StepRunner):
         return True
 
     def run(self, step):
-        """Execute a step in a kubernetes cluster."""
-        self._pod_name = self._base_pod_name + f"-{step.id}"
+        """Execute a step in a kubernetes cluster. Each step runs in a pod of
+        its own, so several steps can run concurrently."""
+        return self._run_pod(step, self._base_pod_name + f"-{step.id}")
+
+    def _run_pod(self, step, pod_name, log_prefix=""):
+        """Execute a step in a pod with the given name.
+
+        Args:
+          step(Box): step information.
+          pod_name(str): name of the pod.
+          log_prefix(str): prefix of the lines of the logs of the pod.
 
+        Returns:
+          int: exit code of the step.
+        """
         needs_build, _, img, tag, _ = self._get_build_info(step)
 
         if needs_build:
-            log.fail(f"Cannot build ")
+            log.fail(
+                f"Step '{step.id}' cannot build images with the Kubernetes "
+                "resource manager."
+            )
 
         image = f"{img}:{tag}"
 
-        m = f"[{step.id}] kubernetes run {self._namespace}.{self._pod_name}"
+        m = f"[{step.id}] kubernetes run {self._namespace}.{pod_name}"
         log.info(m)
 
         if self._config.dry_run:
@@ -69,35 +118,206 @@ class KubernetesRunner(StepRunner):
 
         ecode = 1
         try:
+            self._setup_workspace()
+            self._pod_create(step, image, pod_name, self._pod_host_node)
+            self._pod_read_log(pod_name, log_prefix)
+            ecode = self._pod_exit_code(pod_name)
+        except Exception as e:
+            log.fail(e)
+        finally:
+            if pod_name in self._spawned_pods:
+                self._pod_delete(pod_name)
+
+        log.debug(f"returning with {ecode}")
+        return ecode
+
+    def stop_running_tasks(self):
+        """Delete the Pods of all the steps that are executing upon receiving
+        SIGINT.
+        """
+        log.debug("received SIGINT. deleting pods and jobs")
+        for pod_name in list(self._spawned_pods):
+            try:
+                self._pod_delete(pod_name)
+            except ApiException as e:
+                log.debug(f"unable to delete pod {pod_name}: {e.reason}")
+        for job_name in list(self._spawned_jobs):
+            try:
+                self._job_delete(job_name)
+            except ApiException as e:
+                log.debug(f"unable to delete job {job_name}: {e.reason}")
+
+    def prefetch(self, steps):
+        """Images are pulled by the nodes of the cluster."""
+        pass
+
+    def run_matrix(self, steps):
+        """Execute a step for several elements of a matrix as a single
+        Indexed Job, with one completion index per element. Commands and
+        environment variables that differ among elements are passed to each
+        index through a shell script, so these steps need a 'runs' attribute
+        and an image that has a shell. Logs and exit codes are collected for
+        each element once the job has finished.
+
+        Clusters older than Kubernetes 1.29 (or where the JobBackoffLimitPerIndex
+        feature is disabled) don't support Indexed Jobs with a backoff limit
+        per index, so each element runs in a pod of its own.
+        """
+        if not self._config.dry_run:
+            if self._server_version() < self._indexed_job_version:
+                return self._run_matrix_pods(steps)
+
+        elements = sorted(steps)
+        step = steps[elements[0]]
+        job_name = self._base_pod_name + f"-{step.id}"
+
+        images = set()
+        for s in steps.values():
+            needs_build, _, img, tag, _ = self._get_build_info(s)
+            if needs_build:
+                log.fail(
+                    f"Step '{s.id}' cannot build images inside a Kubernetes "
+                    "matrix job."
+                )
+            images.add(f"{img}:{tag}")
+
+        if len(images) > 1:
+            log.fail(f"Step '{step.id}' uses distinct images in matrix elements.")
+
+        image = images.pop()
+
+        m = f"[{step.id}] kubernetes job {self._namespace}.{job_name}"
+        log.info(f"{m} ({len(elements)} elements)")
+
+        if self._config.dry_run:
+            return {i: 0 for i in elements}
+
+        ecodes = {i: 1 for i in elements}
+        try:
+            self._setup_workspace()
+            commands = [
+                (self._prepare_environment(steps[i]), steps[i].runs, steps[i].args)
+                for i in elements
+            ]
+            if not self._job_create(
+                step, image, job_name, commands, self._pod_host_node
+            ):
+                return self._run_matrix_pods(steps)
+
+            self._job_wait(job_name)
+
+            # exit codes are read from the pods, before the job is deleted
+            pods = self._job_pods(job_name)
+            self._job_read_logs(step, pods, elements)
+            for index, i in enumerate(elements):
+                if index in pods:
+                    ecodes[i] = self._container_exit_code(pods[index])
+        except Exception as e:
+            log.fail(e)
+        finally:
+            if job_name in self._spawned_jobs:
+                self._job_delete(job_name)
+
+        log.debug(f"returning with {ecodes}")
+        return ecodes
+
+    def _run_matrix_pods(self, steps):
+        """Execute a step for several elements of a matrix in a pod per
+        element, up to matrix_parallelism of them at the same time.
+        """
+        log.debug(
+            "Indexed Jobs are not supported by the cluster; running a pod for "
+            "each matrix element"
+        )
+        elements = sorted(steps)
+        parallelism = self._config.resman_opts.get("matrix_parallelism", len(elements))
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            futures = {
+                i: executor.submit(
+                    self._run_pod,
+                    steps[i],
+                    f"{self._base_pod_name}-{steps[i].id}-{i}",
+                    f"[{steps[i].id}][{i}] ",
+                )
+                for i in elements
+            }
+        return {i: f.result() for i, f in futures.items()}
+
+    def _server_version(self):
+        """Returns the (major, minor) version of the kubernetes API server.
+        Minor versions of some providers have a suffix, e.g. '18+'.
+        """
+        if not self._version:
+            info = client.VersionApi().get_code()
+            minor = re.match(r"\d+", info.minor)
+            self._version = (int(info.major), int(minor.group()) if minor else 0)
+            log.debug(f"kubernetes server version {info.git_version}")
+        return self._version
+
+    def _setup_workspace(self):
+        """Create the PersistentVolumeClaim and copy the workspace into it,
+        the first time that a step is executed. Steps that are executed
+        concurrently wait for this to complete.
+        """
+        with self._setup_lock:
             if not self._vol_claim_created:
                 if not self._vol_claim_exists():
                     self._vol_claim_create()
                 self._vol_claim_created = True
 
             if not self._init_pod_created:
-                e, self._pod_host_node = self._init_pod_schedule()
-                if e:
-                    raise Exception("None of the nodes are schedulable.")
+                if not self._persistent_sync_pod or not self._sync_pod_find():
+                    e, self._pod_host_node = self._init_pod_schedule()
+                    if e:
+                        raise Exception("None of the nodes are schedulable.")
                 self._copy_ctx()
-                self._init_pod_delete()
+                if not self._persistent_sync_pod:
+                    self._init_pod_delete()
                 self._init_pod_created = True
 
-            self._pod_create(step, image, self._pod_host_node)
-            self._pod_read_log()
-            ecode = self._pod_exit_code()
-        except Exception as e:
-            log.fail(e)
-        finally:
-            self._pod_delete()
-
-        log.debug(f"returning with {ecode}")
-        return ecode
+    def _sync_pod_find(self):
+        """Look for a sync pod that a previous execution left running for the
+        PersistentVolumeClaim of this runner and, if there is one, use it as
+        the init pod. Sync pods that are not running are deleted.
 
-    def stop_running_tasks(self):
-        """Delete the Pod and then the PersistentVolumeClaim upon receiving SIGINT.
+        Returns:
+          bool: True if a running sync pod was found.
         """
-        log.debug("received SIGINT. deleting pod and volume claim")
-        self._pod_delete()
+        pods = self._kclient.list_namespaced_pod(
+            self._namespace,
+            label_selector=f"{self._sync_pod_label}={self._vol_claim_name}",
+        )
+        for pod in pods.items:
+            if pod.metadata.deletion_timestamp:
+                continue
+            if pod.status.phase != "Running":
+                log.debug(f"deleting stale sync pod {pod.metadata.name}")
+                self._kclient.delete_namespaced_pod(
+                    pod.metadata.name,
+                    namespace=self._namespace,
+                    body=V1DeleteOptions(),
+                )
+                continue
+
+            log.debug(f"reusing sync pod {pod.metadata.name}")
+            self._init_pod_name = pod.metadata.name
+
+            # stick to the node of the sync pod, as _init_pod_schedule() does
+            if self._config.resman_opts.get("pod_host_node", None):
+                self._pod_host_node = self._config.resman_opts.pod_host_node
+            elif not self._config.resman_opts.get("persistent_volume_name", None):
+                self._pod_host_node = pod.spec.node_name
+            else:
+                self._pod_host_node = None
+            return True
+
+        # names of sync pods are unique, so that a new one doesn't collide
+        # with a stale one that is still terminating
+        self._init_pod_name = pu.sanitized_name(
+            f"sync-pod-{int(time.time())}", self._config.wid
+        ).replace("_", "-")
+
+        return False
 
     def _init_pod_schedule(self):
         """If a node selector is not provided, select a node randomly
@@ -141,24 +361,47 @@ class KubernetesRunner(StepRunner):
         return e, pod_host_node
 
     def _copy_ctx(self):
-        """Tar up the workspace context and copy the tar file into
-        the PersistentVolume in the Pod.
+        """Copy the workspace into the PersistentVolume by streaming a tar
+        archive into a `tar` process running in the init pod, through the
+        standard input of the exec connection. If the ``incremental_sync``
+        option is given, only files that changed since the last copy to the
+        same volume claim are sent, and files that were removed from the
+        workspace are deleted from the volume.
         """
-        source_dir = os.path.join(self._config.cache_dir, "kubernetes")
-        if not os.path.exists(source_dir):
-            os.makedirs(source_dir)
-
-        target_file = "ctx_" + str(self._config.wid) + ".tar.gz"
-        source_file = os.path.join(source_dir, target_file)
-        destination_file = "/workspace/" + target_file
+        incremental = self._config.resman_opts.get("incremental_sync", False)
 
-        files = os.listdir(self._config.workspace_dir)
+        # a persistent sync pod always receives the changes since the last copy
+        incremental = incremental or self._persistent_sync_pod
 
-        with tarfile.open(source_file, mode="w:gz") as archive:
-            for f in files:
-                archive.add(f)
+        manifest_file = self._sync_manifest_file()
 
-        exec_command = ["/bin/sh"]
+        if incremental:
+            vol_claim_uid = self._kclient.read_namespaced_persistent_volume_claim(
+                self._vol_claim_name, namespace=self._namespace
+            ).metadata.uid
+            manifest = KubernetesRunner._read_sync_manifest(
+                manifest_file, vol_claim_uid
+            )
+            files, changed, deleted = KubernetesRunner._scan_workspace(
+                self._config.workspace_dir, manifest
+            )
+            log.debug(f"syncing {len(changed)} paths, deleting {len(deleted)}")
+        else:
+            if os.path.exists(manifest_file):
+                os.remove(manifest_file)
+            changed = sorted(os.listdir(self._config.workspace_dir))
+            deleted = []
+
+        # the archive ends with an end-of-archive marker, after which tar
+        # exits without waiting for the end of its input
+        exec_command = [
+            "/bin/sh",
+            "-c",
+            "tar -x -f - -C /workspace && cd /workspace && "
+            f"if [ -f {self._sync_deleted_file} ]; then "
+            f"xargs -0 rm -rf -- < {self._sync_deleted_file}; "
+            f"rm -f {self._sync_deleted_file}; fi",
+        ]
         response = stream(
             self._kclient.connect_get_namespaced_pod_exec,
             self._init_pod_name,
@@ -171,12 +414,20 @@ class KubernetesRunner(StepRunner):
             _preload_content=False,
         )
 
-        with open(source_file, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read())
-
-        commands = [
-            f"echo {encoded_string.decode('utf-8')} | base64 --decode > {destination_file}"
-        ]
+        with tarfile.open(
+            fileobj=ExecStdin(response), mode="w|", bufsize=ExecStdin.chunk_size
+        ) as archive:
+            for path in changed:
+                archive.add(
+                    os.path.join(self._config.workspace_dir, path),
+                    arcname=path,
+                    recursive=not incremental,
+                )
+            if deleted:
+                data = "\0".join(deleted).encode("utf-8")
+                info = tarfile.TarInfo(self._sync_deleted_file)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
 
         while response.is_open():
             response.update(timeout=1)
@@ -184,28 +435,84 @@ class KubernetesRunner(StepRunner):
                 log.debug(f"stdout: {response.read_stdout()}")
             if response.peek_stderr():
                 log.debug(f"stderr: {response.read_stderr()}")
-            if commands:
-                c = commands.pop(0)
-                log.debug(f"running command... {c}")
-                response.write_stdin(c)
-            else:
-                break
+        ecode = response.returncode
         response.close()
 
-        # extract the archive inside the pod
-        exec_command = ["tar", "-zxvf", destination_file]
-        response = stream(
-            self._kclient.connect_get_namespaced_pod_exec,
-            self._init_pod_name,
-            self._namespace,
-            command=exec_command,
-            stderr=True,
-            stdin=False,
-            stdout=True,
-            tty=False,
-        )
+        if ecode != 0:
+            raise Exception(f"Copying the workspace failed with exit code {ecode}")
+
+        if incremental:
+            os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+            with open(manifest_file, "w") as f:
+                json.dump({"vol_claim_uid": vol_claim_uid, "files": files}, f)
+
+    def _sync_manifest_file(self):
+        """Path to the file that records the state of the workspace as of the
+        last copy to the volume claim of this runner."""
+        name = pu.sanitized_name(f"{self._namespace}-{self._vol_claim_name}", "sync")
+        return os.path.join(self._config.cache_dir, "kubernetes", f"{name}.json")
+
+    @staticmethod
+    def _read_sync_manifest(manifest_file, vol_claim_uid):
+        """Returns the files recorded in a sync manifest, or an empty dict if
+        the manifest doesn't exist or refers to another volume claim (e.g.
+        one that was deleted and created again with the same name)."""
+        if not os.path.isfile(manifest_file):
+            return {}
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("vol_claim_uid", None) != vol_claim_uid:
+            return {}
+        return manifest["files"]
+
+    @staticmethod
+    def _scan_workspace(workspace_dir, manifest):
+        """Compares the contents of a workspace against a manifest of a
+        previous copy of it. A file is considered to have changed if its size
+        changed, or if its modification time changed and so did its digest.
+
+        Args:
+          workspace_dir(str): path to the workspace.
+          manifest(dict): maps paths (relative to the workspace) to the entry
+            that was recorded for them.
+
+        Returns:
+          tuple(dict, list, list): the manifest for the current contents of
+            the workspace, the paths that are new or changed, in top-down
+            order, and the paths that no longer exist.
+        """
+        files = {}
+        changed = []
+
+        for root, dirs, names in os.walk(workspace_dir):
+            for name in sorted(dirs) + sorted(names):
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, workspace_dir)
+                old = manifest.get(rel_path, None)
+                st = os.lstat(path)
+
+                if stat.S_ISLNK(st.st_mode):
+                    entry = ["link", os.readlink(path)]
+                elif stat.S_ISDIR(st.st_mode):
+                    entry = ["dir"]
+                else:
+                    entry = ["file", st.st_mtime, st.st_size]
+                    if old and old[:3] == entry:
+                        entry = old
+                    else:
+                        entry.append(pu.file_digest(path))
+                        if old and old[0] == "file" and old[2:] == entry[2:]:
+                            # only the modification time changed
+                            files[rel_path] = entry
+                            continue
+
+                files[rel_path] = entry
+                if entry != old:
+                    changed.append(rel_path)
 
-        log.debug(response)
+        deleted = sorted(p for p in manifest if p not in files)
+
+        return files, changed, deleted
 
     def _init_pod_create(self, pod_host_node=None):
         """Create a init Pod mounted on a volume with alpine image so that 
@@ -239,6 +546,11 @@ class KubernetesRunner(StepRunner):
             },
         }
 
+        if self._persistent_sync_pod:
+            init_pod_conf["metadata"]["labels"] = {
+                self._sync_pod_label: self._vol_claim_name
+            }
+
         if pod_host_node:
             init_pod_conf["spec"]["nodeSelector"] = {
                 "kubernetes.io/hostname": pod_host_node
@@ -248,24 +560,17 @@ class KubernetesRunner(StepRunner):
             body=init_pod_conf, namespace=self._namespace
         )
 
-        # loop and wait for the init pod to come up
-        counter = 1
-        while True:
-            response = self._kclient.read_namespaced_pod(
-                self._init_pod_name, namespace=self._namespace
-            )
-            if response.status.phase != "Pending":
-                break
-
-            log.debug(f"init pod {self._init_pod_name} not started yet")
-
-            if counter == self._config.resman_opts.get("pod_retry_limit", 60):
-                return 1
-
-            time.sleep(1)
-            counter += 1
+        # wait for the init pod to come up
+        log.debug(f"waiting for init pod {self._init_pod_name} to start")
+        pod = self._wait_for(
+            self._kclient.list_namespaced_pod,
+            self._init_pod_name,
+            lambda p: p.status.phase != "Pending",
+            self._pod_timeout,
+            namespace=self._namespace,
+        )
 
-        return 0
+        return 0 if pod else 1
 
     def _init_pod_delete(self):
         """Teardown the init Pod after the context has been copied
@@ -300,19 +605,15 @@ class KubernetesRunner(StepRunner):
 
         self._kclient.create_persistent_volume(body=vol_conf)
 
-        counter = 1
-        while True:
-            response = self._kclient.read_persistent_volume(volume_name)
-            if response.status.phase != "Pending":
-                break
-
-            log.debug(f"volume {volume_name} not created yet")
-
-            if counter == 60:
-                raise Exception("Timed out waiting for PersistentVolume creation")
-
-            time.sleep(1)
-            counter += 1
+        log.debug(f"waiting for volume {volume_name} to be created")
+        vol = self._wait_for(
+            self._kclient.list_persistent_volume,
+            volume_name,
+            lambda v: v.status.phase != "Pending",
+            60,
+        )
+        if not vol:
+            raise Exception("Timed out waiting for PersistentVolume creation")
 
     def _vol_claim_create(self):
         """Create a PersistentVolumeClaim to claim usable storage space 
@@ -342,21 +643,16 @@ class KubernetesRunner(StepRunner):
         )
 
         # wait for the volume claim to go into `Bound` state.
-        counter = 1
-        while True:
-            response = self._kclient.read_namespaced_persistent_volume_claim(
-                self._vol_claim_name, namespace=self._namespace
-            )
-            if response.status.phase != "Pending":
-                break
-
-            log.debug(f"volume claim {self._vol_claim_name} not created yet")
-
-            if counter == 60:
-                raise Exception("Timed out waiting for PersistentVolumeClaim creation")
-
-            time.sleep(1)
-            counter += 1
+        log.debug(f"waiting for volume claim {self._vol_claim_name} to be bound")
+        vol_claim = self._wait_for(
+            self._kclient.list_namespaced_persistent_volume_claim,
+            self._vol_claim_name,
+            lambda c: c.status.phase != "Pending",
+            60,
+            namespace=self._namespace,
+        )
+        if not vol_claim:
+            raise Exception("Timed out waiting for PersistentVolumeClaim creation")
 
     def _vol_exists(self, volume_name):
         vol_exists = False
@@ -390,18 +686,46 @@ class KubernetesRunner(StepRunner):
             self._vol_claim_name, namespace=self._namespace, body=V1DeleteOptions()
         )
 
-    def _pod_create(self, step, image, pod_host_node=None):
+    def _pod_create(self, step, image, pod_name, pod_host_node=None):
         """Start a Pod for each step.
         """
         log.debug(f"trying to start step pod on {pod_host_node}")
         env = self._prepare_environment(step)
         log.debug(env)
 
-        ws_vol_mount = f"{self._pod_name}-ws"
+        pod_conf = self._pod_conf(step, image, pod_name, env, pod_host_node)
+
+        runs = list(step.runs) if step.runs else None
+        args = list(step.args) if step.args else None
+
+        if runs:
+            pod_conf["spec"]["containers"][0]["command"] = runs
+
+        if args:
+            pod_conf["spec"]["containers"][0]["args"] = args
+
+        self._kclient.create_namespaced_pod(body=pod_conf, namespace=self._namespace)
+        self._spawned_pods.add(pod_name)
+
+        log.debug(f"waiting for pod {pod_name} to start")
+        pod = self._wait_for(
+            self._kclient.list_namespaced_pod,
+            pod_name,
+            lambda p: p.status.phase != "Pending",
+            self._pod_timeout,
+            namespace=self._namespace,
+        )
+        if not pod:
+            raise Exception("Timed out waiting for Pod to start")
+
+    def _pod_conf(self, step, image, pod_name, env, pod_host_node=None):
+        """Returns the definition of the Pod of a step, without its command.
+        """
+        ws_vol_mount = f"{pod_name}-ws"
         pod_conf = {
             "apiVersion": "v1",
             "kind": "Pod",
-            "metadata": {"name": self._pod_name},
+            "metadata": {"name": pod_name},
             "spec": {
                 "restartPolicy": "Never",
                 "containers": [
@@ -433,66 +757,278 @@ class KubernetesRunner(StepRunner):
         if pod_host_node:
             pod_conf["spec"]["nodeSelector"] = {"kubernetes.io/hostname": pod_host_node}
 
-        runs = list(step.runs) if step.runs else None
-        args = list(step.args) if step.args else None
+        return pod_conf
 
-        if runs:
-            pod_conf["spec"]["containers"][0]["command"] = runs
+    def _pod_read_log(self, pod_name, prefix=""):
+        """Read logs from the Pod after it moves into `Running` state, adding
+        the given prefix to each line.
+        """
+        log.debug(f"reading logs from {pod_name}")
+        response = self._kclient.read_namespaced_pod_log(
+            name=pod_name,
+            namespace=self._namespace,
+            follow=True,
+            tail_lines=10,
+            _preload_content=False,
+        )
+        for line in response:
+            log.step_info(prefix + line.decode().rstrip())
 
-        if args:
-            pod_conf["spec"]["containers"][0]["args"] = args
+    def _pod_exit_code(self, pod_name):
+        """Read the exit code from the Pod to decide the exit code of the step.
+        """
+        # the log stream ends when the container exits, slightly before the
+        # pod moves into its final phase
+        pod = self._wait_for(
+            self._kclient.list_namespaced_pod,
+            pod_name,
+            lambda p: p.status.phase in ["Succeeded", "Failed"],
+            self._pod_timeout,
+            namespace=self._namespace,
+        )
+        if not pod:
+            log.debug(f"pod {pod_name} did not finish in time")
+            return 1
+        log.debug(f"got status {pod.status.phase}")
+        return self._container_exit_code(pod)
 
-        self._kclient.create_namespaced_pod(body=pod_conf, namespace=self._namespace)
+    @staticmethod
+    def _container_exit_code(pod):
+        """Returns the exit code of the container of a pod that has finished,
+        or 1 if the container did not terminate (e.g. the pod was evicted).
+        """
+        for status in pod.status.container_statuses or []:
+            if status.state and status.state.terminated:
+                return status.state.terminated.exit_code
+        return 0 if pod.status.phase == "Succeeded" else 1
+
+    def _wait_for(self, list_fn, name, done, timeout, **kw):
+        """Waits until an object satisfies a condition. Instead of polling the
+        API server, the object is read once and then its changes are watched,
+        starting from the resource version of the initial read.
+
+        Args:
+          list_fn(function): API function that lists objects of the kind of
+            the object, e.g. ``self._kclient.list_namespaced_pod``.
+          name(str): name of the object.
+          done(function): receives the object and returns True when the
+            condition is satisfied.
+          timeout(int): maximum number of seconds to wait, or None to wait
+            indefinitely.
+          kw(dict): other arguments for list_fn, e.g. namespace.
+
+        Returns:
+          object: the object, or None if the timeout expired before the
+            condition was satisfied.
+        """
+        kw["field_selector"] = f"metadata.name={name}"
+        deadline = time.time() + timeout if timeout else None
 
-        counter = 1
-        while True:
-            response = self._kclient.read_namespaced_pod(
-                self._pod_name, namespace=self._namespace
+        while not deadline or time.time() < deadline:
+            response = list_fn(**kw)
+            for obj in response.items:
+                if done(obj):
+                    return obj
+
+            if deadline:
+                kw["timeout_seconds"] = max(1, int(deadline - time.time()))
+
+            w = watch.Watch()
+            events = w.stream(
+                list_fn, resource_version=response.metadata.resource_version, **kw
             )
-            if response.status.phase != "Pending":
-                break
+            for event in events:
+                if event["type"] == "ERROR":
+                    # the resource version expired; list the object again
+                    break
+                if event["type"] != "DELETED" and done(event["object"]):
+                    w.stop()
+                    return event["object"]
+            w.stop()
+
+        return None
+
+    def _job_create(self, step, image, job_name, commands, pod_host_node=None):
+        """Start an Indexed Job that runs a step for each of the given
+        commands, in the order of their completion index.
+
+        Args:
+          step(Box): step information (of any element).
+          image(str): image of the step.
+          job_name(str): name of the job.
+          commands(list): list of (env, runs, args) tuples.
+          pod_host_node(str): node where pods are executed.
+
+        Returns:
+          bool: False if the job was not created because the API server drops
+            the fields of Indexed Jobs with a backoff limit per index.
+        """
+        env, runs, args = commands[0]
+        if any(c != commands[0] for c in commands):
+            # steps differ among elements
+            if not all(runs for _, runs, _ in commands):
+                log.fail(
+                    f"Step '{step.id}' has to define a 'runs' attribute in order "
+                    "to be executed for distinct matrix elements."
+                )
+            env = {}
+            runs = ["/bin/sh", "-c", KubernetesRunner._matrix_script(commands)]
+            args = None
 
-            log.debug(f"pod {self._pod_name} not started yet")
+        pod_conf = self._pod_conf(step, image, job_name, env, pod_host_node)
 
-            if counter == self._config.resman_opts.get("pod_retry_limit", 60):
-                raise Exception("Timed out waiting for Pod to start")
+        if runs:
+            pod_conf["spec"]["containers"][0]["command"] = list(runs)
 
-            time.sleep(1)
-            counter += 1
+        if args:
+            pod_conf["spec"]["containers"][0]["args"] = list(args)
 
-    def _pod_read_log(self):
-        """Read logs from the Pod after it moves into `Running` state.
-        """
-        log.debug(f"reading logs from {self._pod_name}")
-        response = self._kclient.read_namespaced_pod_log(
-            name=self._pod_name,
+        job_conf = {
+            "apiVersion": "batch/v1",
+            "kind": "Job",
+            "metadata": {"name": job_name},
+            "spec": {
+                "completionMode": "Indexed",
+                "completions": len(commands),
+                "parallelism": self._config.resman_opts.get(
+                    "matrix_parallelism", len(commands)
+                ),
+                # a failing element doesn't affect others
+                "backoffLimitPerIndex": 0,
+                "template": {"spec": pod_conf["spec"]},
+            },
+        }
+
+        # servers where these features are disabled drop the fields instead
+        # of rejecting the job, in which case a failing index would be retried
+        # and eventually fail the whole job. A dry run tells without starting
+        # any pod. The fields are missing in the models of the client, so the
+        # response is read as plain JSON.
+        response = self._batch_client.create_namespaced_job(
+            body=job_conf,
             namespace=self._namespace,
-            follow=True,
-            tail_lines=10,
+            dry_run="All",
             _preload_content=False,
         )
-        for line in response:
-            log.step_info(line.decode().rstrip())
+        spec = json.loads(response.data).get("spec", {})
+        if spec.get("completionMode") != "Indexed" or (
+            spec.get("backoffLimitPerIndex") is None
+        ):
+            log.debug(f"job spec was not accepted as given: {spec}")
+            return False
+
+        self._batch_client.create_namespaced_job(
+            body=job_conf, namespace=self._namespace
+        )
+        self._spawned_jobs.add(job_name)
+        return True
 
-    def _pod_exit_code(self):
-        """Read the exit code from the Pod to decide the exit code of the step.
+    @staticmethod
+    def _matrix_script(commands):
+        """Returns a shell script that runs the command that corresponds to
+        the completion index of the job, which kubernetes passes to pods of
+        Indexed Jobs in the JOB_COMPLETION_INDEX variable.
+
+        Args:
+          commands(list): list of (env, runs, args) tuples.
+
+        Returns:
+          str: the script.
+        """
+        script = 'case "$JOB_COMPLETION_INDEX" in\n'
+        for index, (env, runs, args) in enumerate(commands):
+            exports = [f"export {k}={shlex.quote(str(v))}; " for k, v in env.items()]
+            cmd = [shlex.quote(str(c)) for c in list(runs) + list(args or [])]
+            script += f"{index}) {''.join(exports)}exec {' '.join(cmd)} ;;\n"
+        script += "esac\nexit 1\n"
+        return script
+
+    def _job_wait(self, job_name):
+        """Wait for a job to finish. As the pod of a single step, each pod of
+        the job has to start within pod_retry_limit seconds, which is checked
+        every time that this timeout expires while the job is executing.
+        """
+        log.debug(f"waiting for job {job_name} to finish")
+        while True:
+            job = self._wait_for(
+                self._batch_client.list_namespaced_job,
+                job_name,
+                lambda j: any(
+                    c.type in ["Complete", "Failed"] and c.status == "True"
+                    for c in (j.status.conditions or [])
+                ),
+                self._pod_timeout,
+                namespace=self._namespace,
+            )
+            if job:
+                return
+
+            now = datetime.datetime.now(datetime.timezone.utc)
+            pods = self._kclient.list_namespaced_pod(
+                self._namespace, label_selector=f"job-name={job_name}"
+            )
+            for pod in pods.items:
+                age = (now - pod.metadata.creation_timestamp).total_seconds()
+                if pod.status.phase == "Pending" and age > self._pod_timeout:
+                    raise Exception(
+                        f"Timed out waiting for Pod {pod.metadata.name} to start"
+                    )
+            if not pods.items:
+                raise Exception(f"Timed out waiting for Job {job_name} to start")
+
+    def _job_pods(self, job_name):
+        """Returns the pods of an Indexed Job, mapped to the completion index
+        that they executed. If an index has several pods, the one that was
+        created last is returned.
         """
-        time.sleep(2)
-        response = self._kclient.read_namespaced_pod(
-            name=self._pod_name, namespace=self._namespace
+        pods = self._kclient.list_namespaced_pod(
+            self._namespace, label_selector=f"job-name={job_name}"
         )
-        log.debug(f"got status {response.status.phase}")
-        if response.status.phase != "Succeeded":
-            return 1
-        return 0
+        indexed = {}
+        for pod in sorted(pods.items, key=lambda p: p.metadata.creation_timestamp):
+            labels = pod.metadata.labels or {}
+            index = labels.get(self._completion_index_label, None)
+            if index is not None:
+                indexed[int(index)] = pod
+        return indexed
+
+    def _job_read_logs(self, step, pods, elements):
+        """Read the logs of the pods of a job that has finished, prefixing each
+        line with the matrix element that the pod executed.
+
+        Args:
+          step(Box): step information (of any element).
+          pods(dict): pods of the job, mapped to their completion index.
+          elements(list): matrix elements, in the order of their index.
+        """
+        for index, i in enumerate(elements):
+            if index not in pods:
+                continue
+            logs = self._kclient.read_namespaced_pod_log(
+                name=pods[index].metadata.name, namespace=self._namespace
+            )
+            for line in logs.splitlines():
+                log.step_info(f"[{step.id}][{i}] {line}")
+
+    def _job_delete(self, job_name):
+        """Delete a Job along with its Pods.
+        """
+        log.debug(f"deleting job {job_name}")
+        self._batch_client.delete_namespaced_job(
+            job_name,
+            namespace=self._namespace,
+            body=V1DeleteOptions(propagation_policy="Background"),
+        )
+        self._spawned_jobs.discard(job_name)
 
-    def _pod_delete(self):
+    def _pod_delete(self, pod_name):
         """Delete the Pod after it has Completed or Failed.
         """
-        log.debug(f"deleting pod {self._pod_name}")
+        log.debug(f"deleting pod {pod_name}")
         self._kclient.delete_namespaced_pod(
-            self._pod_name, namespace=self._namespace, body=V1DeleteOptions()
+            pod_name, namespace=self._namespace, body=V1DeleteOptions()
         )
+        self._spawned_pods.discard(pod_name)
 
 
 class DockerRunner(KubernetesRunner, HostDockerRunner):
@@ -505,3 +1041,18 @@ class DockerRunner(KubernetesRunner, HostDockerRunner):
     def __exit__(self, exc_type, exc_value, exc_traceback):
         super(DockerRunner, self).__exit__(exc_type, exc_value, exc_traceback)
         return True
+
+
+class ExecStdin(object):
+    """Minimal file-like object that writes binary data to the standard input
+    of a process executed in a pod, through an exec websocket connection."""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, response):
+        self._response = response
+
+    def write(self, data):
+        for i in range(0, len(data), ExecStdin.chunk_size):
+            self._response.write_stdin(bytes(data[i : i + ExecStdin.chunk_size]))
+        return len(data)
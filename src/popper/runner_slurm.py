@@ -1,20 +1,84 @@
 import os
-import time
-import signal
 import socket
 import threading
 
 from popper import utils as pu
 from popper.cli import log as log
-from popper.runner_host import HostRunner
+from popper.runner_host import HostRunner, OutputPump
 from popper.runner_host import SingularityRunner as HostSingularityRunner
 from popper.utils import assert_executable_exists
 
 
+class OutputFollower(object):
+    """Follows the output files of jobs from a single thread, logging what is
+    appended to them. Files are polled more often while they grow, and less
+    often (up to max_interval seconds) while they don't.
+    """
+
+    def __init__(self, min_interval=0.05, max_interval=1.0):
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._files = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def follow(self, path, **kw):
+        """Starts following a file from its beginning. The keyword arguments
+        are given to the OutputPump that logs the contents of the file.
+        """
+        with self._lock:
+            self._files[path] = (open(path, "rb"), OutputPump(**kw))
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def unfollow(self, path):
+        """Stops following a file, once the rest of its contents is logged.
+
+        Returns:
+          list: lines of the file, if logging was disabled; empty otherwise.
+        """
+        with self._lock:
+            f, pump = self._files.pop(path)
+        with f:
+            OutputFollower._read(f, pump)
+        return pump.close()
+
+    @staticmethod
+    def _read(f, pump):
+        """Gives the bytes appended to a file since it was last read to its
+        pump. Returns whether there were any."""
+        appended = False
+        for chunk in iter(lambda: f.read(OutputPump.chunk_size), b""):
+            pump.feed(chunk)
+            appended = True
+        return appended
+
+    def _run(self):
+        interval = self._min_interval
+        while True:
+            with self._lock:
+                if not self._files:
+                    self._thread = None
+                    return
+                appended = [OutputFollower._read(f, p) for f, p in self._files.values()]
+
+            if any(appended):
+                interval = self._min_interval
+            else:
+                interval = min(interval * 2, self._max_interval)
+
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+
+
 class SlurmRunner(HostRunner):
     def __init__(self, **kw):
         super(SlurmRunner, self).__init__(**kw)
         self._spawned_jobs = set()
+        self._out_follower = OutputFollower()
 
         slurm_executables = ["sbatch", "srun", "scancel", "mpirun"]
         for exe in slurm_executables:
@@ -23,31 +87,6 @@ class SlurmRunner(HostRunner):
     def __exit__(self, exc_type, exc, traceback):
         self._spawned_jobs = set()
 
-    def _tail_output(self, out_file):
-        self._out_stream_pid = set()
-        _, ecode, _ = HostRunner._exec_cmd(
-            ["tail", "-f", out_file], pids=self._out_stream_pid
-        )
-        return ecode
-
-    def _start_out_stream(self, out_file):
-        self._out_stream_thread = threading.Thread(
-            target=self._tail_output, args=(out_file,)
-        )
-        self._out_stream_thread.start()
-        # give time so that _exec_cmd puts the pid inside the self._out_stream_pid set
-        time.sleep(1)
-
-    def _stop_out_stream(self):
-        if len(self._out_stream_pid) != 1:
-            log.fail("Cannot find PID for tail process")
-        _out_stream_pid = list(self._out_stream_pid)[0]
-        try:
-            os.kill(_out_stream_pid, signal.SIGKILL)
-        except ProcessLookupError:
-            log.warning("Tail process was stopped by some other process.")
-        self._out_stream_thread.join()
-
     def _set_config_vars(self, step):
         self._nodes = self._config.resman_opts.get(step.id, {}).get("nodes", 1)
         self._nodelist = self._config.resman_opts.get(step.id, {}).get("nodelist", None)
@@ -130,11 +169,15 @@ class SlurmRunner(HostRunner):
             return 0
 
         self._spawned_jobs.add(job_name)
-        self._start_out_stream(out_file)
+        self._out_follower.follow(out_file, **self._get_output_options(step))
 
-        _, ecode, _ = HostRunner._exec_cmd(sbatch_cmd, **kwargs)
+        try:
+            _, ecode, _ = HostRunner._exec_cmd(sbatch_cmd, **kwargs)
+        finally:
+            # sbatch --wait returns once the job finishes, so what is left in
+            # the output file is logged before moving on
+            self._out_follower.unfollow(out_file)
 
-        self._stop_out_stream()
         self._spawned_jobs.remove(job_name)
 
         return ecode
@@ -153,6 +196,9 @@ class SingularityRunner(SlurmRunner, HostSingularityRunner):
         if self._config.reuse:
             log.fail("Reuse not supported for SingularityRunner.")
 
+        if self._config.engine_opts.get("instances", False):
+            log.warning("Singularity instances are not supported on SLURM.")
+
         singularity_executables = ["singularity"]
         for exe in singularity_executables:
             assert_executable_exists(exe)
@@ -163,58 +209,46 @@ class SingularityRunner(SlurmRunner, HostSingularityRunner):
     def run(self, step):
         self._setup_singularity_cache()
         cid = pu.sanitized_name(step.id, self._config.wid) + ".sif"
-        self._container = os.path.join(self._singularity_cache, cid)
 
-        build, img, _, _, build_ctx_path = self._get_build_info(step)
+        build, img, build_ctx_path, sif = self._get_image_info(step)
+        tmp_image = self._get_tmp_image(sif, cid)
+
+        with self._image_lock(sif):
+            ecode = 0
+            if build and os.path.isfile(sif):
+                log.info(f"[{step.id}] singularity image {sif} is up to date")
+            elif build:
+                recipefile = self._get_recipe_file(
+                    build_ctx_path, self._get_recipe_path(sif, build_ctx_path)
+                )
+                log.info(f"[{step.id}] srun singularity build {sif}")
+                ecode = self._exec_srun(
+                    ["singularity", "build", "--fakeroot", tmp_image, recipefile], step,
+                )
+            elif self._pull_needed(step, sif):
+                log.info(f"[{step.id}] srun singularity pull {sif}")
+                ecode = self._exec_srun(["singularity", "pull", tmp_image, img], step)
 
-        if "shub://" in step.uses or "library://" in step.uses:
-            build = False
-            img = step.uses
-            build_ctx_path = None
-
-        self._exec_srun(["rm", "-rf", self._container], step)
+            if ecode != 0:
+                return ecode
 
-        if build:
-            recipefile = self._get_recipe_file(build_ctx_path, cid)
-            log.info(f"[{step.id}] srun singularity build {self._container}")
-            self._exec_srun(
-                ["singularity", "build", "--fakeroot", self._container, recipefile,],
-                step,
-                cwd=os.path.dirname(recipefile),
-            )
-        else:
-            log.info(f"[{step.id}] srun singularity pull {self._container}")
-            self._exec_srun(["singularity", "pull", self._container, img], step)
+            # the store is expected to be in a file system that is shared with
+            # the nodes, so the image is moved to its place from here
+            if os.path.isfile(tmp_image):
+                os.replace(tmp_image, sif)
+            self._mark_used(sif)
 
-        cmd = self._create_cmd(step, cid)
+        cmd = self._create_cmd(step, sif)
         self._spawned_containers.add(cid)
 
+        env = self._get_singularity_env(step)
+
         if self._config.resman_opts.get(step.id, {}).get("mpi", True):
             log.info(f'[{step.id}] sbatch {" ".join(cmd)}')
-            ecode = self._exec_mpi(cmd, step)
+            ecode = self._exec_mpi(cmd, step, env=env)
         else:
             log.info(f'[{step.id}] srun {" ".join(cmd)}')
-            ecode = self._exec_srun(cmd, step, logging=True)
+            ecode = self._exec_srun(cmd, step, logging=True, env=env)
 
         self._spawned_containers.remove(cid)
         return ecode
-
-    def _create_cmd(self, step, cid):
-        env = self._prepare_environment(step)
-        for k, v in env.items():
-            os.environ[k] = str(v)
-
-        if step.runs:
-            commands = step.runs
-            cmd = ["singularity", "exec"]
-        else:
-            commands = step.args
-            cmd = ["singularity", "run"]
-
-        options = self._get_container_options()
-
-        cmd.extend(options)
-        cmd.extend([self._container])
-        cmd.extend(commands)
-
-        return cmd
@@ -1,8 +1,11 @@
+import fcntl
 import os
 import re
 
 import git
 
+from contextlib import contextmanager
+
 from popper.cli import log
 
 
@@ -55,9 +58,17 @@ def get_remote_url(repo=None):
     return url
 
 
-def clone(url, org, repo, repo_dir, version=None):
+def clone(url, org, repo, repo_dir, version=None, mirror_dir=None, shallow=False):
     """Clones a repository using Git. If ``repo_dir`` already exists, it pulls
-    from the remote.
+    from the remote. If ``mirror_dir`` is given, a bare mirror of the remote
+    repository is created (or updated) in that folder, and ``repo_dir`` is
+    cloned from (or pulled from) this local mirror, so that several clones of
+    the same repository download its contents only once and share objects
+    with the mirror. If ``shallow`` is True, only the requested version is
+    fetched, without its history, and ``mirror_dir`` is ignored.
+
+    If ``version`` is a tag or a commit SHA and it is already checked out in
+    ``repo_dir``, the remote is not contacted at all.
 
     Args:
       url(str): The remote git repository hosting service url.
@@ -66,11 +77,16 @@ def clone(url, org, repo, repo_dir, version=None):
       repo_dir(str): The path where to clone the repo.
       version(str, optional): The remote tag/branch to checkout. If version is
                               None, we use the default remote branch as version
+      mirror_dir(str, optional): The path to the bare mirror of the repo.
+      shallow(bool, optional): Fetch only the given version.
 
     Returns:
         None
 
     """
+    if is_checked_out(repo_dir, version):
+        log.debug(f"{version} is already checked out in {repo_dir}")
+        return
 
     def get_default_branch(r):
         """
@@ -86,29 +102,174 @@ def clone(url, org, repo, repo_dir, version=None):
             return version
         return r.remotes.origin.refs["HEAD"].ref.remote_head
 
+    repo_url = get_repo_url(url, org, repo)
+
+    if shallow:
+        shallow_fetch(repo_url, repo_dir, version)
+        return
+
+    if mirror_dir:
+        update_mirror(repo_url, mirror_dir)
+        repo_url = mirror_dir
+
     if os.path.exists(repo_dir):
         cloned_repo = git.Repo(repo_dir)
+        if cloned_repo.remotes.origin.url != repo_url:
+            cloned_repo.remotes.origin.set_url(repo_url)
         cloned_repo.remotes.origin.pull(get_default_branch(cloned_repo))
     else:
-        if "@" in url:
-            url += ":"
+        cloned_repo = git.Repo.clone_from(repo_url, repo_dir)
+
+    cloned_repo.git.checkout(get_default_branch(cloned_repo))
+    cloned_repo.close()
+
+
+def shallow_fetch(repo_url, repo_dir, version=None):
+    """Fetches a single branch, tag or commit from a remote repository,
+    without its history, and checks it out in ``repo_dir``, creating the
+    repository if it doesn't exist. If the remote refuses to send the given
+    version (e.g. an abbreviated commit SHA), the full history is fetched
+    instead.
+
+    Args:
+      repo_url(str): URL of the remote repository.
+      repo_dir(str): The path where to fetch the repo.
+      version(str, optional): The remote tag/branch/commit to checkout. If
+                              version is None, the default remote branch is
+                              fetched.
+
+    Returns:
+        None
+    """
+    if os.path.exists(repo_dir):
+        r = git.Repo(repo_dir)
+        if r.remotes.origin.url != repo_url:
+            r.remotes.origin.set_url(repo_url)
+    else:
+        r = git.Repo.init(repo_dir)
+        r.create_remote("origin", repo_url)
+
+    ref = version if version else "HEAD"
+
+    try:
+        r.git.fetch("--depth", "1", "origin", ref)
+    except git.GitCommandError:
+        log.debug(f"unable to fetch {ref} shallowly, fetching all history")
+        args = ["--tags", "origin", "+refs/heads/*:refs/remotes/origin/*"]
+        if os.path.exists(os.path.join(r.git_dir, "shallow")):
+            args.insert(0, "--unshallow")
+        r.git.fetch(*args)
+        r.git.checkout(ref)
+        r.close()
+        return
+
+    r.git.checkout("--force", "FETCH_HEAD")
+
+    # fetching a single ref only updates FETCH_HEAD, so tags are recreated
+    # locally in order for is_checked_out() to recognize them later on
+    with open(os.path.join(r.git_dir, "FETCH_HEAD")) as f:
+        if f"\ttag '{version}' of " in f.readline():
+            r.git.tag("--force", version, "FETCH_HEAD")
+
+    r.close()
+
+
+def is_checked_out(repo_dir, version):
+    """True if ``version`` is a tag or a commit SHA (possibly abbreviated) that
+    points to the commit checked out in ``repo_dir``. Branches are never
+    considered as checked out, since they might have moved in the remote.
+
+    Args:
+      repo_dir(str): The path to the repo.
+      version(str): The tag/SHA to check.
+
+    Returns:
+        bool: True if the version is checked out.
+    """
+    if not version or not os.path.isdir(os.path.join(repo_dir, ".git")):
+        return False
+
+    r = git.Repo(repo_dir)
+    try:
+        head = r.head.commit.hexsha
+    except ValueError:
+        # no commit has been checked out
+        r.close()
+        return False
+
+    if re.match(r"^[0-9a-f]{7,40}$", version) and head.startswith(version):
+        found = True
+    else:
+        found = any(t.name == version and t.commit.hexsha == head for t in r.tags)
+
+    r.close()
+    return found
+
+
+def update_mirror(repo_url, mirror_dir):
+    """Creates a bare mirror of a remote repository or, if it already exists,
+    fetches the latest changes from the remote into it. Concurrent updates of
+    the same mirror (e.g. from distinct popper processes) are serialized.
+
+    Args:
+      repo_url(str): URL of the remote repository.
+      mirror_dir(str): The path to the mirror.
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(mirror_dir), exist_ok=True)
+
+    with _lock(f"{mirror_dir}.lock"):
+        if os.path.exists(mirror_dir):
+            mirror = git.Repo(mirror_dir)
+            if mirror.remotes.origin.url != repo_url:
+                mirror.remotes.origin.set_url(repo_url)
+            mirror.git.fetch("--prune", "origin")
         else:
-            url += "/"
+            mirror = git.Repo.clone_from(repo_url, mirror_dir, mirror=True)
+        mirror.close()
 
-        # To obtain the authentication token if set as environment variable.
-        auth_token = os.getenv("GITHUB_API_TOKEN")
 
-        if auth_token is not None and "github" in url and "@" not in url:
-            # To verify the link of github for private repo support.
-            # The authentication token has to be added after protocol
-            # The length of protocol is 8 in case of https://
-            url = url[:8] + auth_token + "@" + url[8:]
+def get_repo_url(url, org, repo):
+    """Returns the URL of a repository, including the Github API token from
+    the ``GITHUB_API_TOKEN`` environment variable if it is defined.
 
-        repo_url = f"{url}{org}/{repo}"
-        cloned_repo = git.Repo.clone_from(repo_url, repo_dir)
+    Args:
+      url(str): The remote git repository hosting service url.
+      org(str): The org/user to which the repo belongs.
+      repo(str): The repo name.
 
-    cloned_repo.git.checkout(get_default_branch(cloned_repo))
-    cloned_repo.close()
+    Returns:
+      str: The URL of the repository.
+    """
+    if "@" in url:
+        url += ":"
+    else:
+        url += "/"
+
+    # To obtain the authentication token if set as environment variable.
+    auth_token = os.getenv("GITHUB_API_TOKEN")
+
+    if auth_token is not None and "github" in url and "@" not in url:
+        # To verify the link of github for private repo support.
+        # The authentication token has to be added after protocol
+        # The length of protocol is 8 in case of https://
+        url = url[:8] + auth_token + "@" + url[8:]
+
+    return f"{url}{org}/{repo}"
+
+
+@contextmanager
+def _lock(lock_file):
+    """Holds an exclusive lock on the given file for the duration of the
+    context."""
+    with open(lock_file, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def parse(url):
@@ -1,5 +1,9 @@
+import hashlib
+import json
 import os
 import re
+import stat
+import tempfile
 import yaml
 
 from distutils.spawn import find_executable
@@ -51,3 +55,138 @@ def key_value_to_flag(k, v, equals_symbol=False):
         else:
             flag += f"{k} {v}"
     return flag
+
+
+def file_digest(path):
+    """Returns the sha256 hex digest of the contents of the given file."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def paths_digest(root, paths):
+    """Computes a sha256 hex digest that identifies the contents of a list of
+    files and folders.
+
+    Args:
+      root(str): folder that the given paths are relative to.
+      paths(list): paths to files or folders. Folders are traversed
+        recursively and paths that do not exist are also accounted for.
+
+    Returns:
+      str: The hex digest.
+    """
+    h = hashlib.sha256()
+    for p in sorted(paths):
+        full_path = os.path.join(root, p)
+        if os.path.isfile(full_path):
+            files = [full_path]
+        elif os.path.isdir(full_path):
+            files = sorted(
+                os.path.join(d, f) for d, _, fs in os.walk(full_path) for f in fs
+            )
+        else:
+            h.update(f"{p}:missing\n".encode("utf-8"))
+            continue
+
+        for f in files:
+            rel_path = os.path.relpath(f, root)
+            if os.path.islink(f):
+                digest = os.readlink(f)
+            else:
+                digest = file_digest(f)
+            h.update(f"{rel_path}:{digest}\n".encode("utf-8"))
+
+    return h.hexdigest()
+
+
+def read_dockerignore(ctx_path):
+    """Returns the patterns in the .dockerignore file of a build context, or
+    an empty list if the context has no such file."""
+    dockerignore = os.path.join(ctx_path, ".dockerignore")
+    if not os.path.isfile(dockerignore):
+        return []
+    with open(dockerignore, "r") as f:
+        lines = [line.strip() for line in f.read().splitlines()]
+    return [line for line in lines if line and line[0] != "#"]
+
+
+def build_context_digest(ctx_path, index_file=None):
+    """Computes a sha256 hex digest that identifies the contents of a docker
+    build context, leaving out the files excluded by its .dockerignore file.
+
+    Args:
+      ctx_path(str): path to the build context.
+      index_file(str): optional JSON file where the digest of each file is
+        stored along with its size and modification time, so that files
+        that did not change since a previous call are not read again.
+
+    Returns:
+      str: The hex digest.
+    """
+    # imported here, so that steps of other engines don't load the docker SDK
+    from docker.utils.build import exclude_paths
+
+    patterns = read_dockerignore(ctx_path)
+
+    index = {}
+    if index_file and os.path.isfile(index_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+
+    new_index = {}
+    h = hashlib.sha256()
+    if os.path.isdir(ctx_path):
+        paths = sorted(exclude_paths(ctx_path, patterns))
+    else:
+        paths = []
+
+    for p in paths:
+        full_path = os.path.join(ctx_path, p)
+        st = os.lstat(full_path)
+        if stat.S_ISLNK(st.st_mode):
+            digest = os.readlink(full_path)
+        elif stat.S_ISREG(st.st_mode):
+            entry = index.get(p, None)
+            if entry and entry[:2] == [st.st_size, st.st_mtime_ns]:
+                digest = entry[2]
+            else:
+                digest = file_digest(full_path)
+            new_index[p] = [st.st_size, st.st_mtime_ns, digest]
+        else:
+            continue
+        h.update(f"{p}:{stat.S_IMODE(st.st_mode):o}:{digest}\n".encode("utf-8"))
+
+    if index_file and new_index != index:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(index_file))
+        with os.fdopen(fd, "w") as f:
+            json.dump(new_index, f)
+        os.replace(tmp_file, index_file)
+
+    return h.hexdigest()
+
+
+def parse_duration(duration):
+    """Parses a duration such as "90s", "15m", "1h30m" or "2d". A number
+    without units is interpreted as seconds; fails if the duration is invalid.
+
+    Args:
+      duration(str): The duration.
+
+    Returns:
+      int: The duration in seconds.
+    """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+    duration = str(duration).strip()
+    if duration.isdigit():
+        return int(duration)
+
+    parts = re.findall(r"(\d+)([smhdw])", duration)
+    if not parts or "".join(n + u for n, u in parts) != duration:
+        log.fail(f"Invalid duration '{duration}'.")
+
+    return sum(int(n) * units[u] for n, u in parts)
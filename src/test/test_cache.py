@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+
+from popper.cache import StepCache
+from popper.cli import log
+from popper.config import ConfigLoader
+from popper.parser import WorkflowParser
+from popper.runner import WorkflowRunner
+
+from .test_common import PopperTest
+
+
+class TestStepCache(PopperTest):
+    def setUp(self):
+        log.setLevel("CRITICAL")
+        self._cache_dir = tempfile.mkdtemp()
+        os.environ["POPPER_CACHE_DIR"] = self._cache_dir
+
+    def tearDown(self):
+        os.environ.pop("POPPER_CACHE_DIR")
+        shutil.rmtree(self._cache_dir, ignore_errors=True)
+        log.setLevel("NOTSET")
+
+    def test_is_cacheable(self):
+        wf = WorkflowParser.parse(
+            wf_data={"steps": [{"uses": "sh", "outputs": ["a"]}, {"uses": "sh"}]}
+        )
+        self.assertTrue(StepCache.is_cacheable(wf.steps[0]))
+        self.assertFalse(StepCache.is_cacheable(wf.steps[1]))
+
+    def test_key(self):
+        repo = self.mk_repo()
+        conf = ConfigLoader.load(workspace_dir=repo.working_dir)
+        cache = StepCache(conf)
+
+        wf_data = {"steps": [{"uses": "sh", "runs": ["ls"], "inputs": ["README.md"]}]}
+        step = WorkflowParser.parse(wf_data=wf_data).steps[0]
+        key = cache.key(step, "host")
+        self.assertEqual(key, cache.key(step, "host"))
+        self.assertNotEqual(key, cache.key(step, "docker"))
+        self.assertNotEqual(key, cache.key(step, "host", "sha256:1234"))
+
+        # changing an input changes the key
+        with open(os.path.join(repo.working_dir, "README.md"), "a") as f:
+            f.write("more content\n")
+        self.assertNotEqual(key, cache.key(step, "host"))
+
+        # and so does changing the step
+        wf_data["steps"][0]["runs"] = ["ls", "-l"]
+        other_step = WorkflowParser.parse(wf_data=wf_data).steps[0]
+        self.assertNotEqual(cache.key(step, "host"), cache.key(other_step, "host"))
+
+        repo.close()
+        shutil.rmtree(repo.working_dir, ignore_errors=True)
+
+    def test_paths_outside_workspace(self):
+        repo = self.mk_repo()
+        conf = ConfigLoader.load(workspace_dir=repo.working_dir)
+        cache = StepCache(conf)
+
+        outside_dir = self.mk_tmpdir()
+        outside_file = os.path.join(outside_dir, "out.txt")
+        with open(outside_file, "w") as f:
+            f.write("content")
+
+        for path in [outside_file, "..", ".", "a/../../b"]:
+            for attr in ["inputs", "outputs"]:
+                wf_data = {"steps": [{"uses": "sh", "runs": ["ls"], attr: [path]}]}
+                step = WorkflowParser.parse(wf_data=wf_data).steps[0]
+                if attr == "inputs":
+                    self.assertRaises(SystemExit, cache.key, step, "host")
+                else:
+                    self.assertRaises(SystemExit, cache.restore, "k", step)
+                    self.assertRaises(SystemExit, cache.store, "k", step)
+
+        # nothing outside of the workspace was touched
+        self.assertTrue(os.path.isfile(outside_file))
+        self.assertTrue(os.path.isdir(repo.working_dir))
+
+        # paths are normalized
+        wf_data = {"steps": [{"uses": "sh", "outputs": ["./a/../b/"]}]}
+        step = WorkflowParser.parse(wf_data=wf_data).steps[0]
+        self.assertEqual(StepCache._paths(step, "outputs"), ["b"])
+
+        repo.close()
+        shutil.rmtree(repo.working_dir, ignore_errors=True)
+
+    def test_run_cached_step(self):
+        repo = self.mk_repo()
+        counter = os.path.join(self._cache_dir, "counter")
+        wf_data = {
+            "steps": [
+                {
+                    "uses": "sh",
+                    "runs": [
+                        "bash",
+                        "-c",
+                        f"echo x >> {counter}; mkdir -p out; cat README.md > out/a",
+                    ],
+                    "inputs": ["README.md"],
+                    "outputs": ["out"],
+                }
+            ]
+        }
+        out_file = os.path.join(repo.working_dir, "out", "a")
+
+        conf = ConfigLoader.load(workspace_dir=repo.working_dir)
+        with WorkflowRunner(conf) as r:
+            r.run(WorkflowParser.parse(wf_data=wf_data))
+            shutil.rmtree(os.path.join(repo.working_dir, "out"))
+
+            # second execution restores outputs without running the step
+            r.run(WorkflowParser.parse(wf_data=wf_data))
+            self.assertTrue(os.path.isfile(out_file))
+            with open(counter, "r") as f:
+                self.assertEqual(1, len(f.readlines()))
+
+            # modifying an input invalidates the entry
+            with open(os.path.join(repo.working_dir, "README.md"), "w") as f:
+                f.write("new content\n")
+            r.run(WorkflowParser.parse(wf_data=wf_data))
+            with open(out_file, "r") as f:
+                self.assertEqual("new content\n", f.read())
+            with open(counter, "r") as f:
+                self.assertEqual(2, len(f.readlines()))
+
+        # cache is ignored if asked to
+        conf = ConfigLoader.load(workspace_dir=repo.working_dir, skip_cache=True)
+        with WorkflowRunner(conf) as r:
+            r.run(WorkflowParser.parse(wf_data=wf_data))
+            with open(counter, "r") as f:
+                self.assertEqual(3, len(f.readlines()))
+
+        repo.close()
+        shutil.rmtree(repo.working_dir, ignore_errors=True)
@@ -1,10 +1,17 @@
 import os
+import shutil
 import tempfile
 import git
 import unittest
 
 
 class PopperTest(unittest.TestCase):
+    def mk_tmpdir(self):
+        """creates a temporary directory that is removed when the test ends"""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir, ignore_errors=True)
+        return tempdir
+
     def mk_repo(self, tag=None):
         """creates a test repo in a random temp file. Equivalent to:
         REPODIR=/tmp/<random>
@@ -19,7 +26,7 @@ class PopperTest(unittest.TestCase):
         git commit -m 'second commit'
         git tag <tag>
         """
-        tempdir = tempfile.mkdtemp()
+        tempdir = self.mk_tmpdir()
         repo = git.Repo.init(tempdir)
 
         # touch README file
@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+
+from click.testing import CliRunner
+
+from popper.cli import log
+from popper.commands import cmd_gc
+from popper.config import ConfigLoader
+from popper.gc import GarbageCollector
+from popper.parser import WorkflowParser
+from popper.runner import WorkflowRunner
+
+from .test_common import PopperTest
+
+
+class TestGarbageCollector(PopperTest):
+    def setUp(self):
+        log.setLevel("CRITICAL")
+        self._cache_dir = tempfile.mkdtemp()
+        os.environ["POPPER_CACHE_DIR"] = self._cache_dir
+
+    def tearDown(self):
+        os.environ.pop("POPPER_CACHE_DIR")
+        shutil.rmtree(self._cache_dir, ignore_errors=True)
+        log.setLevel("NOTSET")
+
+    def _mk_file(self, *path):
+        os.makedirs(os.path.join(self._cache_dir, *path[:-1]), exist_ok=True)
+        with open(os.path.join(self._cache_dir, *path), "w") as f:
+            f.write("content")
+
+    def _mk_workspaces(self):
+        """Creates resources for a workspace that exists, one that was
+        removed and one that was never recorded."""
+        confs = []
+        for _ in range(2):
+            conf = ConfigLoader.load(
+                engine_name="singularity", workspace_dir=self.mk_tmpdir()
+            )
+            GarbageCollector.record_workspace(conf)
+            self._mk_file(conf.wid, "github.com", "org", "repo", "README.md")
+            self._mk_file("singularity", f"{conf.wid}-0", "popper_one.sif")
+            confs.append(conf)
+
+        self._mk_file("0123abcd", "github.com", "org", "repo", "README.md")
+        self._mk_file("mirrors", "github.com", "org", "repo.git", "HEAD")
+
+        shutil.rmtree(confs[1].workspace_dir)
+        return confs
+
+    def test_record_workspace(self):
+        repo = self.mk_repo()
+        conf = ConfigLoader.load(workspace_dir=repo.working_dir)
+        wf = WorkflowParser.parse(wf_data={"steps": [{"uses": "sh", "runs": ["true"]}]})
+        with WorkflowRunner(conf) as r:
+            r.run(wf)
+
+        workspaces = GarbageCollector._read_workspaces(self._cache_dir)
+        self.assertEqual(
+            workspaces[conf.wid]["workspace_dir"], os.path.realpath(repo.working_dir)
+        )
+
+    def test_find(self):
+        live, dead = self._mk_workspaces()
+
+        gc = GarbageCollector(live)
+        resources = {(r.kind, r.wid): r for r in gc.find()}
+        self.assertEqual(
+            sorted(resources),
+            sorted(
+                [
+                    ("clone", "0123abcd"),
+                    ("clone", dead.wid),
+                    ("clone", live.wid),
+                    ("sif", f"{dead.wid}-0"),
+                    ("sif", f"{live.wid}-0"),
+                ]
+            ),
+        )
+        self.assertEqual(resources[("clone", live.wid)].size, len("content"))
+
+        # only the resources of the removed workspace are garbage
+        garbage = sorted(r.wid for r in resources.values() if gc.is_garbage(r))
+        self.assertEqual(garbage, [dead.wid, f"{dead.wid}-0"])
+
+        # unless they are older than the given age
+        garbage = [r for r in resources.values() if gc.is_garbage(r, 0)]
+        self.assertEqual(len(garbage), 5)
+        garbage = [r for r in resources.values() if gc.is_garbage(r, 3600)]
+        self.assertEqual(len(garbage), 2)
+
+        self.assertEqual(GarbageCollector.collect(garbage), 0)
+        self.assertEqual(len(gc.find()), 3)
+
+    def test_gc_command(self):
+        live, dead = self._mk_workspaces()
+
+        result = CliRunner().invoke(cmd_gc.cli, ["-e", "singularity", "--dry-run"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(os.path.isdir(os.path.join(self._cache_dir, dead.wid)))
+
+        result = CliRunner().invoke(cmd_gc.cli, ["-e", "singularity"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertFalse(os.path.isdir(os.path.join(self._cache_dir, dead.wid)))
+        self.assertTrue(os.path.isdir(os.path.join(self._cache_dir, live.wid)))
+
+        result = CliRunner().invoke(
+            cmd_gc.cli, ["-e", "singularity", "--older-than", "0s"]
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertFalse(os.path.isdir(os.path.join(self._cache_dir, live.wid)))
+        self.assertTrue(os.path.isdir(os.path.join(self._cache_dir, "mirrors")))
+
+    def test_find_sif_store(self):
+        self._mk_file("singularity", "images", "0123456789abcdef.sif")
+        self._mk_file("singularity", "images", ".0123456789abcdef.sif.tmp")
+        self._mk_file("singularity", "recipes", "0123456789abcdef")
+
+        conf = ConfigLoader.load(engine_name="singularity")
+        gc = GarbageCollector(conf)
+        resources = [r for r in gc.find() if r.kind == "sif"]
+        self.assertEqual(len(resources), 1)
+        self.assertIsNone(resources[0].wid)
+
+        # images in the store are removed when they have not been used lately
+        self.assertFalse(gc.is_garbage(resources[0], 3600))
+        sif = resources[0].name
+        os.utime(sif, (0, 0))
+        resources = [r for r in gc.find() if r.kind == "sif"]
+        self.assertTrue(gc.is_garbage(resources[0], 3600))
@@ -123,6 +123,38 @@ class TestWorkflow(unittest.TestCase):
         self.assertEqual(1, len(wf.steps))
         self.assertEqual("2", wf.steps[0].id)
 
+    def test_needs(self):
+        wf_data = {
+            "steps": [
+                {"uses": "foo", "id": "one"},
+                {"uses": "bar", "id": "two", "needs": []},
+                {"uses": "baz", "id": "three", "needs": ["one", "two"]},
+                {"uses": "baz", "id": "four"},
+            ]
+        }
+        wf = WorkflowParser.parse(wf_data=wf_data)
+        self.assertEqual(
+            {"one": set(), "two": set(), "three": {"one", "two"}, "four": {"three"},},
+            WorkflowParser.get_dependencies(wf),
+        )
+
+        # references to skipped steps are dropped
+        wf = WorkflowParser.parse(wf_data=wf_data, skipped_steps=["two"])
+        self.assertEqual(("one",), wf.steps[1].needs)
+
+        # unknown step
+        wf_data = {"steps": [{"uses": "foo", "id": "one", "needs": ["two"]}]}
+        self.assertRaises(SystemExit, WorkflowParser.parse, **{"wf_data": wf_data})
+
+        # cycle
+        wf_data = {
+            "steps": [
+                {"uses": "foo", "id": "one", "needs": ["two"]},
+                {"uses": "bar", "id": "two", "needs": ["one"]},
+            ]
+        }
+        self.assertRaises(SystemExit, WorkflowParser.parse, **{"wf_data": wf_data})
+
     def test_add_missing_ids(self):
         wf_data = {"steps": [{"uses": "foo"}, {"uses": "bar"}]}
         # skip one step
@@ -169,23 +169,35 @@ class TestStepRunner(PopperTest):
             self.assertEqual(build_sources, None)
 
         step = Box({"uses": "./", "args": ["ls"], "id": "one",}, default_box=True,)
-        conf = ConfigLoader.load(workspace_dir="/tmp")
+        ws_dir = self.mk_tmpdir()
+        with open(os.path.join(ws_dir, "Dockerfile"), "w") as f:
+            f.write("FROM alpine:3.9\n")
+        conf = ConfigLoader.load(workspace_dir=ws_dir)
         with StepRunner(config=conf) as r:
             build, _, img, tag, build_ctx_path = r._get_build_info(step)
             self.assertEqual(build, True)
             self.assertEqual(img, "popper_one_step")
-            self.assertEqual(tag, "na")
-            self.assertEqual(build_ctx_path, f"{os.path.realpath('/tmp')}/./")
+            self.assertEqual(len(tag), 12)
+            self.assertEqual(build_ctx_path, f"{os.path.realpath(ws_dir)}/./")
 
-        # test within a git repo
+            # the tag only changes when the contents of the context change
+            self.assertEqual(tag, r._get_build_info(step)[3])
+            with open(os.path.join(ws_dir, "hello.txt"), "w") as f:
+                f.write("hello")
+            self.assertNotEqual(tag, r._get_build_info(step)[3])
+
+        # within a git repo, the tag doesn't depend on the commit
         repo = self.mk_repo()
+        with open(os.path.join(repo.working_dir, ".dockerignore"), "w") as f:
+            f.write(".git\n")
         conf = ConfigLoader.load(workspace_dir=repo.working_dir)
         with StepRunner(config=conf) as r:
             build, _, img, tag, build_ctx_path = r._get_build_info(step)
             self.assertEqual(build, True)
             self.assertEqual(img, "popper_one_step")
-            self.assertEqual(tag, scm.get_sha(repo, short=7))
             self.assertEqual(build_ctx_path, f"{os.path.realpath(repo.working_dir)}/./")
+            repo.index.commit("empty commit")
+            self.assertEqual(tag, r._get_build_info(step)[3])
 
         step = Box(
             {
@@ -249,6 +261,7 @@ class TestStepRunner(PopperTest):
                     "detach": True,
                     "stdin_open": False,
                     "tty": False,
+                    "labels": {"popper.wid": config.wid, "popper.step": "one"},
                     "privileged": True,
                     "hostname": "popper.local",
                     "domainname": "www.example.org",
@@ -280,6 +293,7 @@ class TestStepRunner(PopperTest):
                     "detach": False,
                     "stdin_open": True,
                     "tty": True,
+                    "labels": {"popper.wid": config.wid, "popper.step": "one"},
                     "privileged": True,
                     "hostname": "popper.local",
                     "domainname": "www.example.org",
@@ -1,17 +1,34 @@
+import http.server
+import io
+import json
 import os
 import shutil
+import socketserver
+import struct
+import tempfile
+import threading
 import time
 import unittest
+import urllib.parse
 
 from testfixtures import LogCapture
 from subprocess import Popen
+from unittest.mock import Mock, patch
 
 import popper.utils as pu
 
 from popper.config import ConfigLoader
+from popper.gc import GarbageCollector
 from popper.parser import WorkflowParser
 from popper.runner import WorkflowRunner
-from popper.runner_host import HostRunner, DockerRunner, PodmanRunner, SingularityRunner
+from popper.runner_host import (
+    HostRunner,
+    DockerRunner,
+    LogFrameReader,
+    OutputPump,
+    PodmanRunner,
+    SingularityRunner,
+)
 from popper.cli import log as log
 from .test_common import PopperTest
 
@@ -66,6 +83,98 @@ class TestHostHostRunner(PopperTest):
         repo.close()
         shutil.rmtree(repo.working_dir, ignore_errors=True)
 
+    def test_host_run_concurrently(self):
+        repo = self.mk_repo()
+        conf = ConfigLoader.load(workspace_dir=repo.working_dir, jobs=2)
+
+        # step 'one' only succeeds if 'two' runs at the same time
+        wait_for_two = (
+            "for i in $(seq 50); do test -f two.txt && exit 0; sleep 0.1; done"
+        )
+        wf_data = {
+            "steps": [
+                {
+                    "id": "one",
+                    "uses": "sh",
+                    "runs": ["bash", "-c", wait_for_two + "; exit 1"],
+                },
+                {"id": "two", "uses": "sh", "runs": ["touch", "two.txt"], "needs": []},
+                {
+                    "id": "three",
+                    "uses": "sh",
+                    "runs": ["touch", "three.txt"],
+                    "needs": ["one", "two"],
+                },
+                {"id": "four", "uses": "sh", "runs": ["bash", "-c", "exit 78"]},
+                {"id": "five", "uses": "sh", "runs": ["touch", "five.txt"]},
+            ]
+        }
+        with WorkflowRunner(conf) as r:
+            r.run(WorkflowParser.parse(wf_data=wf_data))
+
+        self.assertTrue(os.path.isfile(os.path.join(repo.working_dir, "three.txt")))
+        self.assertFalse(os.path.isfile(os.path.join(repo.working_dir, "five.txt")))
+
+        # a failing step fails the workflow
+        wf_data = {
+            "steps": [
+                {"id": "one", "uses": "sh", "runs": ["bash", "-c", "exit 1"]},
+                {"id": "two", "uses": "sh", "runs": ["true"], "needs": []},
+            ]
+        }
+        with WorkflowRunner(conf) as r:
+            self.assertRaises(SystemExit, r.run, WorkflowParser.parse(wf_data=wf_data))
+
+        # and stops the steps that are still running
+        wf_data = {
+            "steps": [
+                {"id": "one", "uses": "sh", "runs": ["bash", "-c", "sleep 1; exit 1"]},
+                {"id": "two", "uses": "sh", "runs": ["sleep", "60"], "needs": []},
+            ]
+        }
+        start = time.time()
+        with WorkflowRunner(conf) as r:
+            self.assertRaises(SystemExit, r.run, WorkflowParser.parse(wf_data=wf_data))
+        self.assertLess(time.time() - start, 30)
+
+        repo.close()
+        shutil.rmtree(repo.working_dir, ignore_errors=True)
+
+    def test_host_run_matrix(self):
+        repo = self.mk_repo()
+        conf = ConfigLoader.load(workspace_dir=repo.working_dir, jobs=2)
+
+        wfs = []
+        for value in ["a", "b", "c"]:
+            wf_data = {
+                "steps": [
+                    {"id": "one", "uses": "sh", "runs": ["touch", "$_V.one"]},
+                    {"id": "two", "uses": "sh", "runs": ["test", "$_V", "!=", "b"]},
+                    {"id": "three", "uses": "sh", "runs": ["touch", "$_V.three"]},
+                ]
+            }
+            wfs.append(
+                WorkflowParser.parse(wf_data=wf_data, substitutions=[f"_V={value}"])
+            )
+
+        with WorkflowRunner(conf) as r:
+            # element 'b' fails, so the workflow fails
+            self.assertRaises(SystemExit, r.run_matrix, wfs)
+
+        for name, exists in [
+            ("a.one", True),
+            ("b.one", True),
+            ("c.one", True),
+            ("a.three", True),
+            ("b.three", False),
+            ("c.three", True),
+        ]:
+            path = os.path.join(repo.working_dir, name)
+            self.assertEqual(os.path.isfile(path), exists)
+
+        repo.close()
+        shutil.rmtree(repo.working_dir, ignore_errors=True)
+
     def test_exec_cmd(self):
         cmd = ["echo", "hello-world"]
         pid, ecode, output = HostRunner._exec_cmd(cmd, logging=False)
@@ -92,6 +201,88 @@ class TestHostHostRunner(PopperTest):
         _, _, _ = HostRunner._exec_cmd(["sleep", "2"], pids=_pids)
         self.assertEqual(len(_pids), 1)
 
+        # output is logged in batches of lines and '\r' is treated as newline
+        with LogCapture("popper") as logc:
+            _, ecode, _ = HostRunner._exec_cmd(["printf", "a \\nb\\r\\nc\\rd\\n"])
+            self.assertEqual(ecode, 0)
+            logc.check_present(("popper", "STEP_INFO", "a\nb\nc\nd"))
+
+        # lines over the rate limit are discarded
+        cmd = ["seq", "1000"]
+        with LogCapture("popper") as logc:
+            _, ecode, _ = HostRunner._exec_cmd(cmd, rate_limit=10)
+            self.assertEqual(ecode, 0)
+            step_output = [
+                r.getMessage() for r in logc.records if r.levelname == "STEP_INFO"
+            ]
+            self.assertEqual(
+                "\n".join(step_output).split("\n")[:10], [str(i) for i in range(1, 11)]
+            )
+            self.assertLess(len("\n".join(step_output).split("\n")), 1000)
+
+        # or written to a spill file
+        spill_file = os.path.join(self.mk_tmpdir(), "spill.log")
+        with LogCapture("popper") as logc:
+            _, ecode, _ = HostRunner._exec_cmd(
+                cmd, rate_limit=10, spill_file=spill_file
+            )
+            step_output = [
+                r.getMessage() for r in logc.records if r.levelname == "STEP_INFO"
+            ]
+            logged = "\n".join(step_output).split("\n")
+        with open(spill_file, "r") as f:
+            spilled = f.read().splitlines()
+        self.assertEqual(
+            sorted(logged + spilled, key=int), [str(i) for i in range(1, 1001)]
+        )
+
+        # output is not truncated when captured
+        _, _, output = HostRunner._exec_cmd(cmd, logging=False, rate_limit=10)
+        self.assertEqual(output.split("\n"), [str(i) for i in range(1, 1001)])
+
+    def test_output_pump(self):
+        class SlowStream(object):
+            def __init__(self, chunks):
+                self._chunks = list(chunks)
+
+            def read1(self, size):
+                time.sleep(0.01)
+                if not self._chunks:
+                    return b""
+                chunk = self._chunks.pop(0)
+                if isinstance(chunk, Exception):
+                    raise chunk
+                return chunk
+
+        # lines split across chunks are reassembled
+        stream = SlowStream([b"on", b"e\ntw", b"o\nthree"])
+        output = OutputPump(logging=False).drain(stream)
+        self.assertEqual(output, ["one", "two", "three"])
+
+        # chunks read while a batch is being logged are logged together
+        stream = SlowStream([b"%d\n" % i for i in range(50)])
+        pump = OutputPump()
+        feed = pump.feed
+
+        def slow_feed(chunk):
+            time.sleep(0.1)
+            feed(chunk)
+
+        with patch.object(pump, "feed", side_effect=slow_feed) as mock_feed:
+            with LogCapture("popper") as logc:
+                pump.drain(stream)
+        self.assertLess(mock_feed.call_count, 50)
+        step_output = [
+            r.getMessage() for r in logc.records if r.levelname == "STEP_INFO"
+        ]
+        self.assertEqual(
+            "\n".join(step_output).split("\n"), [str(i) for i in range(50)]
+        )
+
+        # errors while reading are raised by drain()
+        stream = SlowStream([b"one\n", OSError("broken")])
+        self.assertRaises(OSError, OutputPump(logging=False).drain, stream)
+
     def test_stop_running_tasks(self):
         with HostRunner() as hr:
             with Popen(["sleep", "2000"]) as p:
@@ -166,6 +357,299 @@ class TestHostDockerRunner(PopperTest):
             self.assertEqual(c2.status, "created")
             dclient.close()
 
+    def test_prefetch(self):
+        config = ConfigLoader.load()
+        steps = [
+            Box({"id": str(i), "uses": uses}, default_box=True)
+            for i, uses in enumerate(
+                ["docker://alpine:3.9", "docker://alpine:3.9", "docker://debian:10"]
+            )
+        ]
+        prepared = []
+
+        def prepare_image(step, build, img, tag, build_ctx_path):
+            time.sleep(0.2)
+            prepared.append(f"{img}:{tag}")
+
+        with DockerRunner(init_docker_client=False, config=config) as dr:
+            dr._prepare_image = prepare_image
+            dr.prefetch(steps)
+
+            # steps wait for the image that is being prefetched
+            for step in steps:
+                build, _, img, tag, build_ctx_path = dr._get_build_info(step)
+                dr._prepare_image_once(step, build, img, tag, build_ctx_path)
+                self.assertIn(f"{img}:{tag}", prepared)
+
+        self.assertEqual(sorted(prepared), ["alpine:3.9", "debian:10"])
+
+        # exiting waits for the image that is being prepared, which fails, and
+        # drops the ones that are pending
+        def fail_prepare_image(step, build, img, tag, build_ctx_path):
+            time.sleep(0.2)
+            prepared.append(f"{img}:{tag}")
+            raise Exception("pull failed")
+
+        prepared.clear()
+        with patch.object(DockerRunner, "_prefetch_jobs", 1):
+            with DockerRunner(init_docker_client=False, config=config) as dr:
+                dr._prepare_image = fail_prepare_image
+                dr.prefetch(steps)
+                prefetches = list(dr._prefetches)
+
+        self.assertEqual(prepared, ["alpine:3.9"])
+        self.assertIsInstance(prefetches[0][1].exception(), Exception)
+        self.assertTrue(prefetches[1][1].cancelled())
+        self.assertEqual(DockerRunner._images, {})
+
+    def test_pull_needed(self):
+        cache_dir = self.mk_tmpdir()
+        os.environ["POPPER_CACHE_DIR"] = cache_dir
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {
+                    "name": "docker",
+                    "options": {"pull_policy": "if-not-present"},
+                }
+            }
+        )
+        os.environ.pop("POPPER_CACHE_DIR")
+
+        step = Box({"id": "one", "uses": "docker://alpine:3.9"}, default_box=True)
+        image = Mock(id="sha256:1", attrs={"RepoDigests": ["alpine@sha256:a"]})
+
+        with DockerRunner(init_docker_client=False, config=config) as dr:
+            dr._d = Mock()
+            dr._d.images.get.side_effect = docker.errors.ImageNotFound("")
+            self.assertTrue(dr._pull_needed(step, "alpine", "3.9"))
+
+            # engine option
+            dr._d.images.get.side_effect = None
+            dr._d.images.get.return_value = image
+            self.assertFalse(dr._pull_needed(step, "alpine", "3.9"))
+
+            # step attribute
+            step = Box(
+                {"id": "one", "uses": "docker://alpine:3.9", "pull_policy": "always"},
+                default_box=True,
+            )
+            self.assertTrue(dr._pull_needed(step, "alpine", "3.9"))
+
+            step.pull_policy = "if-older-than=1h"
+            self.assertTrue(dr._pull_needed(step, "alpine", "3.9"))
+            dr._record_pull("alpine", "3.9")
+            self.assertFalse(dr._pull_needed(step, "alpine", "3.9"))
+
+            # local image differs from the one that was pulled
+            image.id = "sha256:2"
+            self.assertTrue(dr._pull_needed(step, "alpine", "3.9"))
+
+            step.pull_policy = "sometimes"
+            self.assertRaises(SystemExit, dr._pull_needed, step, "alpine", "3.9")
+
+            # the option is not passed to docker
+            kwargs = dr._get_container_kwargs(step, "alpine:3.9", "c1")
+            self.assertNotIn("pull_policy", kwargs)
+
+    def test_build_skipped_if_context_unchanged(self):
+        cache_dir = self.mk_tmpdir()
+        os.environ["POPPER_CACHE_DIR"] = cache_dir
+        ws_dir = self.mk_tmpdir()
+        with open(os.path.join(ws_dir, "Dockerfile"), "w") as f:
+            f.write("FROM alpine:3.9\n")
+        config = ConfigLoader.load(workspace_dir=ws_dir)
+        os.environ.pop("POPPER_CACHE_DIR")
+
+        step = Box({"id": "one", "uses": "./"}, default_box=True)
+
+        with DockerRunner(init_docker_client=False, config=config) as dr:
+            build, _, img, tag, build_ctx_path = dr._get_build_info(step)
+            digest = dr._get_context_digest(build_ctx_path)
+            self.assertTrue(digest.startswith(tag))
+
+            dr._d = Mock()
+            dr._d.api.build.return_value = []
+            dr._d.images.get.return_value = Mock(labels={"popper.context-hash": digest})
+            dr._prepare_image(step, build, img, tag, build_ctx_path)
+            dr._d.api.build.assert_not_called()
+
+            # images built from other contents, or not by popper, are rebuilt
+            for labels in [{"popper.context-hash": "other"}, None]:
+                dr._d.images.get.return_value = Mock(labels=labels)
+                dr._prepare_image(step, build, img, tag, build_ctx_path)
+                _, kwargs = dr._d.api.build.call_args
+                self.assertEqual(kwargs["labels"], {"popper.context-hash": digest})
+            self.assertEqual(dr._d.api.build.call_count, 2)
+
+    @patch("popper.runner_host.assert_executable_exists")
+    @patch("popper.runner_host.HostRunner._exec_cmd", return_value=(1, 0, ""))
+    def test_buildx_build(self, exec_cmd, _):
+        cache_dir = self.mk_tmpdir()
+        os.environ["POPPER_CACHE_DIR"] = cache_dir
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {
+                    "name": "docker",
+                    "options": {"buildkit": True, "buildkit_builder": "ci"},
+                }
+            }
+        )
+        os.environ.pop("POPPER_CACHE_DIR")
+
+        step = Box({"id": "one", "uses": "popperized/bin/sh@master"}, default_box=True)
+        bk_cache = os.path.join(cache_dir, "buildkit", "popperized_bin")
+
+        with DockerRunner(init_docker_client=False, config=config) as dr:
+            dr._d = Mock()
+            dr._d.images.get.side_effect = docker.errors.ImageNotFound("")
+            dr._prepare_image(step, True, "popperized/bin", "master", "/tmp/ctx")
+            dr._d.api.build.assert_not_called()
+
+            cmd = exec_cmd.call_args[0][0]
+            self.assertEqual(cmd[:5], ["docker", "buildx", "build", "--builder", "ci"])
+            self.assertNotIn("--cache-from", cmd)
+            self.assertIn(f"type=local,dest={bk_cache},mode=max", cmd)
+            self.assertIn("--load", cmd)
+            self.assertEqual(cmd[-1], "/tmp/ctx")
+
+            # once exported, the cache is imported by later builds
+            os.makedirs(bk_cache)
+            open(os.path.join(bk_cache, "index.json"), "w").close()
+            dr._prepare_image(step, True, "popperized/bin", "master", "/tmp/ctx")
+            cmd = exec_cmd.call_args[0][0]
+            self.assertIn(f"type=local,src={bk_cache}", cmd)
+
+            # the options are not passed to docker
+            kwargs = dr._get_container_kwargs(step, "popperized/bin:master", "c1")
+            self.assertNotIn("buildkit", kwargs)
+            self.assertNotIn("buildkit_builder", kwargs)
+
+            exec_cmd.return_value = (1, 1, "")
+            self.assertRaises(
+                SystemExit,
+                dr._prepare_image,
+                step,
+                True,
+                "popperized/bin",
+                "master",
+                "/tmp/ctx",
+            )
+
+    def test_run_in_pool(self):
+        config = ConfigLoader.load(
+            config_file={"engine": {"name": "docker", "options": {"warm_pool": True}}},
+            skip_pull=True,
+        )
+        steps = [
+            Box(
+                {"id": "a", "uses": "docker://alpine:3.9", "args": ["ls"]},
+                default_box=True,
+            ),
+            Box(
+                {
+                    "id": "b",
+                    "uses": "docker://alpine:3.9",
+                    "runs": ["sh", "-c"],
+                    "args": ["exit 3"],
+                    "env": {"FOO": "bar"},
+                    "dir": "/tmp",
+                },
+                default_box=True,
+            ),
+            Box(
+                {
+                    "id": "c",
+                    "uses": "docker://alpine:3.9",
+                    "options": {"volumes": ["/data:/data"]},
+                },
+                default_box=True,
+            ),
+        ]
+        image = Mock(attrs={"Config": {"Entrypoint": None, "Cmd": ["/bin/sh"]}})
+        pool_container = Mock(status="running", id="pool")
+
+        with DockerRunner(init_docker_client=False, config=config) as dr:
+            dr._d = Mock()
+            dr._d.containers.list.return_value = []
+            dr._d.containers.create.return_value = pool_container
+            dr._d.images.get.return_value = image
+            dr._d.api.exec_create.return_value = {"Id": "exec"}
+            dr._d.api.exec_start.return_value = [b"output\n"]
+
+            dr._d.api.exec_inspect.return_value = {"ExitCode": 0}
+            self.assertEqual(dr.run(steps[0]), 0)
+            dr._d.api.exec_inspect.return_value = {"ExitCode": 3}
+            self.assertEqual(dr.run(steps[1]), 3)
+
+            # output is logged by lines, even if chunks split lines and
+            # multibyte characters
+            dr._d.api.exec_start.return_value = [b"caf\xc3", b"\xa9\nsec", b"ond\n"]
+            with LogCapture("popper") as logc:
+                self.assertEqual(dr.run(steps[1]), 3)
+                step_output = [
+                    r.getMessage() for r in logc.records if r.levelname == "STEP_INFO"
+                ]
+                self.assertEqual("\n".join(step_output), "caf\u00e9\nsecond")
+
+            # errors of the docker API make the step fail
+            dr._d.api.exec_create.side_effect = docker.errors.APIError("error")
+            with patch.object(log, "fail") as mock_fail:
+                self.assertEqual(dr.run(steps[1]), 1)
+            mock_fail.assert_called_once()
+            dr._d.api.exec_create.side_effect = None
+
+            # steps with the same image and options share the container
+            self.assertEqual(dr._d.containers.create.call_count, 1)
+            _, kwargs = dr._d.containers.create.call_args
+            self.assertEqual(kwargs["entrypoint"], ["tail", "-f", "/dev/null"])
+            self.assertNotIn("environment", kwargs)
+
+            calls = dr._d.api.exec_create.call_args_list
+            self.assertEqual(calls[0][0], ("pool", ["ls"]))
+            self.assertEqual(calls[1][0], ("pool", ["sh", "-c", "exit 3"]))
+            self.assertEqual(calls[1][1]["environment"]["FOO"], "bar")
+            self.assertEqual(calls[1][1]["workdir"], "/tmp")
+
+            # other volumes need a container of their own; the image of the
+            # step is used as is if the container of the pool doesn't run
+            dr._d.containers.create.return_value = Mock(status="exited")
+            self.assertIsNone(dr._run_in_pool(steps[2]))
+            self.assertEqual(dr._d.containers.create.call_count, 2)
+            self.assertEqual(dr._d.api.exec_create.call_count, 4)
+
+        pool_container.remove.assert_called_once_with(force=True)
+
+    def test_container_index(self):
+        config = ConfigLoader.load()
+        c1 = Mock()
+        c1.name = "c1"
+
+        with DockerRunner(init_docker_client=False, config=config) as dr:
+            dr._d = Mock()
+            dr._d.containers.list.return_value = [c1]
+
+            self.assertEqual(dr._find_container("c1"), c1)
+            self.assertIsNone(dr._find_container("c2"))
+            dr._d.containers.list.assert_called_once_with(
+                all=True, filters={"label": f"popper.wid={config.wid}"}
+            )
+
+            dr._remove_container(c1)
+            c1.remove.assert_called_once_with(force=True)
+            self.assertIsNone(dr._find_container("c1"))
+
+            # a container without labels that has the name is replaced
+            c2 = Mock()
+            c2.name = "c2"
+            dr._d.containers.create.side_effect = [
+                docker.errors.APIError("", response=Mock(status_code=409)),
+                c2,
+            ]
+            self.assertEqual(dr._docker_create(name="c2", image="alpine:3.9"), c2)
+            dr._d.containers.get.assert_called_once_with("c2")
+            self.assertEqual(dr._find_container("c2"), c2)
+            self.assertEqual(dr._d.containers.list.call_count, 1)
+
     def test_docker_basic_run(self):
         repo = self.mk_repo()
         conf = ConfigLoader.load(workspace_dir=repo.working_dir)
@@ -359,6 +843,522 @@ class TestHostPodmanRunner(PopperTest):
         shutil.rmtree(repo.working_dir, ignore_errors=True)
 
 
+class FakeLibpodHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the libpod API requests that PodmanRunner sends to run a step,
+    recording them in the server."""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super(FakeLibpodHandler, self).setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b""):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        path, _, query = self.path.partition("?")
+        path = path[len("/v3.0.0/libpod") :]
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else None
+        if body and self.headers["Content-Type"] == "application/json":
+            body = json.loads(body)
+        self.server.requests.append((self.command, path, body))
+        self.server.params[path] = urllib.parse.parse_qs(query)
+
+        if path in ["/info", "/version"]:
+            self._reply(200, {})
+        elif path == "/containers/json":
+            self._reply(200, [])
+        elif path.startswith("/images/") and path.endswith("/json"):
+            if self.server.image_labels is None:
+                self._reply(404, {"message": "no such image"})
+            else:
+                self._reply(200, {"Labels": self.server.image_labels})
+        elif path == "/build":
+            self._reply(200, b'{"stream": "STEP 1: FROM alpine:3.9\\n"}\n')
+        elif path == "/images/pull":
+            self._reply(200, b'{"stream": "pulling"}\n{"id": "sha256:1"}\n')
+        elif path == "/containers/create" and self.server.create_error:
+            self._reply(*self.server.create_error)
+        elif path == "/containers/create":
+            self._reply(201, {"Id": "c1"})
+        elif path == "/containers/c1/start":
+            self._reply(204)
+        elif path == "/containers/c1/logs":
+            frames = b""
+            for stream, payload in [(1, b"hello\n"), (2, b"world\n")]:
+                frames += struct.pack(">BxxxI", stream, len(payload)) + payload
+            self._reply(200, frames)
+        elif path == "/containers/c1/wait":
+            self._reply(200, 3)
+        else:
+            self._reply(404, {"message": "no such container"})
+
+    do_GET = _handle
+    do_POST = _handle
+    do_DELETE = _handle
+
+
+class TestPodmanAPI(PopperTest):
+    def setUp(self):
+        log.setLevel("CRITICAL")
+        self._socket = os.path.join(self.mk_tmpdir(), "podman.sock")
+        self._server = socketserver.ThreadingUnixStreamServer(
+            self._socket, FakeLibpodHandler
+        )
+        self._server.requests = []
+        self._server.params = {}
+        self._server.connections = 0
+        self._server.image_labels = None
+        self._server.create_error = None
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        log.setLevel("NOTSET")
+
+    def test_build(self):
+        cache_dir = self.mk_tmpdir()
+        os.environ["POPPER_CACHE_DIR"] = cache_dir
+        ws_dir = self.mk_tmpdir()
+        with open(os.path.join(ws_dir, "Dockerfile"), "w") as f:
+            f.write("FROM alpine:3.9\n")
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {
+                    "name": "podman",
+                    "options": {"api_socket": self._socket, "layers": True},
+                }
+            },
+            workspace_dir=ws_dir,
+        )
+        os.environ.pop("POPPER_CACHE_DIR")
+        step = Box({"id": "one", "uses": "./"}, default_box=True)
+
+        with PodmanRunner(config=config) as pr:
+            _, _, img, tag, build_ctx_path = pr._get_build_info(step)
+            pr._build_image(step, img, tag, build_ctx_path)
+
+            params = self._server.params["/build"]
+            self.assertEqual(params["t"], [f"{img}:{tag}"])
+            self.assertEqual(params["dockerfile"], ["Dockerfile"])
+            self.assertEqual(params["layers"], ["true"])
+            labels = json.loads(params["labels"][0])
+            self.assertTrue(labels["popper.context-hash"].startswith(tag))
+
+            # an image built from the same contents is not built again
+            self._server.image_labels = labels
+            pr._build_image(step, img, tag, build_ctx_path)
+            builds = [r for r in self._server.requests if r[1] == "/build"]
+            self.assertEqual(len(builds), 1)
+
+    @patch("popper.runner_host.HostRunner._exec_cmd", return_value=(1, 0, "sha256:1\n"))
+    def test_get_image_digest(self, exec_cmd):
+        step = Box({"id": "one", "uses": "docker://alpine:3.9"}, default_box=True)
+        with PodmanRunner(init_podman_client=False, config=ConfigLoader.load()) as pr:
+            self.assertEqual(pr._get_image_digest(step), "sha256:1")
+            self.assertEqual(exec_cmd.call_args[0][0][-1], "alpine:3.9")
+
+            exec_cmd.return_value = (1, 125, "no such image")
+            self.assertIsNone(pr._get_image_digest(step))
+
+    @patch("popper.runner_host.HostRunner._exec_cmd", return_value=(1, 125, ""))
+    def test_build_with_command(self, exec_cmd):
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {
+                    "name": "podman",
+                    "options": {
+                        "layers": False,
+                        "cache_from": "quay.io/org/cache",
+                        "build_jobs": 2,
+                    },
+                }
+            }
+        )
+        step = Box({"id": "one", "uses": "org/repo@main"}, default_box=True)
+
+        with PodmanRunner(init_podman_client=False, config=config) as pr:
+            exec_cmd.side_effect = [(1, 125, ""), (1, 0, "")]
+            pr._build_image(step, "org/repo", "main", "/tmp/ctx")
+
+        cmd = exec_cmd.call_args[0][0]
+        self.assertEqual(cmd[:2], ["podman", "build"])
+        self.assertEqual(cmd[cmd.index("--file") + 1], "/tmp/ctx/Dockerfile")
+        self.assertIn("--layers=false", cmd)
+        self.assertEqual(cmd[cmd.index("--cache-from") + 1], "quay.io/org/cache")
+        self.assertEqual(cmd[cmd.index("--jobs") + 1], "2")
+        self.assertEqual(cmd[-1], "/tmp/ctx")
+
+    def test_log_frame_reader(self):
+        data = struct.pack(">BxxxI", 1, 3) + b"out" + struct.pack(">BxxxI", 2, 3)
+        reader = LogFrameReader(io.BytesIO(data + b"err"))
+        self.assertEqual(reader.read1(), b"out")
+        self.assertEqual(reader.read1(), b"err")
+        self.assertEqual(reader.read1(), b"")
+
+    def test_run(self):
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {"name": "podman", "options": {"api_socket": self._socket}}
+            }
+        )
+        step = Box(
+            {"id": "one", "uses": "docker://alpine:3.9", "runs": ["sh", "-c", "ls"]},
+            default_box=True,
+        )
+
+        with PodmanRunner(config=config) as pr:
+            with LogCapture("popper") as logc:
+                self.assertEqual(pr.run(step), 3)
+                step_output = [
+                    r.getMessage() for r in logc.records if r.levelname == "STEP_INFO"
+                ]
+                self.assertEqual("\n".join(step_output), "hello\nworld")
+
+            # an unknown container is not an error when removing it
+            pr._remove_container("c2")
+
+        requests = [(m, p) for m, p, _ in self._server.requests]
+        self.assertEqual(
+            requests,
+            [
+                ("GET", "/info"),
+                ("GET", "/version"),
+                ("GET", "/containers/json"),
+                ("POST", "/images/pull"),
+                ("POST", "/containers/create"),
+                ("POST", "/containers/c1/start"),
+                ("GET", "/containers/c1/logs"),
+                ("POST", "/containers/c1/wait"),
+                ("DELETE", "/containers/c2"),
+            ],
+        )
+
+        spec = self._server.requests[4][2]
+        self.assertEqual(spec["image"], "alpine:3.9")
+        self.assertEqual(spec["entrypoint"], ["sh", "-c", "ls"])
+        self.assertEqual(spec["labels"]["popper.step"], "one")
+        self.assertEqual(spec["mounts"][0]["destination"], "/workspace")
+
+        # only streamed responses use connections of their own
+        self.assertEqual(self._server.connections, 3)
+
+    def test_create_options(self):
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {
+                    "name": "podman",
+                    "options": {
+                        "api_socket": self._socket,
+                        "privileged": True,
+                        "hostname": "popper.local",
+                    },
+                }
+            }
+        )
+        step = Box({"id": "one", "uses": "docker://alpine:3.9"}, default_box=True)
+
+        with PodmanRunner(config=config) as pr:
+            self.assertEqual(pr._create_container("c1", step), "c1")
+
+        spec = [r[2] for r in self._server.requests if r[1] == "/containers/create"]
+        self.assertTrue(spec[0]["privileged"])
+        self.assertEqual(spec[0]["hostname"], "popper.local")
+
+        # options that the API spec doesn't have are given to podman create
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {
+                    "name": "podman",
+                    "options": {
+                        "api_socket": self._socket,
+                        "privileged": True,
+                        "domainname": "popper.org",
+                    },
+                }
+            }
+        )
+        self._server.requests.clear()
+        with PodmanRunner(config=config) as pr:
+            with patch(
+                "popper.runner_host.HostRunner._exec_cmd", return_value=(1, 0, "c2\n")
+            ) as exec_cmd:
+                self.assertEqual(pr._create_container("c2", step), "c2")
+
+        cmd = exec_cmd.call_args[0][0]
+        self.assertEqual(cmd[:2], ["podman", "create"])
+        self.assertEqual(cmd[cmd.index("--domainname") + 1], "popper.org")
+        self.assertIn("--privileged", cmd)
+        self.assertNotIn("/containers/create", [r[1] for r in self._server.requests])
+
+    def test_create_error(self):
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {"name": "podman", "options": {"api_socket": self._socket}}
+            }
+        )
+        step = Box({"id": "one", "uses": "docker://alpine:3.9"}, default_box=True)
+        self._server.create_error = (500, {"message": "alpine:3.9: image not known"})
+
+        with PodmanRunner(config=config) as pr:
+            with LogCapture("popper") as logc:
+                self.assertRaises(SystemExit, pr.run, step)
+                cid = pu.sanitized_name(step.id, config.wid)
+                logc.check_present(
+                    (
+                        "popper",
+                        "ERROR",
+                        f"Failed to create container {cid}: alpine:3.9: image not known",
+                    )
+                )
+            self.assertEqual(pr._spawned_containers, set())
+
+        paths = [r[1] for r in self._server.requests]
+        self.assertNotIn("/containers/None/start", paths)
+
+
+class TestMockedSingularityRunner(PopperTest):
+    """Tests of the SingularityRunner that don't need singularity."""
+
+    def setUp(self):
+        log.setLevel("CRITICAL")
+        self._cache_dir = tempfile.mkdtemp()
+        os.environ["POPPER_CACHE_DIR"] = self._cache_dir
+
+    def tearDown(self):
+        os.environ.pop("POPPER_CACHE_DIR")
+        shutil.rmtree(self._cache_dir, ignore_errors=True)
+        log.setLevel("NOTSET")
+
+    @staticmethod
+    def _write_image(path, **kw):
+        with open(path, "w") as f:
+            f.write("sif")
+
+    def test_build(self):
+        ws_dir = self.mk_tmpdir()
+        with open(os.path.join(ws_dir, "Dockerfile"), "w") as f:
+            f.write("FROM alpine\nRUN apk add bash\n")
+        config = ConfigLoader.load(engine_name="singularity", workspace_dir=ws_dir)
+        step = Box({"id": "one", "uses": "./"}, default_box=True)
+        cid = pu.sanitized_name(step.id, config.wid) + ".sif"
+
+        with SingularityRunner(init_spython_client=False, config=config) as sr:
+            sr._s = Mock()
+            sr._s.build.side_effect = lambda image, build_folder, **kw: (
+                self._write_image(os.path.join(build_folder, image))
+            )
+            sr._setup_singularity_cache()
+            sif = sr._create_container(step, cid)
+
+            self.assertEqual(sr._s.build.call_count, 1)
+            self.assertTrue(os.path.isfile(sif))
+            self.assertEqual(os.listdir(sr._singularity_cache), [os.path.basename(sif)])
+            self.assertTrue(os.path.isfile(sr._get_recipe_path(sif, ws_dir)))
+
+            # the image is reused by other workspaces with the same contents
+            other_dir = self.mk_tmpdir()
+            shutil.copy(os.path.join(ws_dir, "Dockerfile"), other_dir)
+            other_config = ConfigLoader.load(
+                engine_name="singularity", workspace_dir=other_dir
+            )
+            sr._config = other_config
+            self.assertEqual(sr._create_container(step, cid), sif)
+            self.assertEqual(sr._s.build.call_count, 1)
+
+            # and built again when they change
+            with open(os.path.join(other_dir, "README.md"), "w") as f:
+                f.write("readme")
+            self.assertNotEqual(sr._create_container(step, cid), sif)
+            self.assertEqual(sr._s.build.call_count, 2)
+
+    def test_get_image_digest(self):
+        config = ConfigLoader.load(engine_name="singularity")
+        step = Box({"id": "one", "uses": "docker://alpine:3.9"}, default_box=True)
+
+        with SingularityRunner(init_spython_client=False, config=config) as sr:
+            self.assertIsNone(sr._get_image_digest(step))
+
+            sr._setup_singularity_cache()
+            _, _, _, sif = sr._get_image_info(step)
+            self._write_image(sif)
+            digest = sr._get_image_digest(step)
+            self.assertIsNotNone(digest)
+
+            # pulling the image again changes it
+            st = os.stat(sif)
+            os.utime(sif, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+            self.assertNotEqual(sr._get_image_digest(step), digest)
+
+    def test_convert(self):
+        build_ctx_path = self.mk_tmpdir()
+        os.makedirs(os.path.join(build_ctx_path, "dir"))
+        with open(os.path.join(build_ctx_path, "Dockerfile"), "w") as f:
+            f.write('FROM alpine\nADD README.md /\nCOPY "dir" /opt\n')
+
+        # paths in the recipe do not depend on the current directory
+        recipe_file = os.path.join(self._cache_dir, "recipe")
+        SingularityRunner._convert(
+            os.path.join(build_ctx_path, "Dockerfile"), recipe_file
+        )
+        with open(recipe_file, "r") as f:
+            files = f.read().split("%files\n")[1].split("\n")[:2]
+        self.assertEqual(
+            files, [f"{build_ctx_path}/README.md /", f"{build_ctx_path}/dir/. /opt"],
+        )
+
+    def test_pull(self):
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {
+                    "name": "singularity",
+                    "options": {"pull_policy": "if-older-than=1h"},
+                }
+            }
+        )
+        step = Box({"id": "one", "uses": "docker://alpine:3.9"}, default_box=True)
+        cid = pu.sanitized_name(step.id, config.wid) + ".sif"
+
+        with SingularityRunner(init_spython_client=False, config=config) as sr:
+            sr._s = Mock()
+            sr._s.pull.side_effect = lambda name, pull_folder, **kw: (
+                self._write_image(os.path.join(pull_folder, name))
+            )
+            sr._setup_singularity_cache()
+            sif = sr._create_container(step, cid)
+            self.assertEqual(sr._s.pull.call_count, 1)
+            self.assertEqual(sr._s.pull.call_args[1]["image"], "docker://alpine:3.9")
+
+            sr._create_container(step, cid)
+            self.assertEqual(sr._s.pull.call_count, 1)
+
+            st = os.stat(sif)
+            os.utime(sif, (st.st_atime, st.st_mtime - 7200))
+            sr._create_container(step, cid)
+            self.assertEqual(sr._s.pull.call_count, 2)
+
+            step.pull_policy = "always"
+            sr._create_container(step, cid)
+            self.assertEqual(sr._s.pull.call_count, 3)
+
+            # failed pulls are reported
+            os.remove(sif)
+            sr._s.pull.side_effect = None
+            self.assertRaises(SystemExit, sr._create_container, step, cid)
+
+    def test_use_refreshes_age(self):
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {
+                    "name": "singularity",
+                    "options": {"pull_policy": "if-not-present"},
+                }
+            }
+        )
+        step = Box({"id": "one", "uses": "docker://alpine:3.9"}, default_box=True)
+        cid = pu.sanitized_name(step.id, config.wid) + ".sif"
+        gc = GarbageCollector(config)
+
+        with SingularityRunner(init_spython_client=False, config=config) as sr:
+            sr._s = Mock()
+            sr._s.pull.side_effect = lambda name, pull_folder, **kw: (
+                self._write_image(os.path.join(pull_folder, name))
+            )
+            sr._setup_singularity_cache()
+            sif = sr._create_container(step, cid)
+
+            # an image that was pulled long ago and not used since
+            os.utime(sif, (0, 0))
+            [resource] = [r for r in gc.find() if r.name == sif]
+            self.assertTrue(gc.is_garbage(resource, 3600))
+
+            # using it again doesn't pull it, but makes it recent for gc
+            sr._create_container(step, cid)
+            self.assertEqual(sr._s.pull.call_count, 1)
+            self.assertGreater(os.stat(sif).st_atime, time.time() - 60)
+            self.assertEqual(os.stat(sif).st_mtime, 0)
+            [resource] = [r for r in gc.find() if r.name == sif]
+            self.assertFalse(gc.is_garbage(resource, 3600))
+
+    @patch("popper.runner_host.HostRunner._exec_cmd", return_value=(1, 0, ""))
+    def test_singularity_start(self, exec_cmd):
+        config = ConfigLoader.load(engine_name="singularity", workspace_dir="/w")
+        step = Box(
+            {"id": "one", "runs": ["env"], "env": {"FOO": "bar"}}, default_box=True
+        )
+
+        with SingularityRunner(init_spython_client=False, config=config) as sr:
+            self.assertEqual(sr._singularity_start(step, "one.sif", "/i.sif"), 0)
+
+        cmd = exec_cmd.call_args[0][0]
+        self.assertEqual(cmd[:3], ["singularity", "--quiet", "exec"])
+        self.assertEqual(cmd[-2:], ["/i.sif", "env"])
+
+        # variables of the step are given to singularity only
+        env = exec_cmd.call_args[1]["env"]
+        self.assertEqual(env["SINGULARITYENV_FOO"], "bar")
+        self.assertNotIn("FOO", os.environ)
+
+    @patch("popper.runner_host.HostRunner._exec_cmd", return_value=(1, 0, ""))
+    def test_instances(self, exec_cmd):
+        config = ConfigLoader.load(
+            config_file={
+                "engine": {"name": "singularity", "options": {"instances": True}}
+            },
+            workspace_dir="/w",
+        )
+        one = Box({"id": "one", "runs": ["ls"]}, default_box=True)
+        two = Box({"id": "two", "args": ["-l"]}, default_box=True)
+
+        with SingularityRunner(init_spython_client=False, config=config) as sr:
+            self.assertEqual(sr._singularity_start(one, "one.sif", "/a.sif"), 0)
+            self.assertEqual(sr._singularity_start(two, "two.sif", "/a.sif"), 0)
+            self.assertEqual(sr._singularity_start(one, "one.sif", "/b.sif"), 0)
+
+        cmds = [c[0][0] for c in exec_cmd.call_args_list]
+        instance_a = f"popper_a_{config.wid}"
+        instance_b = f"popper_b_{config.wid}"
+
+        # an instance is started for each image, with the container options
+        self.assertEqual(
+            cmds[0],
+            ["singularity", "--quiet", "instance", "start", "--userns", "--pwd"]
+            + ["/workspace", "--bind", "/w:/workspace", "/a.sif", instance_a],
+        )
+        self.assertEqual(
+            cmds[1],
+            ["singularity", "--quiet", "exec", "--pwd", "/workspace"]
+            + [f"instance://{instance_a}", "ls"],
+        )
+        self.assertEqual(
+            cmds[2],
+            ["singularity", "--quiet", "run", "--pwd", "/workspace"]
+            + [f"instance://{instance_a}", "-l"],
+        )
+        self.assertEqual(cmds[3][:4], ["singularity", "--quiet", "instance", "start"])
+        self.assertEqual(cmds[3][-1], instance_b)
+
+        # and instances are stopped when the runner exits
+        self.assertEqual(
+            sorted(cmds[5:]),
+            [
+                ["singularity", "--quiet", "instance", "stop", instance_a],
+                ["singularity", "--quiet", "instance", "stop", instance_b],
+            ],
+        )
+
+
 @unittest.skipIf(
     os.environ.get("ENGINE", "docker") != "singularity", "ENGINE != singularity"
 )
@@ -379,20 +1379,19 @@ ADD README.md /
 ENTRYPOINT ["/bin/bash"]"""
             )
 
+        recipe_file = os.path.join(self.mk_tmpdir(), "recipes", "sample")
         singularity_file = SingularityRunner._get_recipe_file(
-            build_ctx_path, "sample.sif"
-        )
-        self.assertEqual(
-            singularity_file, os.path.join(build_ctx_path, "Singularity.sample")
+            build_ctx_path, recipe_file
         )
+        self.assertEqual(singularity_file, recipe_file)
         self.assertEqual(os.path.exists(singularity_file), True)
         with open(singularity_file) as f:
             self.assertEqual(
                 f.read(),
-                '''Bootstrap: docker
+                f'''Bootstrap: docker
 From: alpine
 %files
-README.md /
+{build_ctx_path}/README.md /
 %post
 
 apk update && apk add bash
@@ -404,7 +1403,7 @@ exec /bin/bash "$@"''',
 
         os.remove(os.path.join(build_ctx_path, "Dockerfile"))
         self.assertRaises(
-            SystemExit, SingularityRunner._get_recipe_file, build_ctx_path, "sample.sif"
+            SystemExit, SingularityRunner._get_recipe_file, build_ctx_path, recipe_file
         )
 
     def test_create_container(self):
@@ -432,26 +1431,22 @@ exec /bin/bash "$@"''',
 
         with SingularityRunner(config=config) as sr:
             sr._setup_singularity_cache()
-            sr._create_container(step_one, cid_one)
-            self.assertEqual(
-                os.path.exists(os.path.join(sr._singularity_cache, cid_one)), True
-            )
-            os.remove(os.path.join(sr._singularity_cache, cid_one))
+            sif = sr._create_container(step_one, cid_one)
+            self.assertEqual(os.path.exists(sif), True)
+            os.remove(sif)
 
         with SingularityRunner(config=config) as sr:
             sr._setup_singularity_cache()
-            sr._create_container(step_one, cid_two)
-            self.assertEqual(
-                os.path.exists(os.path.join(sr._singularity_cache, cid_two)), True
-            )
-            os.remove(os.path.join(sr._singularity_cache, cid_two))
+            sif = sr._create_container(step_two, cid_two)
+            self.assertEqual(os.path.exists(sif), True)
+            os.remove(sif)
 
     def test_setup_singularity_cache(self):
         config = ConfigLoader.load()
         with SingularityRunner(config=config) as sr:
             sr._setup_singularity_cache()
             self.assertEqual(
-                f'{os.environ["HOME"]}/.cache/popper/singularity/{config.wid}',
+                f'{os.environ["HOME"]}/.cache/popper/singularity/images',
                 sr._singularity_cache,
             )
 
@@ -504,9 +1499,8 @@ exec /bin/bash "$@"''',
         cid = pu.sanitized_name(step["name"], conf.wid)
         with SingularityRunner(config=conf) as sr:
             sr._setup_singularity_cache()
-            sr._container = os.path.join(sr._singularity_cache, cid)
-            sr._create_container(step, cid)
-            self.assertEqual(sr._singularity_start(step, cid), 0)
+            sif = sr._create_container(step, cid)
+            self.assertEqual(sr._singularity_start(step, cid, sif), 0)
 
         # step = Box({
         #     'uses': 'library://library/default/alpine:3.7',
@@ -516,9 +1510,8 @@ exec /bin/bash "$@"''',
         # cid = pu.sanitized_name(step['name'], conf.wid)
         # with SingularityRunner(config=conf) as sr:
         #     sr._setup_singularity_cache()
-        #     sr._container = os.path.join(sr._singularity_cache, cid)
-        #     sr._create_container(step, cid)
-        #     self.assertEqual(sr._singularity_start(step, cid), 0)
+        #     sif = sr._create_container(step, cid)
+        #     self.assertEqual(sr._singularity_start(step, cid, sif), 0)
 
         # step = Box({
         #     'uses': 'shub://divetea/debian:latest',
@@ -528,9 +1521,8 @@ exec /bin/bash "$@"''',
         # cid = pu.sanitized_name(step['name'], conf.wid)
         # with SingularityRunner(config=conf) as sr:
         #     sr._setup_singularity_cache()
-        #     sr._container = os.path.join(sr._singularity_cache, cid)
-        #     sr._create_container(step, cid)
-        #     self.assertEqual(sr._singularity_start(step, cid), 0)
+        #     sif = sr._create_container(step, cid)
+        #     self.assertEqual(sr._singularity_start(step, cid, sif), 0)
 
         step = Box(
             {
@@ -543,9 +1535,8 @@ exec /bin/bash "$@"''',
         cid = pu.sanitized_name(step["name"], conf.wid)
         with SingularityRunner(config=conf) as sr:
             sr._setup_singularity_cache()
-            sr._container = os.path.join(sr._singularity_cache, cid)
-            sr._create_container(step, cid)
-            self.assertNotEqual(sr._singularity_start(step, cid), 0)
+            sif = sr._create_container(step, cid)
+            self.assertNotEqual(sr._singularity_start(step, cid, sif), 0)
 
         with WorkflowRunner(conf) as r:
             wf_data = {"steps": [{"uses": "popperized/bin/sh@master", "args": ["ls"],}]}
@@ -1,14 +1,22 @@
+import datetime
+import io
+import json
 import os
 import shutil
+import subprocess
+import tarfile
 import time
 import unittest
 
+from unittest.mock import Mock, patch
+
 import popper.scm as scm
 import popper.utils as pu
 
 from popper.config import ConfigLoader
+from popper.parser import WorkflowParser
 from popper.runner import WorkflowRunner
-from popper.runner_kubernetes import KubernetesRunner
+from popper.runner_kubernetes import ExecStdin, KubernetesRunner
 from popper.cli import log as log
 from .test_common import PopperTest
 
@@ -113,18 +121,16 @@ class TestKubernetesRunner(PopperTest):
                 },
                 default_box=True,
             )
-            kr._pod_name = kr._base_pod_name + f"-{step.id}"
-            kr._pod_create(step, "alpine:3.9")
-            self.assertEqual(kr._pod_exit_code(), 0)
-            response = self._kclient.read_namespaced_pod(
-                kr._pod_name, namespace="default"
-            )
+            pod_name = kr._base_pod_name + f"-{step.id}"
+            kr._pod_create(step, "alpine:3.9", pod_name)
+            self.assertEqual(kr._pod_exit_code(pod_name), 0)
+            response = self._kclient.read_namespaced_pod(pod_name, namespace="default")
             self.assertEqual(response.status.phase, "Succeeded")
-            kr._pod_delete()
+            kr._pod_delete(pod_name)
             self.assertRaises(
                 Exception,
                 self._kclient.read_namespaced_pod,
-                **{"name": kr._pod_name, "namespace": "default"},
+                **{"name": pod_name, "namespace": "default"},
             )
 
             time.sleep(5)
@@ -137,18 +143,447 @@ class TestKubernetesRunner(PopperTest):
                 },
                 default_box=True,
             )
-            kr._pod_name = kr._base_pod_name + f"-{step.id}"
-            kr._pod_create(step, "alpine:3.9")
-            self.assertEqual(kr._pod_exit_code(), 1)
-            response = self._kclient.read_namespaced_pod(
-                kr._pod_name, namespace="default"
-            )
+            pod_name = kr._base_pod_name + f"-{step.id}"
+            kr._pod_create(step, "alpine:3.9", pod_name)
+            self.assertEqual(kr._pod_exit_code(pod_name), 1)
+            response = self._kclient.read_namespaced_pod(pod_name, namespace="default")
             self.assertEqual(response.status.phase, "Failed")
-            kr._pod_delete()
+            kr._pod_delete(pod_name)
             kr._vol_claim_delete()
 
             self.assertRaises(
                 Exception,
                 self._kclient.read_namespaced_pod,
-                **{"name": kr._pod_name, "namespace": "default"},
+                **{"name": pod_name, "namespace": "default"},
+            )
+
+    def test_run_concurrently(self):
+        repo = self.mk_repo()
+        conf = ConfigLoader.load(
+            workspace_dir=repo.working_dir, resman_name="kubernetes", jobs=2
+        )
+
+        # step 'one' only succeeds if 'two' runs at the same time
+        wait_for_two = (
+            "for i in $(seq 100); do test -f two.txt && exit 0; sleep 0.5; done"
+        )
+        wf_data = {
+            "steps": [
+                {
+                    "id": "one",
+                    "uses": "docker://alpine:3.9",
+                    "runs": ["sh", "-c", wait_for_two + "; exit 1"],
+                },
+                {
+                    "id": "two",
+                    "uses": "docker://alpine:3.9",
+                    "runs": ["touch", "two.txt"],
+                    "needs": [],
+                },
+            ]
+        }
+        with WorkflowRunner(conf) as r:
+            r.run(WorkflowParser.parse(wf_data=wf_data))
+            kr = r._step_runner("docker", None)
+            self.assertEqual(kr._spawned_pods, set())
+            kr._vol_claim_delete()
+
+        repo.close()
+        shutil.rmtree(repo.working_dir, ignore_errors=True)
+
+    def test_persistent_sync_pod(self):
+        repo = self.mk_repo()
+        config_dict = {
+            "resource_manager": {
+                "name": "kubernetes",
+                "options": {"persistent_sync_pod": True},
+            }
+        }
+        conf = ConfigLoader.load(
+            config_file=config_dict, workspace_dir=repo.working_dir
+        )
+
+        sync_pods = []
+        for _ in range(2):
+            with KubernetesRunner(config=conf) as kr:
+                kr._setup_workspace()
+                response = self._kclient.read_namespaced_pod(
+                    kr._init_pod_name, namespace="default"
+                )
+                self.assertEqual(response.status.phase, "Running")
+                sync_pods.append(kr._init_pod_name)
+
+        # the second execution reuses the pod of the first one
+        self.assertEqual(sync_pods[0], sync_pods[1])
+
+        with KubernetesRunner(config=conf) as kr:
+            kr._init_pod_name = sync_pods[0]
+            kr._init_pod_delete()
+            kr._vol_claim_delete()
+
+        repo.close()
+        shutil.rmtree(repo.working_dir, ignore_errors=True)
+
+    def test_run_matrix(self):
+        repo = self.mk_repo()
+        conf = ConfigLoader.load(
+            workspace_dir=repo.working_dir, resman_name="kubernetes"
+        )
+
+        wfs = []
+        for value in ["a", "b", "c"]:
+            wf_data = {
+                "steps": [
+                    {
+                        "id": "one",
+                        "uses": "docker://alpine:3.9",
+                        "runs": ["sh", "-c", "echo $VALUE; test $VALUE != b"],
+                        "env": {"VALUE": "$_V"},
+                    },
+                    {"id": "two", "uses": "docker://alpine:3.9", "runs": ["true"]},
+                ]
+            }
+            wfs.append(
+                WorkflowParser.parse(wf_data=wf_data, substitutions=[f"_V={value}"])
+            )
+
+        with WorkflowRunner(conf) as r:
+            kr = r._step_runner("docker", None)
+            ecodes = kr.run_matrix({i: wf.steps[0] for i, wf in enumerate(wfs)})
+            self.assertEqual(ecodes, {0: 0, 1: 1, 2: 0})
+            self.assertEqual(kr._spawned_jobs, set())
+
+            # element 'b' fails, so the workflow fails
+            self.assertRaises(SystemExit, r.run_matrix, wfs)
+            kr._vol_claim_delete()
+
+        repo.close()
+        shutil.rmtree(repo.working_dir, ignore_errors=True)
+
+
+class TestKubernetesWorkspaceSync(PopperTest):
+    def test_scan_workspace(self):
+        ws = self.mk_repo().working_dir
+        os.makedirs(os.path.join(ws, "data"))
+        for name in ["data/a", "data/b", "c"]:
+            with open(os.path.join(ws, name), "w") as f:
+                f.write(name)
+
+        files, changed, deleted = KubernetesRunner._scan_workspace(ws, {})
+        self.assertEqual(files["data"], ["dir"])
+        self.assertLess(changed.index("data"), changed.index("data/a"))
+        self.assertEqual(set(changed), set(files))
+        self.assertEqual(deleted, [])
+
+        # nothing changed
+        _, changed, deleted = KubernetesRunner._scan_workspace(ws, files)
+        self.assertEqual(changed, [])
+        self.assertEqual(deleted, [])
+
+        # modify, touch (same content) and delete files
+        with open(os.path.join(ws, "data/a"), "w") as f:
+            f.write("new content")
+        st = os.stat(os.path.join(ws, "c"))
+        os.utime(os.path.join(ws, "c"), (st.st_atime, st.st_mtime + 10))
+        os.remove(os.path.join(ws, "data/b"))
+
+        new_files, changed, deleted = KubernetesRunner._scan_workspace(ws, files)
+        self.assertEqual(changed, ["data/a"])
+        self.assertEqual(deleted, ["data/b"])
+        self.assertNotEqual(new_files["c"], files["c"])
+
+        shutil.rmtree(ws, ignore_errors=True)
+
+    def test_exec_stdin(self):
+        class Response(object):
+            data = b""
+
+            def write_stdin(self, data):
+                self.data += data
+
+        response = Response()
+        content = os.urandom(ExecStdin.chunk_size * 2 + 10)
+        info = tarfile.TarInfo("file")
+        info.size = len(content)
+        with tarfile.open(fileobj=ExecStdin(response), mode="w|") as archive:
+            archive.addfile(info, io.BytesIO(content))
+
+        with tarfile.open(fileobj=io.BytesIO(response.data), mode="r|") as archive:
+            member = archive.next()
+            self.assertEqual(member.name, "file")
+            self.assertEqual(archive.extractfile(member).read(), content)
+
+
+class TestKubernetesMatrix(PopperTest):
+    def setUp(self):
+        log.setLevel("CRITICAL")
+        with patch("popper.runner_kubernetes.config"):
+            self._runner = KubernetesRunner(config=ConfigLoader.load())
+
+    def _pod(self, index, phase, exit_code=None):
+        state = {
+            "terminated": {"exit_code": exit_code} if exit_code is not None else None
+        }
+        return Box(
+            {
+                "metadata": {
+                    "name": f"pod-{index}",
+                    "labels": {
+                        "job-name": "job",
+                        "batch.kubernetes.io/job-completion-index": str(index),
+                    },
+                    "creation_timestamp": index,
+                },
+                "status": {"phase": phase, "container_statuses": [{"state": state}]},
+            }
+        )
+
+    def test_run_matrix_exit_codes(self):
+        steps = {
+            i: Box(
+                {"id": "one", "uses": "docker://alpine:3.9", "runs": ["true"]},
+                default_box=True,
+            )
+            for i in range(5)
+        }
+        # index 4 was evicted before its container started
+        pods = [
+            self._pod(0, "Succeeded", 0),
+            self._pod(1, "Failed", 3),
+            self._pod(2, "Failed", 78),
+            self._pod(4, "Failed"),
+        ]
+        kr = self._runner
+        kr._kclient = Mock()
+        kr._kclient.list_namespaced_pod.return_value = Mock(items=pods)
+        kr._kclient.read_namespaced_pod_log.return_value = "output"
+        kr._pod_host_node = None
+        kr._version = (1, 29)
+        with patch.object(kr, "_setup_workspace"), patch.object(
+            kr, "_job_create"
+        ), patch.object(kr, "_wait_for"):
+            ecodes = kr.run_matrix(steps)
+
+        # index 3 has no pod
+        self.assertEqual(ecodes, {0: 0, 1: 3, 2: 78, 3: 1, 4: 1})
+
+    def test_run_matrix_pods(self):
+        steps = {
+            i: Box({"id": "one", "uses": f"docker://alpine:3.{i}"}, default_box=True)
+            for i in range(3)
+        }
+        kr = self._runner
+
+        with patch("popper.runner_kubernetes.client.VersionApi") as mock_api:
+            mock_api.return_value.get_code.return_value = Mock(
+                major="1", minor="18+", git_version="v1.18.2"
+            )
+            self.assertEqual(kr._server_version(), (1, 18))
+
+        # elements run in pods of their own, even with distinct images
+        with patch.object(kr, "_run_pod", side_effect=lambda s, n, p: int(n[-1])):
+            with patch.object(kr, "_job_create") as mock_job_create:
+                ecodes = kr.run_matrix(steps)
+                names = sorted(c[0][1] for c in kr._run_pod.call_args_list)
+                prefixes = sorted(c[0][2] for c in kr._run_pod.call_args_list)
+
+        mock_job_create.assert_not_called()
+        self.assertEqual(ecodes, {0: 0, 1: 1, 2: 2})
+        self.assertEqual(names, [f"{kr._base_pod_name}-one-{i}" for i in range(3)])
+        self.assertEqual(prefixes, [f"[one][{i}] " for i in range(3)])
+
+        # backoffLimitPerIndex is disabled by default in 1.28
+        kr._version = None
+        with patch("popper.runner_kubernetes.client.VersionApi") as mock_api:
+            mock_api.return_value.get_code.return_value = Mock(
+                major="1", minor="28", git_version="v1.28.0"
+            )
+            with patch.object(kr, "_run_pod", return_value=0) as mock_run_pod:
+                with patch.object(kr, "_job_create") as mock_job_create:
+                    self.assertEqual(kr.run_matrix(steps), {0: 0, 1: 0, 2: 0})
+
+        mock_job_create.assert_not_called()
+        self.assertEqual(mock_run_pod.call_count, 3)
+
+    def test_job_create_dropped_fields(self):
+        steps = {
+            i: Box(
+                {"id": "one", "uses": "docker://alpine:3.9", "runs": ["true"]},
+                default_box=True,
+            )
+            for i in range(2)
+        }
+        kr = self._runner
+        kr._version = (1, 29)
+        kr._pod_host_node = None
+        kr._batch_client = Mock()
+
+        # the server drops backoffLimitPerIndex when its feature gate is off;
+        # the job is only created in dry-run mode and pods are used instead
+        spec = {"completionMode": "Indexed", "backoffLimit": 6}
+        kr._batch_client.create_namespaced_job.return_value = Mock(
+            data=json.dumps({"spec": spec})
+        )
+        with patch.object(kr, "_setup_workspace"), patch.object(
+            kr, "_run_pod", return_value=0
+        ) as mock_run_pod:
+            self.assertEqual(kr.run_matrix(steps), {0: 0, 1: 0})
+
+        self.assertEqual(mock_run_pod.call_count, 2)
+        calls = kr._batch_client.create_namespaced_job.call_args_list
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][1]["dry_run"], "All")
+        self.assertEqual(calls[0][1]["body"]["spec"]["backoffLimitPerIndex"], 0)
+        self.assertEqual(kr._spawned_jobs, set())
+
+        # the job is created when the server keeps the fields
+        spec["backoffLimitPerIndex"] = 0
+        kr._batch_client.create_namespaced_job.return_value = Mock(
+            data=json.dumps({"spec": spec})
+        )
+        self.assertTrue(
+            kr._job_create(steps[0], "alpine:3.9", "job", [({}, ["true"], None)] * 2)
+        )
+        calls = kr._batch_client.create_namespaced_job.call_args_list
+        self.assertEqual(len(calls), 3)
+        self.assertNotIn("dry_run", calls[2][1])
+        self.assertEqual(kr._spawned_jobs, {"job"})
+
+    def test_job_wait(self):
+        kr = self._runner
+        kr._kclient = Mock()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        running = self._pod(0, "Running")
+        running.metadata.creation_timestamp = now - datetime.timedelta(hours=1)
+        pending = self._pod(1, "Pending")
+        pending.metadata.creation_timestamp = now - datetime.timedelta(seconds=1)
+
+        # the job keeps running while its pods start in time
+        kr._kclient.list_namespaced_pod.return_value = Mock(items=[running, pending])
+        with patch.object(kr, "_wait_for", side_effect=[None, None, Mock()]) as w:
+            kr._job_wait("job")
+        self.assertEqual(w.call_count, 3)
+        self.assertEqual(w.call_args[0][3], kr._pod_timeout)
+
+        # a pod that doesn't start in time
+        pending.metadata.creation_timestamp = now - datetime.timedelta(hours=1)
+        with patch.object(kr, "_wait_for", return_value=None):
+            self.assertRaises(Exception, kr._job_wait, "job")
+
+        # a job without pods
+        kr._kclient.list_namespaced_pod.return_value = Mock(items=[])
+        with patch.object(kr, "_wait_for", return_value=None):
+            self.assertRaises(Exception, kr._job_wait, "job")
+
+    def test_matrix_script(self):
+        commands = [
+            ({"A": "a1"}, ["sh", "-c", 'echo "$A $0"'], ["x y"]),
+            ({"A": "a'2"}, ["sh", "-c", 'echo "$A $0"; exit 3'], ["z"]),
+        ]
+        script = KubernetesRunner._matrix_script(commands)
+
+        for index, output, ecode in [(0, "a1 x y\n", 0), (1, "a'2 z\n", 3)]:
+            p = subprocess.run(
+                ["sh", "-c", script],
+                env={"JOB_COMPLETION_INDEX": str(index), "PATH": os.environ["PATH"]},
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
             )
+            self.assertEqual(p.stdout, output)
+            self.assertEqual(p.returncode, ecode)
+
+        p = subprocess.run(["sh", "-c", script], env={"JOB_COMPLETION_INDEX": "2"})
+        self.assertEqual(p.returncode, 1)
+
+
+class TestKubernetesWaitFor(PopperTest):
+    def setUp(self):
+        log.setLevel("CRITICAL")
+        with patch("popper.runner_kubernetes.config"):
+            self._runner = KubernetesRunner(config=ConfigLoader.load())
+
+    def _list_fn(self, *objs, resource_version="10"):
+        response = Mock(items=list(objs))
+        response.metadata.resource_version = resource_version
+        return Mock(return_value=response)
+
+    def test_already_done(self):
+        # the condition holds when the object is listed; nothing is watched
+        list_fn = self._list_fn(Box(name="p", phase="Running"))
+        with patch("popper.runner_kubernetes.watch.Watch") as mock_watch:
+            obj = self._runner._wait_for(
+                list_fn, "p", lambda o: o.phase == "Running", 10, namespace="ns"
+            )
+        self.assertEqual(obj.name, "p")
+        list_fn.assert_called_once_with(
+            namespace="ns", field_selector="metadata.name=p"
+        )
+        mock_watch.assert_not_called()
+
+    def test_watch(self):
+        list_fn = self._list_fn(Box(name="p", phase="Pending"))
+        events = [
+            {"type": "MODIFIED", "object": Box(name="p", phase="Pending")},
+            {"type": "DELETED", "object": Box(name="p", phase="Running")},
+            {"type": "MODIFIED", "object": Box(name="p", phase="Running")},
+            {"type": "MODIFIED", "object": Box(name="p", phase="Failed")},
+        ]
+        with patch("popper.runner_kubernetes.watch.Watch") as mock_watch:
+            mock_watch.return_value.stream.return_value = iter(events)
+            obj = self._runner._wait_for(
+                list_fn, "p", lambda o: o.phase == "Running", 10, namespace="ns"
+            )
+
+        self.assertEqual(obj, events[2]["object"])
+        # changes are watched from the version of the listed object
+        _, kw = mock_watch.return_value.stream.call_args
+        self.assertEqual(kw["resource_version"], "10")
+        self.assertEqual(kw["field_selector"], "metadata.name=p")
+        self.assertEqual(kw["namespace"], "ns")
+        self.assertLessEqual(kw["timeout_seconds"], 10)
+        mock_watch.return_value.stop.assert_called()
+
+    def test_resume(self):
+        # an expired resource version makes the object to be listed again, and
+        # the watch resumes from the new version
+        list_fn = Mock(
+            side_effect=[
+                self._list_fn(Box(phase="Pending"), resource_version="10")(),
+                self._list_fn(Box(phase="Pending"), resource_version="20")(),
+            ]
+        )
+        streams = [
+            iter([{"type": "ERROR", "object": {"code": 410}}]),
+            iter([{"type": "MODIFIED", "object": Box(phase="Running")}]),
+        ]
+        with patch("popper.runner_kubernetes.watch.Watch") as mock_watch:
+            mock_watch.return_value.stream.side_effect = streams
+            obj = self._runner._wait_for(
+                list_fn, "p", lambda o: o.phase == "Running", 10
+            )
+
+        self.assertEqual(obj.phase, "Running")
+        self.assertEqual(list_fn.call_count, 2)
+        versions = [
+            kw["resource_version"]
+            for _, kw in mock_watch.return_value.stream.call_args_list
+        ]
+        self.assertEqual(versions, ["10", "20"])
+
+    def test_timeout(self):
+        list_fn = self._list_fn(Box(phase="Pending"))
+
+        def stream(*args, **kw):
+            # the server closes the watch when its timeout expires
+            time.sleep(kw["timeout_seconds"])
+            return iter([{"type": "MODIFIED", "object": Box(phase="Pending")}])
+
+        with patch("popper.runner_kubernetes.watch.Watch") as mock_watch:
+            mock_watch.return_value.stream.side_effect = stream
+            start = time.time()
+            obj = self._runner._wait_for(
+                list_fn, "p", lambda o: o.phase == "Running", 1
+            )
+
+        self.assertIsNone(obj)
+        self.assertLess(time.time() - start, 5)
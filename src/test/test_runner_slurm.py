@@ -1,9 +1,13 @@
+import glob
+import hashlib
 import os
+import shutil
+import time
 import unittest
 import tempfile
 
 from unittest.mock import patch
-from testfixtures import compare, Replacer, replace
+from testfixtures import compare, LogCapture, Replacer
 from testfixtures.popen import MockPopen
 from testfixtures.mock import call
 
@@ -11,6 +15,7 @@ from popper.config import ConfigLoader
 from popper.runner import WorkflowRunner
 from popper.parser import WorkflowParser
 from popper.runner_slurm import (
+    OutputFollower,
     SlurmRunner,
     SingularityRunner,
 )
@@ -24,14 +29,21 @@ from box import Box
 config = ConfigLoader.load(workspace_dir="/w")
 
 
-def mock_kill(pid, sig):
-    return 0
-
-
 def mock_assert_executable_exists(exe):
     return None
 
 
+def job_files():
+    """Returns the job scripts and outputs that the runner writes to the
+    current folder."""
+    return set(glob.glob("popper_*.sh") + glob.glob("popper_*.out"))
+
+
+def remove_job_files(existing):
+    for path in job_files() - existing:
+        os.remove(path)
+
+
 @unittest.skipIf(
     os.environ.get("ENABLE_SLURM_RUNNER_TESTS", "0") != "1",
     "Kubernetes runner tests not enabled.",
@@ -50,15 +62,43 @@ class TestSlurmSlurmRunner(PopperTest):
         )
         self.addCleanup(replacer.restore)
         self.addCleanup(assert_replacer.restore)
+        self.addCleanup(remove_job_files, job_files())
 
     def tearDown(self):
         log.setLevel("NOTSET")
 
-    def test_tail_output(self):
-        self.Popen.set_command("tail -f slurm-x.out", returncode=0)
-        with SlurmRunner(config=ConfigLoader.load()) as sr:
-            self.assertEqual(sr._tail_output("slurm-x.out"), 0)
-            self.assertEqual(len(sr._out_stream_pid), 1)
+    def test_output_follower(self):
+        out_dir = self.mk_tmpdir()
+        follower = OutputFollower(min_interval=0.01, max_interval=0.05)
+
+        with LogCapture("popper") as logs:
+            paths = [os.path.join(out_dir, f"job_{i}.out") for i in range(2)]
+            for path in paths:
+                open(path, "w").close()
+                follower.follow(path)
+
+            for i, path in enumerate(paths):
+                with open(path, "a") as f:
+                    f.write(f"first line of {i}\n")
+
+            # lines are logged while the jobs run
+            deadline = time.time() + 5
+            while len(logs.records) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(
+                sorted(r.getMessage() for r in logs.records),
+                ["first line of 0", "first line of 1"],
+            )
+
+            # and what is left is logged when a file is no longer followed
+            with open(paths[0], "a") as f:
+                f.write("last line without newline")
+            follower.unfollow(paths[0])
+            self.assertEqual(logs.records[-1].getMessage(), "last line without newline")
+
+            follower.unfollow(paths[1])
+
+        self.assertEqual(follower._files, {})
 
     def test_stop_running_tasks(self):
         self.Popen.set_command("scancel --name job_a", returncode=0)
@@ -73,13 +113,11 @@ class TestSlurmSlurmRunner(PopperTest):
                     preexec_fn=os.setsid,
                     stderr=-2,
                     stdout=-1,
-                    universal_newlines=True,
                 ),
                 self.Popen.all_calls[0],
             )
 
-    @replace("popper.runner_slurm.os.kill", mock_kill)
-    def test_exec_srun(self, mock_kill):
+    def test_exec_srun(self):
         config_dict = {
             "engine": {"name": "singularity", "options": {},},
             "resource_manager": {
@@ -118,13 +156,11 @@ class TestSlurmSlurmRunner(PopperTest):
             preexec_fn=os.setsid,
             stderr=-2,
             stdout=-1,
-            universal_newlines=True,
         )
 
         self.assertEqual(call_srun in self.Popen.all_calls, True)
 
-    @replace("popper.runner_slurm.os.kill", mock_kill)
-    def test_exec_mpi(self, mock_kill):
+    def test_exec_mpi(self):
         config_dict = {
             "engine": {"name": "singularity", "options": {},},
             "resource_manager": {
@@ -140,7 +176,6 @@ class TestSlurmSlurmRunner(PopperTest):
             f"popper_sample_{config.wid}.sh",
             returncode=0,
         )
-        self.Popen.set_command(f"tail -f popper_sample_{config.wid}.out", returncode=0)
         step = Box({"id": "sample"}, default_box=True)
         with SlurmRunner(config=config) as sr:
             e = sr._exec_mpi(["ls -la"], step)
@@ -159,17 +194,7 @@ class TestSlurmSlurmRunner(PopperTest):
 mpirun ls -la""",
             )
             self.assertEqual(len(sr._spawned_jobs), 0)
-            self.assertEqual(sr._out_stream_thread.is_alive(), False)
-
-        call_tail = call.Popen(
-            ["tail", "-f", f"popper_sample_{config.wid}.out"],
-            cwd=os.getcwd(),
-            env=None,
-            preexec_fn=os.setsid,
-            stderr=-2,
-            stdout=-1,
-            universal_newlines=True,
-        )
+            self.assertEqual(sr._out_follower._files, {})
 
         call_sbatch = call.Popen(
             [
@@ -185,10 +210,8 @@ mpirun ls -la""",
             preexec_fn=os.setsid,
             stderr=-2,
             stdout=-1,
-            universal_newlines=True,
         )
 
-        self.assertEqual(call_tail in self.Popen.all_calls, True)
         self.assertEqual(call_sbatch in self.Popen.all_calls, True)
 
     def test_dry_run(self):
@@ -206,8 +229,7 @@ mpirun ls -la""",
 
         self.assertEqual(self.Popen.all_calls, [])
 
-    # @replace("popper.runner_slurm.os.kill", mock_kill)
-    # def test_exec_srun_failure(self, mock_kill):
+    # def test_exec_srun_failure(self):
     #     config_dict = {
     #         "engine": {
     #             "name": "singularity",
@@ -251,8 +273,7 @@ mpirun ls -la""",
     #         wf_data = {"steps": [{"uses": "docker://alpine", "args": ["ls"]}]}
     #         self.assertRaises(SystemExit, r.run, WorkflowParser.parse(wf_data=wf_data))
 
-    @replace("popper.runner_slurm.os.kill", mock_kill)
-    def test_exec_mpi_failure(self, mock_kill):
+    def test_exec_mpi_failure(self):
         config_dict = {
             "engine": {"name": "singularity", "options": {},},
             "resource_manager": {
@@ -269,8 +290,6 @@ mpirun ls -la""",
             "sbatch " "--wait --overcommit " f"popper_1_{config.wid}.sh", returncode=12,
         )
 
-        self.Popen.set_command(f"tail -f popper_1_{config.wid}.out", returncode=0)
-
         with WorkflowRunner(config) as r:
             wf_data = {"steps": [{"uses": "docker://alpine", "args": ["ls"]}]}
             self.assertRaises(SystemExit, r.run, WorkflowParser.parse(wf_data=wf_data))
@@ -292,6 +311,7 @@ class TestSlurmSingularityRunner(unittest.TestCase):
         )
         self.addCleanup(replacer.restore)
         self.addCleanup(assert_replacer.restore)
+        self.addCleanup(remove_job_files, job_files())
 
     def tearDown(self):
         log.setLevel("NOTSET")
@@ -300,7 +320,6 @@ class TestSlurmSingularityRunner(unittest.TestCase):
         config = ConfigLoader.load(workspace_dir="/w")
         with SingularityRunner(config=config) as sr:
             step = Box({"args": ["-two", "-flags"]}, default_box=True)
-            sr._container = "c1.sif"
             cmd = sr._create_cmd(step, "c1.sif")
 
             expected = (
@@ -329,7 +348,6 @@ class TestSlurmSingularityRunner(unittest.TestCase):
 
         with SingularityRunner(config=config) as sr:
             step = Box({"args": ["-two", "-flags"]}, default_box=True)
-            sr._container = "c2.sif"
             cmd = sr._create_cmd(step, "c2.sif")
 
             # fmt: off
@@ -337,8 +355,7 @@ class TestSlurmSingularityRunner(unittest.TestCase):
             # fmt: on
             self.assertEqual(expected.split(" "), cmd)
 
-    @replace("popper.runner_slurm.os.kill", mock_kill)
-    def test_run(self, mock_kill):
+    def test_run(self):
         self.maxDiff = None
         config_dict = {
             "engine": {
@@ -358,6 +375,18 @@ class TestSlurmSingularityRunner(unittest.TestCase):
 
         config = ConfigLoader.load(workspace_dir="/w", config_file=config_dict)
 
+        # images are stored in a folder shared by workspaces, named after a
+        # hash of their URI
+        key = hashlib.sha256("docker://alpine".encode("utf-8")).hexdigest()[:16]
+        sif = f"{os.environ['HOME']}/.cache/popper/singularity/images/{key}.sif"
+        tmp_sif = f"{os.path.dirname(sif)}/.{key}.sif.popper_1_{config.wid}.sif"
+
+        self.Popen.set_command(
+            "srun --nodes 2 --ntasks 2 --ntasks-per-node 1 --nodelist worker1,worker2 "
+            f"singularity pull {tmp_sif} docker://alpine",
+            returncode=0,
+        )
+
         # fmt: off
         self.Popen.set_command(
             "sbatch "
@@ -367,8 +396,6 @@ class TestSlurmSingularityRunner(unittest.TestCase):
         )
         # fmt: on
 
-        self.Popen.set_command(f"tail -f popper_1_{config.wid}.out", returncode=0)
-
         with WorkflowRunner(config) as r:
             wf_data = {"steps": [{"uses": "docker://alpine", "args": ["ls"]}]}
             r.run(WorkflowParser.parse(wf_data=wf_data))
@@ -382,7 +409,7 @@ class TestSlurmSingularityRunner(unittest.TestCase):
 #SBATCH --ntasks=2
 #SBATCH --ntasks-per-node=1
 #SBATCH --nodelist=worker1,worker2
-mpirun singularity run --userns --pwd /workspace --bind /w:/workspace --bind /path/in/host:/path/in/container --hostname popper.local {os.environ['HOME']}/.cache/popper/singularity/{config.wid}/popper_1_{config.wid}.sif ls"""
+mpirun singularity run --userns --pwd /workspace --bind /w:/workspace --bind /path/in/host:/path/in/container --hostname popper.local {sif} ls"""
             # fmt: on
             actual = f.read()
             self.assertEqual(expected, actual)
@@ -411,20 +438,58 @@ mpirun singularity run --userns --pwd /workspace --bind /w:/workspace --bind /pa
         config = ConfigLoader.load(workspace_dir="/w", config_file=config_dict)
 
         self.Popen.set_command(
-            f"srun --nodes 2 --ntasks 2 --ntasks-per-node 1 --nodelist worker1,worker2 rm -rf popper_1_{config.wid}.sif",
+            f"srun --nodes 2 --ntasks 2 --ntasks-per-node 1 --nodelist worker1,worker2 singularity run --userns --pwd /workspace --bind /w:/workspace --bind /path/in/host:/path/in/container --hostname popper.local {sif} ls",
             returncode=0,
         )
 
-        self.Popen.set_command(
-            f"srun --nodes 2 --ntasks 2 --ntasks-per-node 1 --nodelist worker1,worker2 singularity pull docker://alpine:latest",
-            returncode=0,
-        )
+        with WorkflowRunner(config) as r:
+            wf_data = {
+                "steps": [
+                    {"uses": "docker://alpine", "args": ["ls"], "env": {"FOO": "bar"}}
+                ]
+            }
+            r.run(WorkflowParser.parse(wf_data=wf_data))
+
+        # the variables of the step are given to singularity through the
+        # environment of srun
+        srun = [c for c in self.Popen.all_calls if c.args and c.args[0][-1] == "ls"]
+        self.assertEqual(srun[-1].kwargs["env"]["SINGULARITYENV_FOO"], "bar")
+        self.assertNotIn("FOO", os.environ)
+
+    def test_use_refreshes_age(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        os.environ["POPPER_CACHE_DIR"] = cache_dir
+        config_dict = {
+            "engine": {
+                "name": "singularity",
+                "options": {"pull_policy": "if-not-present"},
+            },
+            "resource_manager": {"name": "slurm", "options": {"1": {"mpi": False}}},
+        }
+        config = ConfigLoader.load(workspace_dir="/w", config_file=config_dict)
+        os.environ.pop("POPPER_CACHE_DIR")
+
+        # an image that was pulled long ago and not used since
+        key = hashlib.sha256("docker://alpine".encode("utf-8")).hexdigest()[:16]
+        sif = os.path.join(cache_dir, "singularity", "images", f"{key}.sif")
+        os.makedirs(os.path.dirname(sif))
+        with open(sif, "w") as f:
+            f.write("sif")
+        os.utime(sif, (0, 0))
 
         self.Popen.set_command(
-            f"srun --nodes 2 --ntasks 2 --ntasks-per-node 1 --nodelist worker1,worker2 singularity run --userns --pwd /workspace --bind /w:/workspace --bind /path/in/host:/path/in/container --hostname popper.local {os.environ['HOME']}/.cache/popper/singularity/{config.wid}/popper_1_{config.wid}.sif ls",
+            "srun --nodes 1 --ntasks 1 --ntasks-per-node 1 singularity run "
+            f"--userns --pwd /workspace --bind /w:/workspace {sif} ls",
             returncode=0,
         )
 
         with WorkflowRunner(config) as r:
             wf_data = {"steps": [{"uses": "docker://alpine", "args": ["ls"]}]}
             r.run(WorkflowParser.parse(wf_data=wf_data))
+
+        # the image is not pulled again, but its access time is updated
+        cmds = [c.args[0] for c in self.Popen.all_calls if c.args]
+        self.assertFalse(any("pull" in cmd for cmd in cmds))
+        self.assertGreater(os.stat(sif).st_atime, time.time() - 60)
+        self.assertEqual(os.stat(sif).st_mtime, 0)
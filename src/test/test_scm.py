@@ -1,4 +1,5 @@
 import os
+import shutil
 import tempfile
 
 import git
@@ -121,6 +122,78 @@ class TestScm(PopperTest):
         repo.close()
         os.chdir(currdir)
 
+    def test_clone_from_mirror(self):
+        # create a repository in <tempdir>/org/repo to serve as remote
+        remote_base = self.mk_tmpdir()
+        remote = git.Repo.clone_from(
+            self.mk_repo().working_dir, os.path.join(remote_base, "org", "repo")
+        )
+        branch = remote.active_branch.name
+
+        cache_dir = self.mk_tmpdir()
+        mirror_dir = os.path.join(cache_dir, "mirrors", "org", "repo.git")
+        repo_dirs = [os.path.join(cache_dir, wid, "org", "repo") for wid in "ab"]
+
+        for repo_dir in repo_dirs:
+            scm.clone(remote_base, "org", "repo", repo_dir, branch, mirror_dir)
+            repo = git.Repo(repo_dir)
+            self.assertEqual(repo.remotes.origin.url, mirror_dir)
+            self.assertEqual(repo.head.commit.hexsha, remote.head.commit.hexsha)
+            repo.close()
+
+        mirror = git.Repo(mirror_dir)
+        self.assertTrue(mirror.bare)
+        mirror.close()
+
+        # new commits in the remote get to the clones through the mirror
+        with open(os.path.join(remote.working_dir, "README.md"), "a") as f:
+            f.write("more content\n")
+        remote.index.add(["README.md"])
+        remote.index.commit("third commit")
+
+        scm.clone(remote_base, "org", "repo", repo_dirs[0], branch, mirror_dir)
+        repo = git.Repo(repo_dirs[0])
+        self.assertEqual(repo.head.commit.hexsha, remote.head.commit.hexsha)
+        repo.close()
+        remote.close()
+
+    def test_clone_shallow(self):
+        remote_base = self.mk_tmpdir()
+        remote = git.Repo.clone_from(
+            self.mk_repo().working_dir, os.path.join(remote_base, "org", "repo")
+        )
+        first_sha = remote.head.commit.parents[0].hexsha
+        remote.create_tag("v1.0")
+
+        cache_dir = self.mk_tmpdir()
+
+        # only the tagged commit is fetched
+        repo_dir = os.path.join(cache_dir, "tag", "org", "repo")
+        scm.clone(remote_base, "org", "repo", repo_dir, "v1.0", shallow=True)
+        repo = git.Repo(repo_dir)
+        self.assertEqual(repo.head.commit.hexsha, remote.head.commit.hexsha)
+        self.assertEqual(len(list(repo.iter_commits())), 1)
+        self.assertTrue(scm.is_checked_out(repo_dir, "v1.0"))
+        repo.close()
+
+        # a commit that can't be fetched shallowly triggers a full fetch
+        repo_dir = os.path.join(cache_dir, "sha", "org", "repo")
+        scm.clone(remote_base, "org", "repo", repo_dir, first_sha[:7], shallow=True)
+        repo = git.Repo(repo_dir)
+        self.assertEqual(repo.head.commit.hexsha, first_sha)
+        repo.close()
+
+        # tags and commits that are checked out don't require the remote
+        remote.close()
+        os.rename(remote_base, remote_base + ".moved")
+        self.addCleanup(shutil.rmtree, remote_base + ".moved", ignore_errors=True)
+        scm.clone(remote_base, "org", "repo", repo_dir, first_sha[:7], shallow=True)
+        scm.clone(remote_base, "org", "repo", repo_dir, first_sha)
+        repo_dir = os.path.join(cache_dir, "tag", "org", "repo")
+        scm.clone(remote_base, "org", "repo", repo_dir, "v1.0", shallow=True)
+        self.assertFalse(scm.is_checked_out(repo_dir, "v0.1"))
+        self.assertFalse(scm.is_checked_out(repo_dir, first_sha))
+
     def test_parse(self):
         test_url = "ssh://git@github.com:popperized" "/github-actions-demo.git"
         self.assertRaises(SystemExit, scm.parse, test_url)
@@ -1,3 +1,7 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
 from popper import utils as pu
@@ -40,3 +44,69 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(pu.key_value_to_flag("y", False, eq), "-y=false")
         self.assertEqual(pu.key_value_to_flag("yy", True, eq), "--yy=true")
         self.assertEqual(pu.key_value_to_flag("zz", "c", eq), "--zz=c")
+
+    def test_paths_digest(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        os.makedirs(os.path.join(root, "d"))
+        with open(os.path.join(root, "d", "a"), "w") as f:
+            f.write("a")
+        with open(os.path.join(root, "b"), "w") as f:
+            f.write("b")
+
+        digest = pu.paths_digest(root, ["d", "b"])
+        self.assertEqual(digest, pu.paths_digest(root, ["b", "d"]))
+        self.assertNotEqual(digest, pu.paths_digest(root, ["d"]))
+        self.assertNotEqual(digest, pu.paths_digest(root, ["d", "b", "missing"]))
+
+        with open(os.path.join(root, "d", "a"), "w") as f:
+            f.write("changed")
+        self.assertNotEqual(digest, pu.paths_digest(root, ["d", "b"]))
+
+    def test_parse_duration(self):
+        self.assertEqual(pu.parse_duration("90"), 90)
+        self.assertEqual(pu.parse_duration("90s"), 90)
+        self.assertEqual(pu.parse_duration("15m"), 900)
+        self.assertEqual(pu.parse_duration("1h30m"), 5400)
+        self.assertEqual(pu.parse_duration("2d"), 172800)
+        self.assertRaises(SystemExit, pu.parse_duration, "1x")
+        self.assertRaises(SystemExit, pu.parse_duration, "h1")
+        self.assertRaises(SystemExit, pu.parse_duration, "")
+
+    def test_build_context_digest(self):
+        ctx = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ctx, ignore_errors=True)
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        index_file = os.path.join(index_dir, "contexts", "ctx.json")
+        with open(os.path.join(ctx, "Dockerfile"), "w") as f:
+            f.write("FROM alpine:3.9\n")
+        os.makedirs(os.path.join(ctx, "logs"))
+        with open(os.path.join(ctx, "logs", "out.log"), "w") as f:
+            f.write("out")
+
+        digest = pu.build_context_digest(ctx, index_file)
+        with open(index_file, "r") as f:
+            self.assertEqual(sorted(json.load(f)), ["Dockerfile", "logs/out.log"])
+
+        # the index is used for files that didn't change
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        index["Dockerfile"][2] = "cached"
+        with open(index_file, "w") as f:
+            json.dump(index, f)
+        self.assertNotEqual(digest, pu.build_context_digest(ctx, index_file))
+        os.remove(index_file)
+        self.assertEqual(digest, pu.build_context_digest(ctx, index_file))
+
+        # files excluded by .dockerignore don't affect the digest
+        with open(os.path.join(ctx, ".dockerignore"), "w") as f:
+            f.write("# comment\nlogs\n")
+        digest = pu.build_context_digest(ctx, index_file)
+        with open(os.path.join(ctx, "logs", "out.log"), "w") as f:
+            f.write("more output")
+        self.assertEqual(digest, pu.build_context_digest(ctx, index_file))
+
+        with open(os.path.join(ctx, "Dockerfile"), "a") as f:
+            f.write("RUN apk add bash\n")
+        self.assertNotEqual(digest, pu.build_context_digest(ctx, index_file))